@@ -0,0 +1,246 @@
+"""
+Analog analysis of many FOVs at once.
+
+Each AnalyzedAnalogTrace analyzes a single FOV with pandas, which in large
+batches costs more than the analysis itself. analyze_analog_batch reads the
+analog files of many FOVs of the same acquisition type, stacks their
+per-frame samples into a (FOV x frame) array padded with NaNs, and detects
+the puffs, juxta puffs and running of all of them with a few NumPy
+operations along its rows. Every row is reduced on its own, so each FOV
+gets exactly the values its own analysis class computes. The result is an
+AnalogBatch - the per-frame epoch codes of all FOVs, one after the other,
+with a bit per base signal as in :meth:`EpochIntervals.code`.
+
+Usage:
+    batch = analyze_analog_batch(analog_files, AnalogAcquisitionType.TREADMILL, fps=30.0)
+    batch.epoch_intervals(0).frames("run_stim")
+"""
+import pathlib
+from collections import namedtuple
+from typing import Optional, Sequence, Union
+
+import attr
+from attr.validators import instance_of
+import numpy as np
+
+from calcium_bflow_analysis.analog_cache import read_analog
+from calcium_bflow_analysis.analog_trace import (
+    PUFF_AND_JUXTA_DROP,
+    ROWS_PUFF_AND_JUXTA_RISE,
+    ROWS_RUN_THRESH,
+    ROWS_TRUE_PUFF_RISE,
+    TREADMILL_RUN_THRESH,
+    TRUE_PUFF_DROP,
+    AnalogAcquisitionType,
+    bin_analog_to_frames,
+)
+from calcium_bflow_analysis.epoch_intervals import (
+    MOVEMENT,
+    OCCLUDER,
+    PUFF,
+    EpochIntervals,
+    paint_intervals,
+)
+
+
+# The thresholds of each acquisition type, shared with its analysis class.
+# Puffs are steps of the stimulus channel, up (rising) or down, larger
+# than puff_and_juxta, and true puffs are steps larger than true_puff.
+Detection = namedtuple("Detection", ("rising", "puff_and_juxta", "true_puff", "run_thresh"))
+DETECTION = {
+    AnalogAcquisitionType.TREADMILL: Detection(
+        False, PUFF_AND_JUXTA_DROP, TRUE_PUFF_DROP, TREADMILL_RUN_THRESH
+    ),
+    AnalogAcquisitionType.TREADROWS: Detection(
+        True, ROWS_PUFF_AND_JUXTA_RISE, ROWS_TRUE_PUFF_RISE, ROWS_RUN_THRESH
+    ),
+}
+
+
+@attr.s(slots=True)
+class AnalogBatch:
+    """
+    The per-frame epoch codes of a batch of FOVs. The codes of the i-th FOV
+    are codes[offsets[i]:offsets[i + 1]], and bit j of a code is set if the
+    frame is in signals[j].
+    """
+
+    fnames = attr.ib(validator=instance_of(list))
+    signals = attr.ib(validator=instance_of(tuple))
+    codes = attr.ib(validator=instance_of(np.ndarray), repr=False)
+    offsets = attr.ib(validator=instance_of(np.ndarray), repr=False)
+
+    @property
+    def num_of_frames(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def fov_codes(self, fov: int) -> np.ndarray:
+        """ A view of the codes of a FOV """
+        return self.codes[self.offsets[fov] : self.offsets[fov + 1]]
+
+    def epoch_intervals(self, fov: int) -> EpochIntervals:
+        return EpochIntervals.from_code(self.fov_codes(fov), self.signals)
+
+    def padded(self, fill_value: int = 0) -> np.ndarray:
+        """ The codes as a (FOV x frame) array, padded to the longest FOV """
+        num_of_frames = self.num_of_frames
+        padded = np.full(
+            (len(num_of_frames), num_of_frames.max(initial=0)), fill_value, dtype=self.codes.dtype
+        )
+        padded[np.arange(padded.shape[1]) < num_of_frames[:, np.newaxis]] = self.codes
+        return padded
+
+
+def analyze_analog_batch(
+    analog_files: Sequence[pathlib.Path],
+    analog_type: AnalogAcquisitionType,
+    fps: Union[float, Sequence[float]],
+    num_of_frames: Optional[Sequence[int]] = None,
+    puff_length: float = 1.0,
+    buffer_after_stim: float = 1.0,
+    occ_metadata=None,
+    sep: str = ",",
+) -> AnalogBatch:
+    """
+    Analyzes the analog files of a batch of FOVs.
+
+    Parameters:
+        analog_files (list of Path): The analog .txt files.
+        analog_type (AnalogAcquisitionType): TREADMILL or TREADROWS.
+        fps (float or list of float): The frame rate of all FOVs, or of each one.
+        num_of_frames (list of int): The number of frames of each FOV, which
+            TREADROWS files need to bin their rows into frames.
+        puff_length, buffer_after_stim (float): As in AnalyzedAnalogTrace.
+        occ_metadata (namedtuple): The before and during lengths of an
+            occluder experiment, or None.
+        sep (str): Separator of the analog files.
+    """
+    if analog_type not in DETECTION:
+        raise TypeError("Invalid analog acquisition type")
+    detection = DETECTION[analog_type]
+    traces = [read_analog(fname, sep=sep).to_numpy().T for fname in analog_files]
+    num_of_samples = np.array([trace.shape[1] for trace in traces], dtype=np.int64)
+    samples = _stack(traces)
+    fps = np.broadcast_to(np.asarray(fps, dtype=np.float64), (samples.shape[1],))
+    if analog_type is AnalogAcquisitionType.TREADROWS:
+        if num_of_frames is None:
+            raise ValueError("TREADROWS files need the number of frames of each FOV.")
+        lengths = np.asarray(num_of_frames, dtype=np.int64)
+        stim, run = _rows_to_frames(samples, num_of_samples, lengths)
+    else:
+        lengths = num_of_samples
+        stim, run = samples
+    frames = np.arange(stim.shape[1])
+    in_fov = frames < lengths[:, np.newaxis]
+
+    stim_times, juxta_times = _find_puffs(
+        stim, lengths, fps, puff_length, buffer_after_stim, detection
+    )
+    run_times = _find_run(run, in_fov, fps, detection.run_thresh)
+    masks = {
+        "run": run_times,
+        "stand": ~run_times,
+        "stim": stim_times,
+        "juxta": juxta_times,
+        "spont": ~(stim_times | juxta_times),
+    }
+    signals = MOVEMENT + PUFF
+    if occ_metadata is not None:
+        during_starts = occ_metadata.before
+        after_starts = occ_metadata.before + occ_metadata.during
+        masks["before_occ"] = np.broadcast_to(frames < during_starts, in_fov.shape)
+        masks["during_occ"] = np.broadcast_to(
+            (frames >= during_starts) & (frames < after_starts), in_fov.shape
+        )
+        masks["after_occ"] = np.broadcast_to(frames >= after_starts, in_fov.shape)
+        signals += OCCLUDER
+    codes = np.zeros(in_fov.shape, dtype=np.uint8)
+    for bit, name in enumerate(signals):
+        codes |= masks[name].astype(np.uint8) << np.uint8(bit)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    return AnalogBatch(
+        [pathlib.Path(fname) for fname in analog_files], signals, codes[in_fov], offsets
+    )
+
+
+def _stack(traces: Sequence[np.ndarray]) -> np.ndarray:
+    """ Stacks (channel x sample) traces into a (channel x FOV x sample)
+    array, NaN-padded to the longest one """
+    num_of_channels = traces[0].shape[0] if traces else 2
+    length = max((trace.shape[1] for trace in traces), default=0)
+    stacked = np.full((num_of_channels, len(traces), length), np.nan)
+    for idx, trace in enumerate(traces):
+        stacked[:, idx, : trace.shape[1]] = trace
+    return stacked
+
+
+def _rows_to_frames(rows: np.ndarray, num_of_rows: np.ndarray, num_of_frames: np.ndarray):
+    """ Bins the rows of all FOVs into their frames at once, as
+    AnalogAnalysisTreadmillRows._turn_analog_vec_into_per_frame does for each """
+    max_frames = num_of_frames.max(initial=0)
+    starts = np.zeros((len(num_of_frames), max_frames), dtype=np.int64)
+    stops = np.zeros_like(starts)
+    window_sizes = np.maximum(num_of_rows // np.maximum(num_of_frames, 1), 1)
+    for fov, (length, frames, window_size) in enumerate(
+        zip(num_of_rows, num_of_frames, window_sizes)
+    ):
+        sample_at = np.linspace(window_size - 1, length - 1, num=frames, dtype=np.uint32)
+        starts[fov, :frames] = sample_at.astype(np.int64) - window_size + 1
+        stops[fov, :frames] = sample_at.astype(np.int64) + 1
+    means, counts = bin_analog_to_frames(np.abs(rows), starts, stops)
+    # As a rolling mean, frames with a missing sample have no value
+    means[counts < window_sizes[:, np.newaxis]] = np.nan
+    return means[0], means[1]
+
+
+def _find_puffs(stim, lengths, fps, puff_length, buffer_after_stim, detection):
+    """
+    The puff and juxta puff windows of all FOVs. Steps are indexed by the
+    frame before them, and steps of the same kind closer than puff_length
+    are merged into a window which extends buffer_after_stim past the last
+    of them, up to the end of its FOV.
+    """
+    diffs = np.diff(stim, axis=1)
+    with np.errstate(invalid="ignore"):
+        if detection.rising:
+            steps, true_steps = diffs > detection.puff_and_juxta, diffs > detection.true_puff
+        else:
+            steps, true_steps = diffs < detection.puff_and_juxta, diffs < detection.true_puff
+    max_gaps = (fps * puff_length).astype(np.int64)
+    buffers = (fps * buffer_after_stim).astype(np.int64)
+    num_of_frames = stim.shape[1]
+    times = []
+    for fovs, events in (np.nonzero(true_steps), np.nonzero(steps & ~true_steps)):
+        new_window = np.ones(len(events), dtype=bool)
+        new_window[1:] = (np.diff(events) > max_gaps[fovs[1:]]) | (np.diff(fovs) != 0)
+        firsts = np.flatnonzero(new_window)
+        lasts = np.concatenate((firsts[1:] - 1, [len(events) - 1]))[: len(firsts)]
+        window_fovs = fovs[firsts]
+        stops = np.minimum(events[lasts] + buffers[window_fovs], lengths[window_fovs])
+        # The windows of all FOVs are painted at once in the flattened array
+        flat_offsets = window_fovs * num_of_frames
+        painted = paint_intervals(
+            events[firsts] + flat_offsets, stops + flat_offsets, stim.size
+        )
+        times.append(painted.reshape(stim.shape))
+    return times[0], times[1]
+
+
+def _find_run(run, in_fov, fps, run_thresh):
+    """
+    Running frames of all FOVs, as in the _populate_run of the treadmill
+    analyses - the run channel of each FOV is normalized to [0, 1], and the
+    mouse runs where the rolling mean of its absolute differences, over a
+    second, passes the threshold.
+    """
+    lows = np.where(in_fov, run, np.inf).min(axis=1, keepdims=True)
+    highs = np.where(in_fov, run, -np.inf).max(axis=1, keepdims=True)
+    normalized = (run - lows) / (highs - lows)
+    diffs = np.full(run.shape, np.nan)  # the first frame has no difference
+    diffs[:, 1:] = np.abs(np.diff(normalized, axis=1))
+    windows = fps.astype(np.int64)[:, np.newaxis]
+    stops = np.broadcast_to(np.arange(1, run.shape[1] + 1), run.shape)
+    means, counts = bin_analog_to_frames(diffs, stops - windows, stops)
+    # As a rolling mean, windows with a missing value have no value
+    with np.errstate(invalid="ignore"):
+        return (means > run_thresh) & (counts == windows) & in_fov
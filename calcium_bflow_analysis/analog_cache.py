@@ -0,0 +1,172 @@
+"""
+A binary cache of the analog traces recorded with ScanImage.
+
+The analog data is a two-column text file (stimulus and run) sampled at
+1 kHz, which takes longer to parse than to analyze. The first time such a
+file is read it's converted, a chunk of lines at a time, into a .npy file
+next to it, and a small JSON file with its column names, sample rate and
+the size and modification time of the text file it was made from. Later
+reads memory-map the .npy file instead of parsing the text, as long as
+the text file wasn't changed since.
+
+Usage:
+    analog_data = read_analog(analog_fname)  # a DataFrame, as pd.read_csv returned
+"""
+import json
+import os
+import pathlib
+import warnings
+from collections import namedtuple
+from typing import Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from calcium_bflow_analysis.manifest import file_stamp
+
+
+ANALOG_COLUMNS = ("stimulus", "run")
+CACHE_SUFFIX = ".cache.npy"
+SIDECAR_SUFFIX = ".cache.json"
+CHUNK_LINES = 1_000_000
+
+AnalogSidecar = namedtuple("AnalogSidecar", ("columns", "sample_rate", "source_stamp"))
+
+
+def cache_fnames(fname: pathlib.Path):
+    """ The .npy and .json files which cache the given text file """
+    fname = pathlib.Path(fname)
+    return fname.with_name(fname.name + CACHE_SUFFIX), fname.with_name(fname.name + SIDECAR_SUFFIX)
+
+
+def read_sidecar(fname: pathlib.Path) -> Optional[AnalogSidecar]:
+    """ The description of the cache of the text file, or None if it
+    has none """
+    _, sidecar_fname = cache_fnames(fname)
+    try:
+        with open(sidecar_fname, "r") as f:
+            content = json.load(f)
+        return AnalogSidecar(
+            tuple(content["columns"]), content["sample_rate"], content["source_stamp"]
+        )
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def iter_analog_text(
+    fname: pathlib.Path,
+    columns: Sequence[str] = ANALOG_COLUMNS,
+    sep: str = ",",
+    chunk_lines: int = CHUNK_LINES,
+):
+    """ Parses the text file a chunk of lines at a time, yielding each
+    chunk as a (samples x columns) float64 array """
+    reader = pd.read_csv(
+        fname,
+        header=None,
+        names=list(columns),
+        index_col=False,
+        sep=sep,
+        dtype=np.float64,
+        chunksize=chunk_lines,
+    )
+    for chunk in reader:
+        yield chunk.to_numpy(dtype=np.float64)
+
+
+def convert_analog(
+    fname: pathlib.Path,
+    columns: Sequence[str] = ANALOG_COLUMNS,
+    sep: str = ",",
+    sample_rate: int = 1000,
+    chunk_lines: int = CHUNK_LINES,
+) -> pathlib.Path:
+    """
+    Converts the text file into its binary cache and returns the .npy
+    file name. The parsed chunks are written to a temporary file, so that
+    files of several hours are never held in memory as a whole, and the
+    .npy header, which needs the total number of samples, is written
+    before them once they're all read.
+    """
+    fname = pathlib.Path(fname)
+    cache_fname, sidecar_fname = cache_fnames(fname)
+    source_stamp = file_stamp(fname)
+    raw_fname = cache_fname.with_name(cache_fname.name + ".raw")
+    tmp_fname = cache_fname.with_name(cache_fname.name + ".tmp")
+    num_of_samples = 0
+    try:
+        with open(raw_fname, "wb") as raw:
+            for chunk in iter_analog_text(fname, columns, sep, chunk_lines):
+                raw.write(np.ascontiguousarray(chunk).tobytes())
+                num_of_samples += len(chunk)
+        header = {
+            "descr": np.lib.format.dtype_to_descr(np.dtype(np.float64)),
+            "fortran_order": False,
+            "shape": (num_of_samples, len(columns)),
+        }
+        with open(tmp_fname, "wb") as out, open(raw_fname, "rb") as raw:
+            np.lib.format.write_array_header_1_0(out, header)
+            while True:
+                block = raw.read(1 << 24)
+                if not block:
+                    break
+                out.write(block)
+        os.replace(str(tmp_fname), str(cache_fname))
+        with open(sidecar_fname, "w") as f:
+            json.dump(
+                {
+                    "columns": list(columns),
+                    "sample_rate": sample_rate,
+                    "source_stamp": source_stamp,
+                },
+                f,
+            )
+    finally:
+        for leftover in (raw_fname, tmp_fname):
+            if leftover.exists():
+                leftover.unlink()
+    return cache_fname
+
+
+def cache_is_current(fname: pathlib.Path, columns: Sequence[str] = ANALOG_COLUMNS) -> bool:
+    """ Whether the text file has a cache with these columns, made from
+    its current contents """
+    sidecar = read_sidecar(fname)
+    cache_fname, _ = cache_fnames(fname)
+    return (
+        sidecar is not None
+        and sidecar.columns == tuple(columns)
+        and sidecar.source_stamp == file_stamp(fname)
+        and cache_fname.exists()
+    )
+
+
+def read_analog(
+    fname: pathlib.Path,
+    columns: Sequence[str] = ANALOG_COLUMNS,
+    sep: str = ",",
+    sample_rate: int = 1000,
+) -> pd.DataFrame:
+    """
+    Reads the analog text file through its binary cache, converting it first
+    if it has no cache or was changed since. The data is memory-mapped
+    copy-on-write, so the analysis may modify it without changing the cache.
+    If the cache can't be written, e.g. in a read-only folder, the text
+    file is parsed as before.
+    """
+    fname = pathlib.Path(fname)
+    if cache_is_current(fname, columns):
+        cache_fname, _ = cache_fnames(fname)
+    else:
+        try:
+            cache_fname = convert_analog(fname, columns, sep, sample_rate)
+        except OSError:
+            warnings.warn(f"Couldn't write the analog cache of {fname}.")
+            chunks = list(iter_analog_text(fname, columns, sep))
+            data = np.concatenate(chunks) if chunks else np.empty((0, len(columns)))
+            return pd.DataFrame(data, columns=list(columns))
+    try:
+        data = np.load(str(cache_fname), mmap_mode="c")
+    except ValueError:  # an empty trace can't be memory-mapped
+        data = np.load(str(cache_fname))
+    return pd.DataFrame(data, columns=list(columns), copy=False)
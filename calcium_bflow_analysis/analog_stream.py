@@ -0,0 +1,210 @@
+"""
+Detection of the epochs of a recording while its analog data is acquired.
+
+The analysis classes in analog_trace need the entire analog file. The
+StreamingAnalogDetector instead receives chunks of analog samples as they
+arrive, one (stimulus, run) sample per frame as in the TREADMILL
+acquisition, and returns the epoch code of each frame once it can no longer
+change. The code has a bit for each base signal, in the order of
+``detector.signals``, and :meth:`EpochIntervals.from_code` turns the codes
+into the compound epochs of the batch analysis.
+
+Only a bounded state is kept between chunks - the last samples, the rolling
+window of the run detection and the puff windows which may still be
+extended - so a recording of any length is processed in constant memory.
+
+Usage:
+    detector = StreamingAnalogDetector(fps=30.0, run_range=(0.0, 5.0))
+    for chunk in chunks:
+        codes = detector.feed(chunk)  # codes of the frames which are final
+    codes = detector.flush()  # the remaining frames, at the end of the recording
+"""
+from typing import Dict, List, Optional, Tuple
+
+import attr
+from attr.validators import instance_of
+import numpy as np
+
+from calcium_bflow_analysis.analog_trace import (
+    PUFF_AND_JUXTA_DROP,
+    TREADMILL_RUN_THRESH,
+    TRUE_PUFF_DROP,
+)
+from calcium_bflow_analysis.epoch_intervals import MOVEMENT, OCCLUDER, PUFF, paint_intervals
+
+
+@attr.s(slots=True)
+class StreamingAnalogDetector:
+    """
+    Incremental epoch detection of a TREADMILL analog recording.
+
+    Puffs are detected from the drops of the stimulus channel, and puffs
+    closer than puff_length are merged into a single window which extends
+    buffer_after_stim past the last of them, as AnalyzedAnalogTrace does.
+    Running is detected as in AnalogAnalysisTreadmill._populate_run, from
+    the rolling mean of the absolute differences of the normalized run
+    channel. The batch analysis normalizes by the minimum and maximum of
+    the whole recording, which aren't known during acquisition, so they're
+    given as run_range - the output range of the encoder. With the actual
+    minimum and maximum of the recording, the codes are identical to those
+    of the batch analysis of the same data.
+
+    Attributes:
+        fps (float): Frame rate of the recording.
+        run_range (tuple): The (minimum, maximum) of the run channel.
+        puff_length (float): Maximal gap between merged puffs, in seconds.
+        buffer_after_stim (float): Length of the window after a puff, in seconds.
+        run_thresh (float): Threshold of the rolling mean of the run channel.
+        occ_metadata (namedtuple): The before and during lengths, in frames,
+            of an occluder experiment, or None.
+    """
+
+    fps = attr.ib(validator=instance_of(float))
+    run_range = attr.ib(validator=instance_of(tuple))
+    puff_length = attr.ib(default=1.0, validator=instance_of(float))
+    buffer_after_stim = attr.ib(default=1.0, validator=instance_of(float))
+    run_thresh = attr.ib(default=TREADMILL_RUN_THRESH, validator=instance_of(float))
+    occ_metadata = attr.ib(default=None)
+    signals = attr.ib(init=False)
+    num_of_frames = attr.ib(init=False, default=0)  # received so far
+    num_of_emitted = attr.ib(init=False, default=0)
+    _max_puff_gap = attr.ib(init=False, repr=False)
+    _buffer_frames = attr.ib(init=False, repr=False)
+    _last_stim = attr.ib(init=False, default=None, repr=False)
+    _last_run = attr.ib(init=False, default=None, repr=False)
+    _run_diffs = attr.ib(init=False, repr=False)  # the last window - 1 absolute differences
+    _pending_run = attr.ib(init=False, repr=False)  # run of the frames not yet emitted
+    _open = attr.ib(init=False, repr=False)  # the puff windows which may still be extended
+    _closed = attr.ib(init=False, repr=False)  # final puff windows not yet emitted
+
+    def __attrs_post_init__(self):
+        self.signals = MOVEMENT + PUFF
+        if self.occ_metadata is not None:
+            self.signals += OCCLUDER
+        self._max_puff_gap = int(self.fps * self.puff_length)
+        self._buffer_frames = int(self.fps * self.buffer_after_stim)
+        self._run_diffs = np.full(int(self.fps) - 1, np.nan)
+        self._pending_run = np.zeros(0, dtype=bool)
+        self._open: Dict[str, Optional[List[int]]] = {"stim": None, "juxta": None}
+        self._closed: Dict[str, List[Tuple[int, int]]] = {"stim": [], "juxta": []}
+
+    def feed(self, chunk: np.ndarray) -> np.ndarray:
+        """ Processes a (samples x 2) chunk of stimulus and run samples,
+        and returns the codes of the frames which became final """
+        chunk = np.asarray(chunk, dtype=np.float64).reshape(-1, 2)
+        first_frame = self.num_of_frames
+        self._detect_puffs(chunk[:, 0], first_frame)
+        self._pending_run = np.concatenate((self._pending_run, self._detect_run(chunk[:, 1])))
+        self.num_of_frames += len(chunk)
+        self._close_puffs()
+        return self._emit(self._frontier())
+
+    def flush(self) -> np.ndarray:
+        """ Ends the recording, and returns the codes of all frames which
+        weren't returned yet """
+        for kind, window in self._open.items():
+            if window is not None:
+                self._closed[kind].append((window[0], window[1] + self._buffer_frames))
+                self._open[kind] = None
+        return self._emit(self.num_of_frames)
+
+    def _detect_puffs(self, stim: np.ndarray, first_frame: int):
+        """ Finds the drops of the stimulus channel, including the one between
+        the previous chunk and this one. A drop is indexed by the frame
+        before it. """
+        if self._last_stim is not None:
+            stim = np.concatenate(([self._last_stim], stim))
+            first_frame -= 1
+        if len(stim):
+            self._last_stim = stim[-1]
+        diffs = np.diff(stim)
+        frames = np.arange(len(diffs)) + first_frame
+        is_true_puff = diffs < TRUE_PUFF_DROP
+        self._add_puffs("stim", frames[is_true_puff])
+        self._add_puffs("juxta", frames[(diffs < PUFF_AND_JUXTA_DROP) & ~is_true_puff])
+
+    def _add_puffs(self, kind: str, frames: np.ndarray):
+        """ Merges the puffs into the open window, or starts new ones """
+        for frame in frames.tolist():
+            window = self._open[kind]
+            if window is not None and frame - window[1] <= self._max_puff_gap:
+                window[1] = frame
+                continue
+            if window is not None:
+                self._closed[kind].append((window[0], window[1] + self._buffer_frames))
+            self._open[kind] = [frame, frame]
+
+    def _close_puffs(self):
+        """ Closes the windows which no later puff can extend. The next
+        puff can be at the last received frame, once its following
+        sample arrives. """
+        next_puff = self.num_of_frames - 1
+        for kind, window in self._open.items():
+            if window is not None and next_puff - window[1] > self._max_puff_gap:
+                self._closed[kind].append((window[0], window[1] + self._buffer_frames))
+                self._open[kind] = None
+
+    def _detect_run(self, run: np.ndarray) -> np.ndarray:
+        """ Whether the mouse ran in each of the frames of the chunk, from
+        the rolling mean of the differences of the normalized samples """
+        low, high = self.run_range
+        normalized = (run - low) / (high - low)
+        if self._last_run is None:
+            previous = np.nan  # the first frame has no difference
+        else:
+            previous = self._last_run
+        if len(normalized):
+            self._last_run = normalized[-1]
+        diffs = np.abs(np.diff(np.concatenate(([previous], normalized))))
+        window = len(self._run_diffs) + 1
+        diffs = np.concatenate((self._run_diffs, diffs))
+        self._run_diffs = diffs[len(diffs) - (window - 1) :]
+        windows = np.lib.stride_tricks.as_strided(
+            diffs,
+            shape=(len(diffs) - window + 1, window),
+            strides=(diffs.strides[0], diffs.strides[0]),
+            writeable=False,
+        )
+        with np.errstate(invalid="ignore"):
+            return windows.mean(axis=1) > self.run_thresh
+
+    def _frontier(self) -> int:
+        """ The first frame which may still change. New puffs can only
+        start at the last received frame or later, and the frames after
+        an open window may still be added to it. """
+        frontier = self.num_of_frames - 1
+        for window in self._open.values():
+            if window is not None:
+                frontier = min(frontier, window[1] + self._buffer_frames)
+        return max(frontier, self.num_of_emitted)
+
+    def _emit(self, frontier: int) -> np.ndarray:
+        """ The codes of the frames up to the frontier """
+        start = self.num_of_emitted
+        length = frontier - start
+        dtype = np.uint8
+        code = np.zeros(length, dtype=dtype)
+        run = self._pending_run[:length]
+        self._pending_run = self._pending_run[length:]
+        puffs = {}
+        for kind in ("stim", "juxta"):
+            windows = list(self._closed[kind])
+            if self._open[kind] is not None:
+                first, last = self._open[kind]
+                windows.append((first, last + self._buffer_frames))
+            windows = np.array(windows, dtype=np.int64).reshape(-1, 2) - start
+            puffs[kind] = paint_intervals(windows[:, 0], windows[:, 1], length)
+            self._closed[kind] = [window for window in self._closed[kind] if window[1] > frontier]
+        spont = ~(puffs["stim"] | puffs["juxta"])
+        masks = {"run": run, "stand": ~run, "spont": spont, **puffs}
+        if self.occ_metadata is not None:
+            frames = np.arange(start, frontier)
+            during_starts = self.occ_metadata.before
+            after_starts = self.occ_metadata.before + self.occ_metadata.during
+            masks["before_occ"] = frames < during_starts
+            masks["during_occ"] = (frames >= during_starts) & (frames < after_starts)
+            masks["after_occ"] = frames >= after_starts
+        for bit, name in enumerate(self.signals):
+            code |= masks[name].astype(dtype) << dtype(bit)
+        self.num_of_emitted = frontier
+        return code
@@ -1,13 +1,11 @@
 import pathlib
 import re
 from typing import Tuple, Any, Union
-from itertools import product
 import os
 from datetime import datetime
 from collections import namedtuple
 from enum import Enum
 
-import tifffile
 import pandas as pd
 import numpy as np
 import attr
@@ -15,11 +13,29 @@ from attr.validators import instance_of
 import xarray as xr
 
 from calcium_bflow_analysis.dff_dataset import dff_dataset_init
+from calcium_bflow_analysis.epoch_intervals import (
+    EpochIntervals,
+    has_neighbor,
+    paint_intervals,
+)
 from calcium_bflow_analysis.fluo_metadata import FluoMetadata
+from calcium_bflow_analysis.metadata_index import get_stack_metadata
 
 # Constant values for the analog acquisiton
 TYPICAL_JUXTA_VALUE = -480
 TYPICAL_PUFF_VALUE = -27180
+# Thresholds of the drops of the stimulus channel - of puffs and juxta
+# puffs together, and of true puffs alone
+PUFF_AND_JUXTA_DROP = -50
+TRUE_PUFF_DROP = -1000
+# The same thresholds for the rises of the per-frame stimulus channel of
+# TREADROWS acquisitions
+ROWS_PUFF_AND_JUXTA_RISE = 1
+ROWS_TRUE_PUFF_RISE = 3.8
+# Thresholds of the rolling mean of the absolute differences of the
+# normalized run channel, above which the mouse is running
+TREADMILL_RUN_THRESH = 0.035
+ROWS_RUN_THRESH = 0.01
 
 
 class AnalogAcquisitionType(Enum):
@@ -76,6 +92,41 @@ def analog_trace_runner(
     return analysis
 
 
+def bin_analog_to_frames(
+    data: np.ndarray, starts: np.ndarray, stops: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    NaN-aware means of the analog samples in each [start, stop) window,
+    along the last axis of data, which can hold several channels.
+    Windows may overlap, so they're reduced as differences of prefix sums
+    of the values and of the number of valid samples, rather than by a
+    loop over the frames.
+    starts and stops are either shared by all rows of data, or have a row
+    of windows for each row of it, e.g. for traces of several FOVs which
+    are padded to the same length.
+    Returns the means, NaN for windows without valid samples, and the
+    number of valid samples in each window.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    valid = np.isfinite(data)
+    pad = [(0, 0)] * (data.ndim - 1) + [(1, 0)]
+    sums = np.pad(np.cumsum(np.where(valid, data, 0.0), axis=-1), pad)
+    counts = np.pad(np.cumsum(valid, axis=-1), pad)
+    starts = np.clip(starts, 0, data.shape[-1])
+    stops = np.clip(stops, starts, data.shape[-1])
+    if starts.ndim == 1:
+        window_counts = counts[..., stops] - counts[..., starts]
+        window_sums = sums[..., stops] - sums[..., starts]
+    else:
+        leading = (1,) * (data.ndim - starts.ndim)
+        starts, stops = starts.reshape(leading + starts.shape), stops.reshape(leading + stops.shape)
+        window_counts = np.take_along_axis(counts, stops, -1) - np.take_along_axis(counts, starts, -1)
+        window_sums = np.take_along_axis(sums, stops, -1) - np.take_along_axis(sums, starts, -1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.where(window_counts > 0, window_sums / window_counts, np.nan)
+    return means, window_counts
+
+
 @attr.s
 class AnalyzedAnalogTrace:
     """
@@ -130,9 +181,9 @@ class AnalyzedAnalogTrace:
             vec = self.analog_trace.stimulus.to_numpy()
         else:
             vec = vec.to_numpy()
-        diffs_puff_and_juxta = np.where(np.diff(vec) < -50)[0]
-        diffs_true = np.where(np.diff(vec) < -1000)[0]
-        intersect = np.in1d(diffs_puff_and_juxta, diffs_true)
+        diffs_puff_and_juxta = np.where(np.diff(vec) < PUFF_AND_JUXTA_DROP)[0]
+        diffs_true = np.where(np.diff(vec) < TRUE_PUFF_DROP)[0]
+        intersect = np.isin(diffs_puff_and_juxta, diffs_true)
         true_puff_idx = diffs_puff_and_juxta[intersect]
         juxta_puff_idx = diffs_puff_and_juxta[~intersect]
         true_puff_times = np.zeros_like(vec)
@@ -147,19 +198,16 @@ class AnalyzedAnalogTrace:
     def _iter_over_puff_times(self, puff_idx, vec_len):
         max_puff_length = int(self.metadata.fps * self.puff_length)
         buffer_after_stim_frames = int(self.metadata.fps * self.buffer_after_stim)
-        puff_times = np.zeros(vec_len)
         puff_limits = np.where(np.diff(puff_idx) > max_puff_length)[0]
         start_puff_indices = puff_limits + 1
         start_puff_indices = np.concatenate(([0], start_puff_indices))
         end_puff_indices = np.concatenate((puff_limits, [len(puff_idx) - 1]))
-        for start_of_puff, end_of_puff in zip(start_puff_indices, end_puff_indices):
-            puff_times[
-                puff_idx[start_of_puff] : (
-                    puff_idx[end_of_puff] + buffer_after_stim_frames
-                )
-            ] = 1
-
-        return puff_times
+        puff_times = paint_intervals(
+            puff_idx[start_puff_indices],
+            puff_idx[end_puff_indices] + buffer_after_stim_frames,
+            vec_len[0],
+        )
+        return puff_times.astype(np.float64)
 
     def _populate_occluder(self):
         self.before_occ_vec = np.full(self.metadata.timestamps.shape, np.nan)
@@ -227,19 +275,12 @@ class AnalyzedAnalogTrace:
         )
         end_idx = starting_idx + samples_per_frame
 
-        for frame_idx, (start, end) in enumerate(zip(starting_idx, end_idx)):
-            self.stim_vec[frame_idx] = (
-                1.0 if np.nanmean(stim_vec[start:end]) > 0.5 else np.nan
-            )
-            self.juxta_vec[frame_idx] = (
-                1.0 if np.nanmean(juxta_vec[start:end]) > 0.5 else np.nan
-            )
-            self.run_vec[frame_idx] = (
-                1.0 if np.nanmean(run_vec[start:end]) > 0.5 else np.nan
-            )
-            self.spont_vec[frame_idx] = (
-                1.0 if np.nanmean(spont_vec[start:end]) > 0.5 else np.nan
-            )
+        means, _ = bin_analog_to_frames(
+            np.vstack((stim_vec, juxta_vec, run_vec, spont_vec)), starting_idx, end_idx
+        )
+        with np.errstate(invalid="ignore"):
+            per_frame = np.where(means > 0.5, 1.0, np.nan)
+        self.stim_vec, self.juxta_vec, self.run_vec, self.spont_vec = per_frame
 
         stand_vec = np.logical_not(np.nan_to_num(self.run_vec))
         self.stand_vec = np.where(stand_vec, 1.0, np.nan)
@@ -253,22 +294,17 @@ class AnalyzedAnalogTrace:
 
     def _get_metadata(self) -> Tuple[int, ...]:
         """
-        Retrieves metadata from ScanImage files.
+        Retrieves metadata from ScanImage files, through the metadata
+        index of the stack's folder.
         """
-        with tifffile.TiffFile(str(self.tif_filename)) as f:
-            meta = f.scanimage_metadata
-            if "FrameData" not in meta:
-                data = f.asarray()
-                num_of_lines = data.shape[1]
-                num_of_frames = data.shape[0] // self.metadata.num_of_channels
-            else:
-                num_of_lines = int(meta["FrameData"]["SI.hRoiManager.linesPerFrame"])
-                num_of_frames = int(meta["FrameData"]["SI.hStackManager.framesPerSlice"])
+        meta = get_stack_metadata(self.tif_filename)
+        num_of_lines = meta.lines_per_frame
+        num_of_frames = meta.num_of_pages // self.metadata.num_of_channels
         return num_of_lines, num_of_frames
 
     @staticmethod
     def normalize_vec(vec: pd.Series) -> pd.Series:
-        vec -= vec.min()
+        vec = vec - vec.min()
         vec = vec / vec.max()
         return vec
 
@@ -280,6 +316,22 @@ class AnalyzedAnalogTrace:
         stand_vec = np.logical_not(np.nan_to_num(self.run_vec))
         return np.where(stand_vec, 1.0, np.nan)
 
+    def epoch_intervals(self) -> EpochIntervals:
+        """ The frame intervals of the running, stimulus and occluder
+        vectors, from which any of their combinations can be computed """
+        masks = {
+            "run": self.run_vec,
+            "stand": self.stand_vec,
+            "stim": self.stim_vec,
+            "juxta": self.juxta_vec,
+            "spont": self.spont_vec,
+        }
+        if self.occluder:
+            masks["before_occ"] = self.before_occ_vec
+            masks["during_occ"] = self.occluder_vec
+            masks["after_occ"] = self.after_occ_vec
+        return EpochIntervals.from_masks(masks)
+
     def __mul__(self, other: np.ndarray) -> xr.DataArray:
         """
         Multiplying an AnalogTrace with a numpy array containing the fluorescent trace results
@@ -291,44 +343,12 @@ class AnalyzedAnalogTrace:
 
         coords_of_neurons = np.arange(other.shape[0])
 
-        # To find all possible combinations of running and stimulus we run a Cartesian product
-        movement = ["run", "stand", None]
-        puff = ["stim", "juxta", "spont", None]
-        ones = np.ones_like(self.metadata.timestamps, dtype=np.uint8)
-        move_data = [self.run_vec, self.stand_vec, ones]
-        puff_data = [self.stim_vec, self.juxta_vec, self.spont_vec, ones]
-        epochs = [movement, puff]
-        analog_data = [move_data, puff_data]
-        if self.occluder:
-            occluder = ["before_occ", "during_occ", "after_occ", None]
-            epochs.append(occluder)
-            occ_data = [
-                self.before_occ_vec,
-                self.occluder_vec,
-                self.after_occ_vec,
-                ones,
-            ]
-            analog_data.append(occ_data)
-        epochs = list(product(*epochs))
-        true_epochs = []
-        times_of_epoch = np.zeros((len(epochs), other.shape[1]), dtype=np.bool)
-        for idx, (epoch, datum) in enumerate(zip(epochs, product(*analog_data))):
-            try:
-                key = "_".join((filter(None.__ne__, epoch)))
-            except IndexError:
-                pass
-            true_epochs.append(key)
-            # Filter "None"s and multiply to find the joint area
-            prod = np.array([x for x in datum if type(x) is pd.Series]).prod(axis=0)
-            if key == "":
-                relevant_times_of_epoch = np.ones((other.shape[1]), dtype=np.bool)
-            else:
-                relevant_times_of_epoch = np.isfinite(prod)
-            times_of_epoch[idx, :] = relevant_times_of_epoch
-        # Last item is '', and it stands for "all" - so we
-        # just remove it and replace it with "all"
-        true_epochs.pop(-1)
-        true_epochs.append("all")
+        # The dataset holds the dense mask of all combinations of running,
+        # stimulus and occluder phase. The vectors are encoded once as bits
+        # of a per-frame code, and each combination is a comparison with it.
+        intervals = self.epoch_intervals()
+        true_epochs = intervals.epochs
+        times_of_epoch = intervals.to_dense()
 
         data_vars = {
             "dff": (["neuron", "time"], other),
@@ -385,7 +405,7 @@ class AnalogAnalysisTreadmill(AnalyzedAnalogTrace):
         """
         processed_run_vec = np.full(run_vec.shape, np.nan)
         run = pd.Series(run_vec).diff().abs().rolling(int(self.metadata.fps)).mean()
-        processed_run_vec[run > 0.035] = 1
+        processed_run_vec[run > TREADMILL_RUN_THRESH] = 1
 
         return processed_run_vec
 
@@ -425,9 +445,14 @@ class AnalogAnalysisTreadmillRows(AnalyzedAnalogTrace):
         frame.
         """
         window_size = max(len(vec) // self.num_of_frames, 1)
-        mean_data = vec.abs().rolling(window_size).mean()
         sample_at = np.linspace(window_size - 1, len(vec) - 1, num=self.num_of_frames, dtype=np.uint32)
-        data_per_frame = mean_data[sample_at]
+        sample_at = sample_at.astype(np.int64)
+        means, counts = bin_analog_to_frames(
+            np.abs(vec.to_numpy()), sample_at - window_size + 1, sample_at + 1
+        )
+        # As a rolling mean, frames with a missing sample have no value
+        means[counts < window_size] = np.nan
+        data_per_frame = pd.Series(means, index=sample_at)
         assert len(data_per_frame) == self.num_of_frames
         return data_per_frame
 
@@ -441,7 +466,7 @@ class AnalogAnalysisTreadmillRows(AnalyzedAnalogTrace):
         """
         processed_run_vec = np.full(run_vec.shape, np.nan)
         run = pd.Series(run_vec).diff().abs().rolling(int(self.metadata.fps)).mean()
-        processed_run_vec[run > 0.01] = 1
+        processed_run_vec[run > ROWS_RUN_THRESH] = 1
         return processed_run_vec
 
     def _find_peaks(self, vec=None) -> Tuple[np.ndarray, np.ndarray]:
@@ -455,9 +480,9 @@ class AnalogAnalysisTreadmillRows(AnalyzedAnalogTrace):
             vec = self.analog_trace.stimulus.to_numpy()
         else:
             vec = vec.to_numpy()
-        diffs_puff_and_juxta = np.where(np.diff(vec) > 1)[0]
-        diffs_true = np.where(np.diff(vec) > 3.8)[0]
-        intersect = np.in1d(diffs_puff_and_juxta, diffs_true)
+        diffs_puff_and_juxta = np.where(np.diff(vec) > ROWS_PUFF_AND_JUXTA_RISE)[0]
+        diffs_true = np.where(np.diff(vec) > ROWS_TRUE_PUFF_RISE)[0]
+        intersect = np.isin(diffs_puff_and_juxta, diffs_true)
         true_puff_idx = diffs_puff_and_juxta[intersect]
         juxta_puff_idx = diffs_puff_and_juxta[~intersect]
         true_puff_times = np.zeros_like(vec)
@@ -532,17 +557,11 @@ class AnalogAnalysisOld(AnalyzedAnalogTrace):
             )
 
             # Separate between stimulus and juxta pulses
-            idx_juxta = []
-            for val in idx_juxta_full:
-                diff = np.abs(idx_true_stim - val)
-                idx = np.where(diff < self.sample_rate)[0]
-                if idx.size > 0:
-                    continue
-                else:
-                    idx_juxta.append(val)
+            near_stim = has_neighbor(idx_juxta_full, idx_true_stim, self.sample_rate)
+            idx_juxta = idx_juxta_full[~near_stim]
         else:
-            idx_juxta = []
-        return idx_true_stim, np.array(idx_juxta)
+            idx_juxta = np.array([])
+        return idx_true_stim, idx_juxta
 
     def _populate_stims(
         self, true_stim: np.ndarray, juxta: np.ndarray
@@ -554,19 +573,15 @@ class AnalogAnalysisOld(AnalyzedAnalogTrace):
         :param juxta: Indices for a juxta stimulus
         :return: None
         """
-        stim_vec = np.full(self.analog_trace.shape[0], np.nan)
-        juxta_vec = np.full(self.analog_trace.shape[0], np.nan)
-        for idx in true_stim:
-            last_idx = int(
-                idx + (self.response_window + self.buffer_after_stim) * self.sample_rate
-            )
-            stim_vec[idx:last_idx] = 1
-
-        for idx in juxta:
-            last_idx = int(
-                idx + (self.response_window + self.buffer_after_stim) * self.sample_rate
-            )
-            juxta_vec[idx:last_idx] = 1
+        num_of_samples = self.analog_trace.shape[0]
+        window = (self.response_window + self.buffer_after_stim) * self.sample_rate
+        true_stim, juxta = np.asarray(true_stim), np.asarray(juxta)
+        stim_times = paint_intervals(
+            true_stim, (true_stim + window).astype(np.int64), num_of_samples
+        )
+        juxta_times = paint_intervals(juxta, (juxta + window).astype(np.int64), num_of_samples)
+        stim_vec = np.where(stim_times, 1.0, np.nan)
+        juxta_vec = np.where(juxta_times, 1.0, np.nan)
 
         return stim_vec, juxta_vec
 
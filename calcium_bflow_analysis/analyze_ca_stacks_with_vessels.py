@@ -12,17 +12,18 @@ import matplotlib
 
 matplotlib.use("TkAgg")
 import sys
-import tifffile
 import numpy as np
 from scipy.io import loadmat
 from matplotlib.gridspec import GridSpec
-from h5py import File
 import matplotlib.pyplot as plt
 import h5py
 from calium_bflow_analysis.trace_converter import ConversionMethod, RawTraceConverter
 from calcium_bflow_analysis.analysis_gui import AnalysisGui
+from calcium_bflow_analysis.analog_cache import read_analog
 from calcium_bflow_analysis.analog_trace import AnalogTraceAnalyzer
-import pandas as pd
+from calcium_bflow_analysis.projections import project_stack
+from calcium_bflow_analysis.read_ahead import read_ahead, warm_file
+from calcium_bflow_analysis.stack_io import StackReader
 import xarray as xr
 
 from calcium_trace_analysis import CalciumAnalyzer
@@ -39,20 +40,21 @@ def batch_process(foldername, close_figs=True):
     # foldername = Path(r'X:\David\THY_1_GCaMP_BEFOREAFTER_TAC_290517')
     # all_files = foldername.rglob('*DAY*EXP_STIM*FOV*.tif')
     all_files = Path(foldername).rglob("*vessels_only*.mat")
+    all_files = [
+        file for file in all_files if not ("oldana" in str(file) or "Oldana" in str(file))
+    ]
     do_calcium = False
-    for file in all_files:
-        if "oldana" in str(file) or "Oldana" in str(file):
-            pass
-        else:
-            print(f"Starting {str(file)}...")
-            main(
-                filename=str(file),
-                save_file=False,
-                run_gui=False,
-                do_calcium=do_calcium,
-            )
-            if close_figs:
-                plt.close("all")
+    # The next files are read into the OS page cache while the current one is analyzed
+    for file, _ in read_ahead(all_files, warm_file):
+        print(f"Starting {str(file)}...")
+        main(
+            filename=str(file),
+            save_file=False,
+            run_gui=False,
+            do_calcium=do_calcium,
+        )
+        if close_figs:
+            plt.close("all")
 
 
 def main(
@@ -149,9 +151,7 @@ def main(
 
     if gui.analog_trace.get():
         analog_data_fname = next(Path(filename).parent.glob("*analog.txt"))
-        analog_data = pd.read_table(
-            analog_data_fname, header=None, names=["stimulus", "run"], index_col=False
-        )
+        analog_data = read_analog(analog_data_fname, sep="\t")
         an_trace = AnalogTraceAnalyzer(filename, analog_data)
         an_trace.run()
         sliced_fluo: xr.DataArray = an_trace * return_vals[
@@ -285,15 +285,20 @@ def draw_rois_and_find_fluo(
     """
     print("Reading stack...")
     if filename.endswith(".tif"):
-        tif = tifffile.imread(filename)
-        data = tif[channel_to_keep - 1 :: num_of_channels, :]
+        channel = channel_to_keep - 1
     elif filename.endswith(".h5") or filename.endswith(".hdf5"):
-        with File(filename, "r") as h5file:
-            data = h5file["mov"].value  # EP's motion correction output
+        channel, num_of_channels = 0, 1  # EP's motion correction output
+    reader = StackReader(filename, num_of_channels, dataset="mov")
+    data = reader.read(channel)
 
     # If image isn't symmetric - expand it. Useful for PYSIGHT outputs
     if data.shape[1] != data.shape[2]:
         data = resize_image(data)
+        mean_image = np.mean(data, 0)
+    else:
+        mean_image = project_stack(
+            filename, channel, reader.num_of_channels, dataset="mov", data=data
+        ).mean
 
     print("Reading complete.")
     num_of_slices = data.shape[0]
@@ -302,8 +307,6 @@ def draw_rois_and_find_fluo(
     fluorescent_trace = np.zeros((num_of_rois, num_of_slices))
 
     # Display the mean image and draw ROIs
-
-    mean_image = np.mean(data, 0)
     for idx in range(num_of_rois):
         fig_rois = plt.figure()
         ax_rois = fig_rois.add_subplot(111)
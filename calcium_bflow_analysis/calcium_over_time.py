@@ -8,10 +8,15 @@ from enum import Enum
 from pathlib import Path
 import os
 import re
-from collections import defaultdict
+import bisect
+import fnmatch
+from glob import escape as glob_escape
+from collections import defaultdict, namedtuple
 import itertools
+import traceback
+import warnings
 from datetime import datetime
-import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 from typing import Tuple, List, Optional
 
 import pandas as pd
@@ -23,7 +28,17 @@ import tifffile
 from scipy.ndimage.morphology import binary_fill_holes
 from attr.validators import instance_of
 
+from calcium_bflow_analysis.day_store import (
+    DayLayout,
+    open_day,
+    update_day,
+    write_day_cube,
+)
 from calcium_bflow_analysis.fluo_metadata import FluoMetadata
+from calcium_bflow_analysis.manifest import AnalysisManifest
+from calcium_bflow_analysis.metadata_index import get_stack_metadata
+from calcium_bflow_analysis.read_ahead import file_nbytes, read_ahead, warm_file
+from calcium_bflow_analysis.serialization import DAY_ENCODING, FOV_ENCODING, EncodingConfig
 from calcium_bflow_analysis.analog_trace import AnalogAcquisitionType
 from calcium_bflow_analysis.trace_converter import RawTraceConverter, ConversionMethod
 import calcium_bflow_analysis.caiman_funcs_for_comparison
@@ -50,6 +65,43 @@ class Epoch(Enum):
     STAND_SPONT = "stand_spont"
 
 
+@attr.s(slots=True)
+class FolderIndex:
+    """
+    All files under a folder, collected in a single walk over it. Files
+    are then found by the prefix of their name and a glob pattern using
+    a binary search over the sorted names, instead of walking the folder
+    again with ``folder.rglob(prefix + pattern)``.
+    """
+
+    folder = attr.ib(validator=instance_of(Path))
+    files = attr.ib(init=False, repr=False)  # in the order of the walk
+    names = attr.ib(init=False, repr=False)  # sorted (name, index in files)
+
+    def __attrs_post_init__(self):
+        self.files = [
+            Path(root) / name for root, _, names in os.walk(self.folder) for name in names
+        ]
+        self.names = sorted((path.name, idx) for idx, path in enumerate(self.files))
+
+    def glob(self, pattern: str) -> List[Path]:
+        """ All files whose name matches the pattern, like rglob """
+        return [path for path in self.files if fnmatch.fnmatchcase(path.name, pattern)]
+
+    def find(self, prefix: str, pattern: str) -> Optional[Path]:
+        """ The first file whose name starts with the prefix and matches
+        prefix + pattern, or None if there's no such file """
+        full_pattern = glob_escape(prefix) + pattern
+        first = None
+        for idx in range(bisect.bisect_left(self.names, (prefix,)), len(self.names)):
+            name, file_idx = self.names[idx]
+            if not name.startswith(prefix):
+                break
+            if fnmatch.fnmatchcase(name, full_pattern) and (first is None or file_idx < first):
+                first = file_idx
+        return None if first is None else self.files[first]
+
+
 @attr.s(slots=True)
 class FileFinder:
     """
@@ -96,37 +148,40 @@ class FileFinder:
         result_files = []
         colabeled_files = []
         summary_str = "Found the following {num} files:\nFluo: {fluo}\nAnalog: {analog}\nCaImAn: {caiman}\nColabeled: {colabeled}"
+        manifest = AnalysisManifest(self.results_folder)
         for folder, globstr in self.folder_globs.items():
-            for file in folder.rglob(globstr):
+            index = FolderIndex(folder)
+            if "/" in globstr:  # the pattern also matches directories
+                tif_files = folder.rglob(globstr)
+            else:
+                tif_files = index.glob(globstr)
+            for file in tif_files:
                 num_of_files_found = 1
                 fname = str(file.name)[:-4]
                 if self.analog is not AnalogAcquisitionType.NONE:
-                    try:
-                        analog_file = next(folder.rglob(fname + "*analog*.txt"))
-                        num_of_files_found += 1
-                    except StopIteration:
+                    analog_file = index.find(fname, "*analog*.txt")
+                    if analog_file is None:
                         print(f"File {file} has no analog counterpart.")
                         continue
+                    num_of_files_found += 1
                 else:
                     analog_file = None
-                try:
-                    result_file = next(folder.rglob(fname + "*results.npz"))
-                    num_of_files_found += 1
-                except StopIteration:
+                result_file = index.find(fname, "*results.npz")
+                if result_file is None:
                     print(f"File {file} has no result.npz couterpart.")
                     continue
+                num_of_files_found += 1
                 if self.with_colabeled:
-                    try:
-                        colabeled_file = next(folder.rglob(fname + "*_colabeled*.npy"))
-                        num_of_files_found += 1
-                    except StopIteration:
+                    colabeled_file = index.find(fname, "*_colabeled*.npy")
+                    if colabeled_file is None:
                         print(f"File {file} has no colabeled.npy couterpart.")
                         continue
+                    num_of_files_found += 1
                 else:
                     colabeled_file = None
-                try:
-                    _ = next(folder.rglob(f"{str(file.name)[:-4]}*.nc"))
-                except StopIteration:  # FOV wasn't already analyzed
+                # FOVs which were analyzed before are reanalyzed only if they're
+                # in the manifest, which tells whether they changed since
+                if index.find(fname, "*.nc") is None or manifest.has_fov(file):
                     print(
                         summary_str.format(
                             num=num_of_files_found,
@@ -153,14 +208,88 @@ class FileFinder:
         Turns list of pathlib.Path objects into a DataFrame.
         """
         columns = ["tif", "caiman", "analog", "colabeled"]
-        data_files = pd.DataFrame([], columns=columns)
         to_zip = [fluo_files, result_files, analog_files, colabeled_files]
-        files_iter = zip(*to_zip)
+        return pd.DataFrame(list(zip(*to_zip)), columns=columns)
 
-        for idx, files_tup in enumerate(files_iter):
-            cur_row = pd.DataFrame([files_tup], columns=columns, index=[idx])
-            data_files = data_files.append(cur_row)
-        return data_files
+
+@attr.s(frozen=True)
+class FovWorkUnit:
+    """
+    Everything that is needed in order to analyze a single FOV. It only
+    holds paths, the regexes and the analog type, so it can be sent
+    to a worker process.
+    """
+
+    tif = attr.ib(validator=instance_of(Path))
+    caiman = attr.ib(validator=instance_of(Path))
+    analog = attr.ib(default=None)
+    colabeled = attr.ib(default=None)
+    regex = attr.ib(factory=dict, validator=instance_of(dict))
+    analog_type = attr.ib(
+        default=AnalogAcquisitionType.NONE, validator=instance_of(AnalogAcquisitionType)
+    )
+    serialize = attr.ib(default=False, validator=instance_of(bool))
+    overwrite = attr.ib(default=False, validator=instance_of(bool))
+    encoding = attr.ib(default=FOV_ENCODING, validator=instance_of(EncodingConfig))
+    num_of_channels = attr.ib(default=2, validator=instance_of(int))
+
+
+FovResult = namedtuple("FovResult", ("tif", "output", "fps", "error"))
+
+
+def analyze_fov(unit: FovWorkUnit) -> FovResult:
+    """
+    Parses a single FOV with its fluorescent and analog data, and writes
+    it to disk if unit.serialize is True. Exceptions are returned as a
+    formatted traceback in the error field of the result, so that a
+    single bad FOV doesn't stop the batch.
+    """
+    print(f"Parsing {unit.tif}")
+    try:
+        meta = FluoMetadata(unit.tif, num_of_channels=unit.num_of_channels, **unit.regex)
+        meta.get_metadata()
+        fov = SingleFovParser(
+            analog_fname=unit.analog,
+            results_fname=unit.caiman,
+            metadata=meta,
+            analog=unit.analog_type,
+            summarize_in_plot=True,
+        )
+        fov.parse()
+        plt.close()
+        if unit.serialize:
+            fov.add_metadata_and_serialize(overwrite=unit.overwrite, encoding=unit.encoding)
+    except Exception:
+        return FovResult(unit.tif, None, None, traceback.format_exc())
+    return FovResult(unit.tif, str(unit.tif)[:-4] + ".nc", meta.fps, None)
+
+
+def _init_worker():
+    """ Worker processes only save their figures to disk """
+    plt.switch_backend("Agg")
+
+
+def _prefetch_fov(files_row: Tuple):
+    """ Reads the metadata of the stack of the FOV and pulls its CaImAn and
+    analog files into the OS page cache, so that processing it doesn't
+    wait for the NAS """
+    get_stack_metadata(files_row.tif)
+    warm_file(files_row.caiman)
+    warm_file(files_row.analog)
+
+
+def _fov_inputs(files_row: Tuple) -> dict:
+    """ The input files of the FOV, as they're recorded in the manifest """
+    return {
+        "tif": files_row.tif,
+        "caiman": files_row.caiman,
+        "analog": files_row.analog,
+        "colabeled": files_row.colabeled,
+    }
+
+
+def _fov_nbytes(files_row: Tuple) -> int:
+    return file_nbytes((files_row.caiman, files_row.analog))
 
 
 @attr.s(slots=True, hash=True)
@@ -172,6 +301,11 @@ class CalciumAnalysisOverTime:
     you to analyze several directories of data, each with its own glob pattern.
     If serialize is True, it will write to disk each FOV's DataArray, as well
     as the concatenated DataArray to make future processing faster.
+    "max_workers" is the number of processes that analyze FOVs in parallel.
+    "day_layout" is the layout of the per-day files, see ``day_store.DayLayout``.
+    "fov_encoding" and "day_encoding" set the compression and chunking of the
+    per-FOV and per-day files, see ``serialization.EncodingConfig``.
+    "num_of_channels" is the number of interleaved channels in each FOV's stack.
     If you've already serialized your data, use "generate_ds_per_day" to continue
     the downstream analysis of your files by concatenating all relevant files into
     one large database which can be analyzed with downstream scripts that may be
@@ -187,6 +321,12 @@ class CalciumAnalysisOverTime:
     regex = attr.ib(default=attr.Factory(dict), validator=instance_of(dict))
     list_of_fovs = attr.ib(init=False)
     concat = attr.ib(init=False)
+    max_workers = attr.ib(default=1, validator=instance_of(int))
+    day_layout = attr.ib(default=DayLayout.RAGGED, validator=instance_of(DayLayout))
+    fov_encoding = attr.ib(default=FOV_ENCODING, validator=instance_of(EncodingConfig))
+    day_encoding = attr.ib(default=DAY_ENCODING, validator=instance_of(EncodingConfig))
+    num_of_channels = attr.ib(default=2, validator=instance_of(int))
+    manifest = attr.ib(init=False, default=None)
 
     def run_batch_of_timepoints(self, results_folder):
         """
@@ -205,48 +345,91 @@ class CalciumAnalysisOverTime:
         The `**regex` kwargs-like parameter is used to manually set the regex
         that will parse the metadata from the file name. The default regexes are
         described above. Valid keys are "id_reg", "fov_reg", "cond_reg" and "day_reg".
+        Each FOV is analyzed by "analyze_fov", possibly in a worker process.
+        A FOV whose analysis raised an exception is reported and skipped,
+        and the output of its previous analysis, if any, isn't used either.
+        FOVs whose input files and parameters didn't change since they were
+        serialized, as recorded in the manifest of the results folder, aren't
+        analyzed again, and only days with changed FOVs are concatenated again.
         """
 
-        # Multiprocessing doesn't work due to the fact that not all objects are
-        # pickleable
-        # with mp.Pool() as pool:
-        #     self.list_of_fovs = pool.map(
-        #         self._mp_process_timepoints, self.files_table.itertuples(index=False)
-        #     )
+        self.manifest = AnalysisManifest(results_folder)
         self.list_of_fovs = []
+        units = []
         for row in self.files_table.itertuples():
-            self.list_of_fovs.append(self._mp_process_timepoints(row))
+            if self.manifest.fov_is_current(_fov_inputs(row), self._fov_params()):
+                print(f"{row.tif} didn't change since its last analysis")
+                self.list_of_fovs.append(self.manifest.fov_output(row.tif))
+            else:
+                units.append(self._make_work_unit(row))
+        try:
+            results = self._run_work_units(units)
+        finally:
+            self.manifest.save()
+        failed = [result for result in results if result.error is not None]
+        for result in failed:
+            print(f"Analysis of {result.tif} failed:\n{result.error}")
+        if failed:
+            warnings.warn(f"{len(failed)} out of {len(units)} FOVs failed, see errors above.")
         self.generate_ds_per_day(results_folder)
 
-    def _mp_process_timepoints(self, files_row: Tuple):
+    def _run_work_units(self, units: List[FovWorkUnit]) -> List[FovResult]:
         """
-        A function for a single process that takes three conjugated files - i.e.
-        three files that belong to the same recording, and processes them.
+        Analyzes the FOVs, in this process or in a pool of max_workers
+        processes, and returns their results in the order of the units.
+        In this process the files of the next FOVs are read ahead.
         """
-        print(f"Parsing {files_row.tif}")
-        fov = self._analyze_single_fov(files_row, analog=self.analog, **self.regex)
-        return str(fov.metadata.fname)[:-4] + ".nc"
+        results = []
+        if self.max_workers == 1:
+            for unit, _ in read_ahead(units, _prefetch_fov, nbytes=_fov_nbytes):
+                results.append(self._collect_result(unit, analyze_fov(unit)))
+            return results
 
-    def _analyze_single_fov(
-        self, files_row, analog=AnalogAcquisitionType.NONE, **regex
-    ):
-        """ Helper function to go file by file, each with its own fluorescence and
-        possibly analog data, and run the single FOV parsing on it """
+        with ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_worker) as pool:
+            futures = [pool.submit(analyze_fov, unit) for unit in units]
+            for unit, future in zip(units, futures):
+                try:
+                    result = future.result()
+                except Exception:  # the worker process itself died
+                    result = FovResult(unit.tif, None, None, traceback.format_exc())
+                results.append(self._collect_result(unit, result))
+        return results
 
-        meta = FluoMetadata(files_row.tif, num_of_channels=2, **regex)
-        meta.get_metadata()
-        fov = SingleFovParser(
-            analog_fname=files_row.analog,
-            results_fname=files_row.caiman,
-            metadata=meta,
-            analog=analog,
-            summarize_in_plot=True,
+    def _collect_result(self, unit: FovWorkUnit, result: FovResult) -> FovResult:
+        """ Records the output of a successfully analyzed FOV. A FOV that
+        failed has its previous output, whose inputs changed, invalidated. """
+        if result.error is None:
+            self.list_of_fovs.append(result.output)
+            if self.serialize:
+                self.manifest.record_fov(
+                    _fov_inputs(unit), self._fov_params(), result.output, fps=result.fps
+                )
+        else:
+            self.manifest.invalidate_fov(unit.tif)
+        return result
+
+    def _make_work_unit(self, files_row: Tuple) -> FovWorkUnit:
+        return FovWorkUnit(
+            tif=files_row.tif,
+            caiman=files_row.caiman,
+            analog=files_row.analog,
+            colabeled=files_row.colabeled,
+            regex=self.regex,
+            analog_type=self.analog,
+            serialize=self.serialize,
+            # A FOV which is in the manifest is only reanalyzed if it changed
+            overwrite=self.manifest.has_fov(files_row.tif),
+            encoding=self.fov_encoding,
+            num_of_channels=self.num_of_channels,
         )
-        fov.parse()
-        plt.close()
-        if self.serialize:
-            fov.add_metadata_and_serialize()
-        return fov
+
+    def _fov_params(self) -> dict:
+        """ The parameters which, if changed, require reanalyzing a FOV """
+        return {
+            "regex": self.regex,
+            "analog": self.analog.name,
+            "num_of_channels": self.num_of_channels,
+        }
 
     def generate_ds_per_day(self, results_folder: Path, globstr="*FOV*.nc", day_regex=r"_DAY_*(\d+)_", recursive=True):
         """
@@ -263,7 +446,7 @@ class CalciumAnalysisOverTime:
         fovs_by_day = defaultdict(list)
         day_reg = re.compile(day_regex)
         try:  # coming from run_batch_of_timepoints()
-            all_files = self.list_of_fovs
+            all_files = self.list_of_fovs + self._unchanged_fovs_in_manifest()
         except AttributeError:
             if recursive:
                 all_files = [folder.rglob(globstr) for folder in self.folder_globs]
@@ -282,38 +465,50 @@ class CalciumAnalysisOverTime:
 
         self._concat_fovs(fovs_by_day, results_folder)
 
+    def _unchanged_fovs_in_manifest(self) -> List[str]:
+        """ The outputs of FOVs that were analyzed in previous runs of this
+        experiment, which have to be concatenated with the new ones. FOVs
+        whose last analysis failed are left out. """
+        if self.manifest is None:
+            return []
+        folders = [str(folder) for folder in self.folder_globs]
+        return [
+            entry["output"]
+            for tif, entry in self.manifest.fovs.items()
+            if entry["output"] not in self.list_of_fovs
+            and not self.manifest.fov_failed(tif)
+            and any(tif.startswith(folder) for folder in folders)
+            and Path(entry["output"]).exists()
+        ]
+
     def _concat_fovs(self, fovs_by_day: dict, results_folder: Path):
         """
-        Take the list of FOVs and turn them into a single DataArray. Lastly it will
-        write this DataArray to disk.
+        Take the list of FOVs and turn them into a single day store, in the
+        layout given by day_layout. The FOVs are streamed one at a time into
+        the file on disk, so only a single FOV is held in memory.
         fovs_by_day: Dictionary with its keys being the days of experiment (0, 1, ...) and
         values as a list of filenames.
+        Days which were already concatenated from the same, unchanged, FOVs
+        aren't concatenated again. Ragged day stores are updated in place with
+        the FOVs that were added, changed or removed since they were written.
         """
         print("Concatenating all FOVs...")
         fname_to_save = "data_of_day_"
+        if self.manifest is None:
+            self.manifest = AnalysisManifest(results_folder)
         for day, file_list in fovs_by_day.items():
-            try:
-                file = next(results_folder.glob(fname_to_save + str(day) + ".nc"))
-                print(f"Found {str(file)}, not concatenating")
-            except StopIteration:  # .nc file doesn't exist
+            day_fname = results_folder / f"{fname_to_save + str(day)}.nc"
+            if self.manifest.day_is_current(day, file_list, day_fname):
+                print(f"Found {str(day_fname)}, not concatenating")
+            else:
                 print(f"Concatenating day {day}")
-                data_per_day = []
-                for file in file_list:
-                    try:
-                        data_per_day.append(xr.open_dataset(file).load())
-                    except FileNotFoundError:
-                        pass
-                concat = xr.concat(data_per_day, dim="fname")
-                # Fix datatype conversion of epoch_times to floats:
-                asbool = concat["epoch_times"].data.astype(np.bool)
-                nans = np.where(np.isnan(concat["epoch_times"].data))
-                asbool[nans] = False
-                concat["epoch_times"] = (["fname", "epoch", "time"], asbool)
-                self.concat = concat
-                concat.to_netcdf(
-                    str(results_folder / f"{fname_to_save + str(day)}.nc"),
-                    mode="w",
-                )
+                if self.day_layout is DayLayout.RAGGED:
+                    update_day(file_list, day_fname, self.day_encoding)
+                else:
+                    write_day_cube(file_list, day_fname, self.day_encoding)
+                self.concat = open_day(day_fname)
+                self.manifest.record_day(day, file_list, day_fname)
+                self.manifest.save()
 
     def _get_metadata(self, list_of_da: list, key: str, default):
         """ Finds ands returns metadata from existing DataArrays """
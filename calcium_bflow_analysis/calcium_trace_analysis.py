@@ -6,7 +6,6 @@ import attr
 from attr.validators import instance_of
 import numpy as np
 import pandas as pd
-import xarray as xr
 import matplotlib.pyplot as plt
 from typing import List, Tuple, Dict
 from enum import Enum
@@ -16,7 +15,8 @@ import itertools
 from scipy import stats
 
 from calcium_bflow_analysis.dff_analysis_and_plotting import dff_analysis
-from calcium_bflow_analysis.single_fov_analysis import filter_da
+from calcium_bflow_analysis.day_store import RaggedDay, open_day
+from calcium_bflow_analysis.single_fov_analysis import EpochSelector, filter_da
 
 
 class Condition(Enum):
@@ -55,6 +55,7 @@ class CalciumReview:
     df_columns = attr.ib(init=False)
     funcs_dict = attr.ib(init=False)
     raw_data = attr.ib(init=False)
+    selectors = attr.ib(init=False)
     auc_data = attr.ib(init=False)
     mean_data = attr.ib(init=False)
     spike_data = attr.ib(init=False)
@@ -66,6 +67,7 @@ class CalciumReview:
         """
         self.files = []
         self.raw_data = {}
+        self.selectors = {}
         all_files = folder.rglob(self.glob)
         day_reg = re.compile(r".+?of_day_(\d+).nc")
         parsed_days = []
@@ -75,7 +77,7 @@ class CalciumReview:
             self.files.append(file)
             day = int(day_reg.findall(file.name)[0])
             parsed_days.append(day)
-            self.raw_data[day] = xr.open_dataset(file)
+            self.raw_data[day] = open_day(file)
         self.days = np.unique(np.array(parsed_days))
         stats = ["_mean", "_std"]
         self.conditions = np.unique(self.raw_data[day].condition.values).tolist()
@@ -104,19 +106,30 @@ class CalciumReview:
             print(f"The day {day} is invalid. Valid days are {self.days}.")
         else:
             return filter_da(
-                unselected_data, condition=condition.value, epoch=epoch
+                self._selector(day), condition=condition.value, epoch=epoch
             )
 
+    def _selector(self, day: int):
+        """ The object which filters the data of the day by epoch and
+        condition. Ragged days filter themselves, and cubes are wrapped by
+        an EpochSelector, which is kept since its setup is costly. """
+        raw_datum = self.raw_data[day]
+        if isinstance(raw_datum, RaggedDay):
+            return raw_datum
+        if day not in self.selectors:
+            self.selectors[day] = EpochSelector(raw_datum)
+        return self.selectors[day]
+
     def apply_analysis_funcs(self, funcs: list, epoch: str):
         """ Call the list of methods given to save time and memory """
         norm1, norm2 = 1, 1
         for day, raw_datum in dict(sorted(self.raw_data.items())).items():
             print(f"Analyzing day {day}...")
             selected_first = filter_da(
-                raw_datum, condition=self.conditions[0], epoch=epoch
+                self._selector(day), condition=self.conditions[0], epoch=epoch
             )
             selected_second = filter_da(
-                raw_datum, condition=self.conditions[1], epoch=epoch
+                self._selector(day), condition=self.conditions[1], epoch=epoch
             )
             for func in funcs:
                 cond1 = getattr(dff_analysis, func.value)(selected_first)
@@ -7,7 +7,6 @@ import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 import attr
 from attr.validators import instance_of, optional
-import tifffile
 
 from calcium_bflow_analysis.dff_analysis_and_plotting.dff_analysis import (
     locate_spikes_peakutils,
@@ -19,6 +18,7 @@ from calcium_bflow_analysis.dff_analysis_and_plotting.plot_cells_and_traces impo
 )
 
 from calcium_bflow_analysis.colabeled_cells.find_colabeled_cells import TiffChannels
+from calcium_bflow_analysis.stack_io import StackReader
 
 
 @attr.s
@@ -90,7 +90,7 @@ class FovSubsetData:
         Loads a tif file containing the parallel data
         of the colabeled cells to memory.
         """
-        return tifffile.imread(str(self.colabel_img))
+        return StackReader(self.colabel_img).read()
 
     def _populate_dff_data(self):
         """
@@ -3,16 +3,20 @@ import pandas as pd
 import xarray as xr
 import matplotlib.pyplot as plt
 import pathlib
+import functools
 import attr
 import enum
 from attr.validators import instance_of
-import tifffile
 import scipy.ndimage
 import scipy.spatial.distance
 import scipy.stats
 import warnings
 import skimage.draw, skimage.measure
 
+from calcium_bflow_analysis.metadata_index import get_stack_metadata
+from calcium_bflow_analysis.projections import project_stack
+from calcium_bflow_analysis.read_ahead import file_nbytes, read_ahead
+
 
 class TiffChannels(enum.Enum):
     ONE = 0
@@ -37,8 +41,6 @@ class ColabeledCells:
     colabeled_idx = attr.ib(init=False)
     unlabeled_idx = attr.ib(init=False)
     num_of_channels = attr.ib(init=False)
-    act_data = attr.ib(init=False)
-    morph_data = attr.ib(init=False)
     act_img = attr.ib(init=False)
     morph_img = attr.ib(init=False)
     struct_element = attr.ib(init=False)
@@ -46,23 +48,18 @@ class ColabeledCells:
     def __attrs_post_init__(self):
         assert self.activity_ch != self.morph_ch
         # Divide movie into its channels (supports 2 currently)
-        try:
-            self.num_of_channels = len(tifffile.TiffFile(str(self.tif)).scanimage_metadata\
-                ['FrameData']['SI.hChannels.channelsActive'])
-        except TypeError:
+        meta = get_stack_metadata(self.tif)
+        if meta.is_scanimage:
+            self.num_of_channels = meta.num_of_channels
+        else:
             warnings.warn('Not a ScanImage stack.')
             self.num_of_channels = 1
 
-        with tifffile.TiffFile(str(self.tif), movie=True) as f:
-            if self.verbose:
-                raw_data = f.asarray()
-                self.morph_data = raw_data[self.morph_ch.value::self.num_of_channels]
-                self.act_data = raw_data[self.activity_ch.value::self.num_of_channels]
-                self.act_img = self.act_data.sum(axis=0)
-            else:
-                sl = slice(self.morph_ch.value, None, self.num_of_channels)
-                self.morph_data = f.asarray(sl)
-        self.morph_img = self.morph_data.sum(axis=0)
+        self.morph_img = project_stack(self.tif, self.morph_ch.value, self.num_of_channels).sum
+        if self.verbose:
+            self.act_img = project_stack(
+                self.tif, self.activity_ch.value, self.num_of_channels
+            ).sum
         
     def find_colabeled(self):
         """ Main method of class. Finds co-labeled cells. Returns the number
@@ -183,22 +180,34 @@ class ColabeledCells:
 
 def batch_colabeled(foldername: pathlib.Path, glob='*results.npz', verbose=False):
     """ Batch process all stacks in folder to find and write to disk
-    the indices of the colabeled cells """
-    result_files = foldername.rglob(glob)
-    for file in result_files:
-        print(f"Loading {file} and its matching TIF...")
+    the indices of the colabeled cells. The projections of the next
+    stacks are computed in the background while the current one is
+    processed. """
+    pairs = []
+    for file in foldername.rglob(glob):
         name_without_channel = str(file.name)[:-22] + '.tif'
         try:
             matching_tif = next(file.parent.glob(name_without_channel))
         except StopIteration:
             continue
-        else:
-            cur_pair = (file, matching_tif)
-            colabeled = ColabeledCells(tif=matching_tif, result_file=file,
-                                       activity_ch=TiffChannels.ONE,
-                                       morph_ch=TiffChannels.TWO,
-                                       cell_radius=5, verbose=verbose).find_colabeled()
-            print(f"File {file} contained {colabeled} colabeled cells.")
+        pairs.append((file, matching_tif))
+
+    load = functools.partial(_load_colabeled, verbose=verbose)
+    # Loading a pair reads its results file and projects its whole TIF, so
+    # the data in flight is estimated by the sizes of both files
+    for (file, _), cells in read_ahead(pairs, load, nbytes=file_nbytes):
+        colabeled = cells.find_colabeled()
+        print(f"File {file} contained {colabeled} colabeled cells.")
+
+
+def _load_colabeled(pair, verbose=False) -> ColabeledCells:
+    """ Loads the images of a results file and its matching TIF """
+    file, matching_tif = pair
+    print(f"Loading {file} and its matching TIF...")
+    return ColabeledCells(tif=matching_tif, result_file=file,
+                          activity_ch=TiffChannels.ONE,
+                          morph_ch=TiffChannels.TWO,
+                          cell_radius=5, verbose=verbose)
 
 
 if __name__ == '__main__':
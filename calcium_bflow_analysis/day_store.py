@@ -0,0 +1,560 @@
+"""
+On-disk stores of the data of all FOVs of a single experimental day, the
+"data_of_day_N.nc" files.
+
+A day store holds the datasets of many FOVs, each with its own number of
+neurons, recording length and epochs. The FOVs are streamed into the
+store one at a time, so peak memory usage is about the size of a single
+FOV. There are two layouts:
+
+* DayLayout.CUBE - the FOVs concatenated along the "fname" dimension, as
+  ``xr.concat`` would do. The neuron and time coordinates are outer-joined,
+  so the (fname x neuron x time) cube is mostly NaN padding when the FOVs
+  differ in their number of cells or in their length.
+* DayLayout.RAGGED - the (cell x time) block of each FOV is flattened into
+  a single "sample" dimension, and its position is recorded in per-FOV
+  offset arrays. The epoch masks are stored along a "frame" dimension in
+  the same way. No padding is stored, and ``RaggedDay`` returns the blocks
+  of a FOV or of a condition as views into the loaded data. Single FOVs
+  can be appended to a ragged store or replaced in it without rewriting
+  the others, and ``update_day`` brings a store up to date with its FOV
+  files this way.
+
+Usage:
+    update_day(fov_files, results_folder / "data_of_day_1.nc")
+    day = open_day(results_folder / "data_of_day_1.nc")
+    dff = day.fov_dff("fov1_00001")
+"""
+import functools
+import pathlib
+from collections import namedtuple
+from enum import Enum
+from typing import List, Optional, Sequence, Union
+
+import attr
+from attr.validators import instance_of
+import numpy as np
+import pandas as pd
+import xarray as xr
+import netCDF4
+
+from calcium_bflow_analysis.epoch_intervals import EpochIntervals
+from calcium_bflow_analysis.manifest import file_stamp
+from calcium_bflow_analysis.serialization import (
+    DAY_ENCODING,
+    EncodingConfig,
+    decode_dataset,
+    open_dataset,
+    pack_bits,
+    packed_dim,
+)
+
+
+class DayLayout(Enum):
+    CUBE = "cube"
+    RAGGED = "ragged"
+
+
+FovHeader = namedtuple(
+    "FovHeader", ("fname", "neuron", "time", "epoch", "scalar_coords", "attrs")
+)
+
+PER_FOV_COORDS = ("fov", "mouse_id", "condition", "day")
+
+
+def read_fov_header(fname: pathlib.Path) -> FovHeader:
+    """ Reads the coordinates and attributes of a FOV dataset, without
+    its data """
+    with open_dataset(fname) as ds:
+        return FovHeader(
+            fname,
+            ds["neuron"].values,
+            ds["time"].values,
+            ds["epoch"].values,
+            {key: ds[key].values.item() for key in ("fname",) + PER_FOV_COORDS},
+            dict(ds.attrs),
+        )
+
+
+def read_fov_headers(fov_files: Sequence[pathlib.Path]) -> List[FovHeader]:
+    """ The headers of all FOV files which exist """
+    headers = []
+    for file in fov_files:
+        try:
+            headers.append(read_fov_header(file))
+        except FileNotFoundError:
+            pass
+    return headers
+
+
+def write_day_cube(
+    fov_files: Sequence[pathlib.Path],
+    fname: pathlib.Path,
+    encoding: EncodingConfig = DAY_ENCODING,
+) -> pathlib.Path:
+    """
+    Writes the FOV datasets concatenated along "fname" into a NetCDF file,
+    in the same layout as ``xr.concat(datasets, dim="fname")`` - an outer
+    join over the neuron, time and epoch coordinates, with a NaN-padded
+    dF/F and a False-padded boolean epoch_times.
+
+    The variables are created with their final shape before any data is
+    read, and are then filled in one FOV at a time.
+    """
+    headers = read_fov_headers(fov_files)
+    if not headers:
+        raise ValueError(f"None of the FOV files of {fname} exist.")
+    neurons = _union([header.neuron for header in headers])
+    times = _union([header.time for header in headers])
+    epochs = _union([header.epoch for header in headers])
+
+    with netCDF4.Dataset(str(fname), "w", format="NETCDF4") as store:
+        _create_cube(store, headers, neurons, times, epochs, encoding)
+        for idx, header in enumerate(headers):
+            with open_dataset(header.fname) as ds:
+                dff = ds["dff"].values
+                epoch_times = _as_bool(ds["epoch_times"].values)
+            neuron_idx = neurons.get_indexer(header.neuron)
+            time_idx = times.get_indexer(header.time)
+            epoch_idx = epochs.get_indexer(header.epoch)
+            block = np.full((len(neurons), len(times)), np.nan)
+            block[np.ix_(neuron_idx, time_idx)] = dff
+            store["dff"][idx] = block
+            block = np.zeros((len(epochs), len(times)), dtype=bool)
+            block[np.ix_(epoch_idx, time_idx)] = epoch_times
+            store["epoch_times"][idx] = _encode_epoch_times(block, encoding)
+    return fname
+
+
+def _create_cube(
+    store: netCDF4.Dataset,
+    headers: Sequence[FovHeader],
+    neurons: pd.Index,
+    times: pd.Index,
+    epochs: pd.Index,
+    encoding: EncodingConfig,
+):
+    """ Creates the dimensions, coordinates and the empty data variables
+    of a cube-layout day store, following the conventions xarray uses so
+    that it's read back by ``xr.open_dataset`` """
+    store.createDimension("fname", len(headers))
+    store.createDimension("epoch", len(epochs))
+    store.createDimension("neuron", len(neurons))
+    store.createDimension("time", len(times))
+    _write_coord(store, "fname", ("fname",), [h.scalar_coords["fname"] for h in headers])
+    _write_coord(store, "epoch", ("epoch",), epochs.values)
+    _write_coord(store, "neuron", ("neuron",), neurons.values)
+    _write_coord(store, "time", ("time",), times.values)
+    for key in PER_FOV_COORDS:
+        values = [h.scalar_coords[key] for h in headers]
+        if all(value == values[0] for value in values):  # kept as a scalar by xr.concat
+            _write_coord(store, key, (), values[0])
+        else:
+            _write_coord(store, key, ("fname",), values)
+
+    dims = ("fname", "neuron", "time")
+    dff = store.createVariable(
+        "dff",
+        encoding.dff_dtype(np.float64),
+        dims,
+        fill_value=np.nan,
+        **encoding.variable_kwargs(dims, (len(headers), len(neurons), len(times))),
+    )
+    epoch_times = _create_epoch_times(
+        store, ("fname", "epoch", "time"), (len(headers), len(epochs), len(times)), encoding
+    )
+    coordinates = " ".join(PER_FOV_COORDS)
+    dff.setncattr("coordinates", coordinates)
+    epoch_times.setncattr("coordinates", coordinates)
+    store.setncatts(_netcdf_attrs(headers[0].attrs))
+
+
+def _write_coord(store: netCDF4.Dataset, name: str, dims: tuple, values):
+    """ Writes a coordinate variable. Strings are stored as variable-length
+    strings, like xarray does. """
+    values = np.asarray(values)
+    if values.dtype.kind in "OUS":
+        var = store.createVariable(name, str, dims)
+        var[...] = values.astype(object)
+    else:
+        var = store.createVariable(name, values.dtype, dims)
+        var[...] = values
+
+
+def _create_epoch_times(
+    store: netCDF4.Dataset, dims: tuple, shape: tuple, encoding: EncodingConfig
+) -> netCDF4.Variable:
+    """ Creates the boolean epoch_times variable, either bit-packed along
+    its last dimension or with a byte per value as xarray stores booleans """
+    if encoding.pack_epoch_times:
+        dim, length = dims[-1], shape[-1]
+        size = store.dimensions[dim]
+        store.createDimension(packed_dim(dim), None if size.isunlimited() else -(-length // 8))
+        dims, shape = dims[:-1] + (packed_dim(dim),), shape[:-1] + (-(-length // 8),)
+        var = store.createVariable(
+            "epoch_times", np.uint8, dims, **encoding.variable_kwargs(dims, shape)
+        )
+        var.setncatts({"packed_dim": dim, "packed_length": length})
+    else:
+        var = store.createVariable(
+            "epoch_times", np.int8, dims, **encoding.variable_kwargs(dims, shape)
+        )
+        var.setncattr("dtype", "bool")
+    return var
+
+
+def _encode_epoch_times(block: np.ndarray, encoding: EncodingConfig) -> np.ndarray:
+    if encoding.pack_epoch_times:
+        return pack_bits(block)
+    return block.astype(np.int8)
+
+
+def _union(indices: Sequence[np.ndarray]) -> pd.Index:
+    """ The outer join of the coordinates, as xarray aligns them """
+    return functools.reduce(lambda a, b: a.union(b), (pd.Index(idx) for idx in indices))
+
+
+def _as_bool(epoch_times: np.ndarray) -> np.ndarray:
+    """ Epoch masks which were padded with NaNs are False where they're NaN """
+    if epoch_times.dtype.kind == "f":
+        return np.nan_to_num(epoch_times, nan=0.0).astype(bool)
+    return epoch_times.astype(bool)
+
+
+def _netcdf_attrs(attrs: dict) -> dict:
+    """ NetCDF attributes can't be booleans or None """
+    return {
+        key: (int(val) if isinstance(val, bool) else val)
+        for key, val in attrs.items()
+        if val is not None
+    }
+
+
+OFFSET_VARS = ("data_offset", "cell_offset", "frame_offset", "num_of_cells", "num_of_frames")
+SOURCE_VARS = ("source", "source_size", "source_mtime", "active")
+
+
+def write_day_ragged(
+    fov_files: Sequence[pathlib.Path],
+    fname: pathlib.Path,
+    encoding: EncodingConfig = DAY_ENCODING,
+) -> pathlib.Path:
+    """
+    Writes the FOV datasets into a NetCDF file in the ragged layout. The
+    dF/F of the i-th FOV is the flat range
+    ``data_offset[i]:data_offset[i] + num_of_cells[i] * num_of_frames[i]``
+    of "dff", its neurons and times are in the ranges starting at
+    cell_offset[i] and frame_offset[i] of "neuron" and "time", and its
+    epoch masks are in the same frame range of "epoch_times". Frame
+    offsets are aligned to whole bytes of the bit-packed masks, so a few
+    unused frames may follow each FOV.
+
+    The file each FOV was read from, its size and modification time are
+    recorded in "source", "source_size" and "source_mtime", so that the
+    store can later be updated with update_day.
+    """
+    headers = read_fov_headers(fov_files)
+    if not headers:
+        raise ValueError(f"None of the FOV files of {fname} exist.")
+    epochs = _union([header.epoch for header in headers])
+
+    with netCDF4.Dataset(str(fname), "w", format="NETCDF4") as store:
+        _create_ragged(store, epochs, headers[0], encoding)
+        for header in headers:
+            _append_fov_block(store, header)
+    return fname
+
+
+def append_fov(fname: pathlib.Path, fov_file: pathlib.Path):
+    """
+    Appends a FOV to a ragged-layout day store, without rewriting the other
+    FOVs in it. If the store already has a block from the same file, that
+    block is marked as inactive and replaced by the new one. Inactive blocks
+    still take space in the file until the day is rewritten.
+    """
+    header = read_fov_header(fov_file)
+    with netCDF4.Dataset(str(fname), "a") as store:
+        _deactivate(store, str(fov_file))
+        _append_fov_block(store, header)
+
+
+def remove_fov(fname: pathlib.Path, fov_file: pathlib.Path):
+    """ Marks the block of the FOV file in the day store as inactive """
+    with netCDF4.Dataset(str(fname), "a") as store:
+        _deactivate(store, str(fov_file))
+
+
+def day_fovs(fname: pathlib.Path) -> pd.DataFrame:
+    """ The FOVs in a ragged-layout day store - a row per block with the
+    file it was read from, the size and modification time that file had,
+    and whether the block is active or was replaced or removed """
+    with xr.open_dataset(str(fname)) as ds:
+        return pd.DataFrame({key: ds[key].values for key in ("fname",) + SOURCE_VARS})
+
+
+def update_day(
+    fov_files: Sequence[pathlib.Path],
+    fname: pathlib.Path,
+    encoding: EncodingConfig = DAY_ENCODING,
+) -> pathlib.Path:
+    """
+    Makes the ragged-layout day store hold exactly the given FOV files.
+    FOVs which are new or whose files changed since they were added are
+    appended, and FOVs which are no longer in the list are removed. The
+    store is written from scratch if it doesn't exist, isn't a ragged store,
+    or if most of it would be taken by inactive blocks.
+    """
+    try:
+        blocks = day_fovs(fname)
+    except (OSError, KeyError):  # missing, or not a ragged store
+        return write_day_ragged(fov_files, fname, encoding)
+    present = blocks[blocks["active"] == 1].set_index("source")
+    wanted = {str(file): file_stamp(file) for file in fov_files}
+    wanted = {file: stamp for file, stamp in wanted.items() if stamp is not None}
+    to_remove = [file for file in present.index if file not in wanted]
+    to_add = [
+        file
+        for file, stamp in wanted.items()
+        if file not in present.index
+        or [present.at[file, "source_size"], present.at[file, "source_mtime"]] != stamp
+    ]
+    num_of_inactive = len(blocks) + len(to_add) - len(wanted)
+    if num_of_inactive > len(wanted):
+        return write_day_ragged(fov_files, fname, encoding)
+    for file in to_remove:
+        remove_fov(fname, pathlib.Path(file))
+    for file in to_add:
+        append_fov(fname, pathlib.Path(file))
+    return fname
+
+
+def _deactivate(store: netCDF4.Dataset, source: str):
+    sources = store["source"][:]
+    active = store["active"][:]
+    for idx in np.flatnonzero((sources == source) & (active == 1)):
+        store["active"][idx] = 0
+
+
+def _aligned(num_of_frames: int) -> int:
+    """ The number of frames rounded up to a whole byte of packed bits """
+    return -(-num_of_frames // 8) * 8
+
+
+def _create_ragged(
+    store: netCDF4.Dataset, epochs: pd.Index, header: FovHeader, encoding: EncodingConfig
+):
+    """ Creates the dimensions and the empty variables of a ragged-layout
+    day store, with the per-FOV coordinates typed as in the given FOV.
+    All dimensions are unlimited so that FOVs can be appended. """
+    for dim in ("fname", "epoch", "cell", "frame", "sample"):
+        store.createDimension(dim, None)
+    for key in ("fname",) + PER_FOV_COORDS:
+        value = np.asarray(header.scalar_coords[key])
+        dtype = str if value.dtype.kind in "OUS" else value.dtype
+        store.createVariable(key, dtype, ("fname",))
+    for key in OFFSET_VARS + SOURCE_VARS[1:3]:
+        store.createVariable(key, np.int64, ("fname",), chunksizes=(512,))
+    store.createVariable("source", str, ("fname",))
+    store.createVariable("active", np.int8, ("fname",), chunksizes=(512,))
+    store.createVariable("epoch", str, ("epoch",))
+    store["epoch"][: len(epochs)] = epochs.values.astype(object)
+    store.createVariable("neuron", np.int64, ("cell",), chunksizes=(4096,))
+    store.createVariable(
+        "time", np.float64, ("frame",), chunksizes=(4096,), fill_value=np.nan
+    )
+    store.createVariable(
+        "dff",
+        encoding.dff_dtype(np.float64),
+        ("sample",),
+        fill_value=np.nan,
+        **encoding.variable_kwargs(("sample",), (0,)),
+    )
+    _create_epoch_times(store, ("epoch", "frame"), (len(epochs), 0), encoding)
+    store.setncatts(_netcdf_attrs(header.attrs))
+    store.setncattr("layout", DayLayout.RAGGED.value)
+
+
+def _append_fov_block(store: netCDF4.Dataset, header: FovHeader):
+    """ Reads the data of a FOV and writes it, with its coordinates, after
+    the last FOV in a ragged store """
+    with open_dataset(header.fname) as ds:
+        dff = ds["dff"].values
+        epoch_times = _as_bool(ds["epoch_times"].values)
+    idx = len(store.dimensions["fname"])
+    data_offset = len(store.dimensions["sample"])
+    cell_offset = len(store.dimensions["cell"])
+    frame_offset = len(store.dimensions["frame"])
+    num_of_cells, num_of_frames = dff.shape
+    epochs = _add_epochs(store, header.epoch)
+
+    store["dff"][data_offset : data_offset + dff.size] = dff.ravel()
+    store["neuron"][cell_offset : cell_offset + num_of_cells] = header.neuron
+    # The masks are written up to the next aligned frame, so that they're
+    # written in whole bytes when they're packed
+    span = _aligned(num_of_frames)
+    time = np.full(span, np.nan)
+    time[:num_of_frames] = header.time
+    store["time"][frame_offset : frame_offset + span] = time
+    block = np.zeros((len(epochs), span), dtype=bool)
+    block[epochs.get_indexer(header.epoch), :num_of_frames] = epoch_times
+    epoch_var = store["epoch_times"]
+    if "packed_dim" in epoch_var.ncattrs():
+        epoch_var[:, frame_offset // 8 : (frame_offset + span) // 8] = pack_bits(block)
+        epoch_var.setncattr("packed_length", len(store.dimensions["frame"]))
+    else:
+        epoch_var[:, frame_offset : frame_offset + span] = block.astype(np.int8)
+    for key in ("fname",) + PER_FOV_COORDS:
+        value = header.scalar_coords[key]
+        store[key][idx] = str(value) if store[key].dtype is str else value
+    values = (data_offset, cell_offset, frame_offset, num_of_cells, num_of_frames)
+    for key, value in zip(OFFSET_VARS, values):
+        store[key][idx] = value
+    store["source"][idx] = str(header.fname)
+    store["source_size"][idx], store["source_mtime"][idx] = file_stamp(header.fname)
+    store["active"][idx] = 1
+
+
+def _add_epochs(store: netCDF4.Dataset, new_epochs: Sequence[str]) -> pd.Index:
+    """ Adds the epochs which aren't in the store yet, with masks which are
+    False for all of the FOVs already in it. Returns all epochs. """
+    epochs = pd.Index(store["epoch"][:])
+    missing = [epoch for epoch in new_epochs if epoch not in epochs]
+    if missing:
+        epoch_var = store["epoch_times"]
+        num_of_columns = epoch_var.shape[1]
+        store["epoch"][len(epochs) : len(epochs) + len(missing)] = np.array(missing, dtype=object)
+        epoch_var[len(epochs) : len(epochs) + len(missing), :num_of_columns] = np.zeros(
+            (len(missing), num_of_columns), dtype=epoch_var.dtype
+        )
+        epochs = pd.Index(store["epoch"][:])
+    return epochs
+
+
+@attr.s(slots=True)
+class RaggedDay:
+    """
+    A ragged-layout day store, loaded into memory. Only the real data
+    of the FOVs is loaded, without any padding, and the per-FOV and
+    per-condition accessors return views into it.
+
+    The "fovs" table has a row per active FOV, indexed by its fname, with
+    its coordinates, offsets and the file it was read from.
+    """
+
+    fname = attr.ib(validator=instance_of(pathlib.Path))
+    dff = attr.ib(init=False, repr=False)
+    epoch_times = attr.ib(init=False, repr=False)
+    neuron = attr.ib(init=False, repr=False)
+    time = attr.ib(init=False, repr=False)
+    epoch = attr.ib(init=False)
+    fovs = attr.ib(init=False, repr=False)
+    attrs = attr.ib(init=False)
+    _intervals = attr.ib(init=False, factory=dict, repr=False)  # fname -> EpochIntervals
+
+    def __attrs_post_init__(self):
+        with open_dataset(self.fname) as ds:
+            keys = ("fname",) + PER_FOV_COORDS + OFFSET_VARS + SOURCE_VARS
+            fovs = {key: ds[key].values for key in keys}
+            self.dff = ds["dff"].values
+            self.epoch_times = ds["epoch_times"].values
+            self.neuron = ds["neuron"].values
+            self.time = ds["time"].values
+            self.epoch = ds.indexes["epoch"]
+            self.attrs = {key: val for key, val in ds.attrs.items() if key != "layout"}
+        fovs = pd.DataFrame(fovs)
+        self.fovs = fovs[fovs["active"] == 1].set_index("fname", drop=False)
+
+    @property
+    def condition(self) -> pd.Series:
+        return self.fovs["condition"]
+
+    def _fov(self, fov: Union[int, str]) -> pd.Series:
+        """ A row of the FOVs table, by position or by fname """
+        if isinstance(fov, str):
+            return self.fovs.loc[fov]
+        return self.fovs.iloc[fov]
+
+    def fov_dff(self, fov: Union[int, str]) -> np.ndarray:
+        """ A view of the (cell x time) dF/F of a FOV """
+        row = self._fov(fov)
+        start, shape = row.data_offset, (row.num_of_cells, row.num_of_frames)
+        return self.dff[start : start + row.num_of_cells * row.num_of_frames].reshape(shape)
+
+    def fov_epoch_times(self, fov: Union[int, str]) -> np.ndarray:
+        """ A view of the (epoch x time) masks of a FOV """
+        row = self._fov(fov)
+        return self.epoch_times[:, row.frame_offset : row.frame_offset + row.num_of_frames]
+
+    def fov_epoch_intervals(self, fov: Union[int, str]) -> EpochIntervals:
+        """ The epochs of a FOV as frame intervals. They're built from the
+        masks once per FOV, and later selections reuse them along with the
+        compound epochs they've already computed. """
+        fname = self._fov(fov)["fname"]
+        try:
+            return self._intervals[fname]
+        except KeyError:
+            intervals = EpochIntervals.from_epoch_times(self.epoch, self.fov_epoch_times(fov))
+            self._intervals[fname] = intervals
+            return intervals
+
+    def fov_neurons(self, fov: Union[int, str]) -> np.ndarray:
+        row = self._fov(fov)
+        return self.neuron[row.cell_offset : row.cell_offset + row.num_of_cells]
+
+    def fov_time(self, fov: Union[int, str]) -> np.ndarray:
+        row = self._fov(fov)
+        return self.time[row.frame_offset : row.frame_offset + row.num_of_frames]
+
+    def fovs_of_condition(self, condition: str) -> List[str]:
+        return self.fovs.index[self.fovs["condition"] == condition].tolist()
+
+    def condition_dff(self, condition: str) -> List[np.ndarray]:
+        """ Views of the (cell x time) dF/F of each of the FOVs of the
+        condition. FOVs differ in their length, so they aren't stacked. """
+        return [self.fov_dff(fov) for fov in self.fovs_of_condition(condition)]
+
+    def cell_labels(self, key: str) -> np.ndarray:
+        """ The value of a per-FOV column, e.g. "mouse_id", for each cell """
+        return np.repeat(self.fovs[key].to_numpy(), self.fovs["num_of_cells"].to_numpy())
+
+    def stacked_dff(
+        self, epoch: Optional[str] = None, condition: Optional[str] = None
+    ) -> np.ndarray:
+        """
+        The (cell x time) dF/F of all cells of the FOVs of the condition
+        during the epoch, or during the entire recording if epoch is None.
+        The frames of the epoch of each FOV are left-aligned and the rows
+        are NaN-padded to the length of the longest FOV of the day.
+        """
+        fovs = self.fovs.index if condition is None else self.fovs_of_condition(condition)
+        if epoch is None:
+            blocks = [self.fov_dff(fov) for fov in fovs]
+        else:
+            blocks = [
+                self.fov_dff(fov)[:, self.fov_epoch_intervals(fov).frames(epoch)]
+                for fov in fovs
+            ]
+        num_of_frames = self.fovs["num_of_frames"].max() if len(self.fovs) else 0
+        stacked_dff = np.full((sum(len(block) for block in blocks), num_of_frames), np.nan)
+        last_full_row = 0
+        for block in blocks:
+            stacked_dff[last_full_row : last_full_row + len(block), : block.shape[1]] = block
+            last_full_row += len(block)
+        return stacked_dff
+
+    def filter(self, epoch: str, condition: Optional[str] = None) -> np.ndarray:
+        """ The stacked dF/F without cells that have no valid value, which
+        is what filter_da returns for cube-layout days """
+        stacked_dff = self.stacked_dff(epoch, condition)
+        return stacked_dff[np.isfinite(stacked_dff).any(axis=1)]
+
+
+def open_day(fname: pathlib.Path) -> Union[RaggedDay, xr.Dataset]:
+    """ Opens a day store - a RaggedDay for the ragged layout and a lazily
+    loaded xr.Dataset for the cube layout. Files without a layout attribute
+    were written by xr.concat, i.e. they're cubes. """
+    data = xr.open_dataset(str(fname))
+    if data.attrs.get("layout", DayLayout.CUBE.value) == DayLayout.RAGGED.value:
+        data.close()
+        return RaggedDay(pathlib.Path(fname))
+    return decode_dataset(data)
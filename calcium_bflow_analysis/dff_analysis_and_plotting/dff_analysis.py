@@ -7,7 +7,6 @@ import pandas as pd
 import xarray as xr
 import seaborn as sns
 from ansimarkup import ansiprint as aprint
-import peakutils
 import matplotlib
 import matplotlib.gridspec as gridspec
 from mpl_toolkits.mplot3d import Axes3D
@@ -16,12 +15,17 @@ from matplotlib.ticker import FormatStrFormatter
 import matplotlib.patches
 import sklearn.metrics
 import skimage.draw
-import tifffile
 import scipy.ndimage
-import scipy.signal
 
 from calcium_bflow_analysis import caiman_funcs_for_comparison
 from calcium_bflow_analysis.colabeled_cells.find_colabeled_cells import TiffChannels
+from calcium_bflow_analysis.dff_analysis_and_plotting.spike_detection import (
+    SpikeEvents,
+    count_peaks_by_threshold,
+    find_peaks_peakutils,
+    find_peaks_scipy,
+)
+from calcium_bflow_analysis.stack_io import deinterleave_stack
 
 # from calcium_bflow_analysis.single_fov_analysis import SingleFovParser
 
@@ -55,38 +59,40 @@ def calc_dff_batch(files):
 
 
 def locate_spikes_peakutils(
-    data, fps=30.03, thresh=0.7, min_dist=None, max_allowed_firing_rate=1
-) -> np.ndarray:
+    data, fps=30.03, thresh=0.7, min_dist=None, max_allowed_firing_rate=1, as_events=False
+):
     """
-    Find spikes from a dF/F matrix using the peakutils package.
+    Find spikes from a dF/F matrix using the peakutils algorithm.
     The fps parameter is used to calculate the minimum allowed distance \
     between consecutive spikes, and to disqualify cells which had no
     evident dF/F peaks, which result in too many false-positives.
+    All cells are searched at once by ``spike_detection.find_peaks_peakutils``.
 
     :param float max_allowed_firing_rate: Maximal number of spikes per second
     that are considered viable.
+    :param bool as_events: Return a SpikeEvents instead of a dense (cell x time)
+    matrix with 1 at the spikes.
     """
     assert len(data.shape) == 2 and data.shape[0] > 0
     if min_dist is None:
         min_dist = int(fps)
     else:
         min_dist = int(min_dist)
-    all_spikes: np.ndarray = np.zeros_like(data)
-    nan_to_zero = np.nan_to_num(data)
     max_spike_num = int(data.shape[1] // fps) * max_allowed_firing_rate
-    for row, cell in enumerate(nan_to_zero):
-        peaks = peakutils.indexes(cell, thres=thresh, min_dist=min_dist)
-        num_of_peaks = len(peaks)
-        if (num_of_peaks > 0) and (num_of_peaks < max_spike_num):
-            all_spikes[row, peaks] = 1
-    return all_spikes
+    spikes = find_peaks_peakutils(data, thresh, min_dist).drop_cells_by_count(max_spike_num)
+    if as_events:
+        return spikes
+    return spikes.to_dense(data.dtype)
 
 
-def locate_spikes_scipy(data, fps=30.03, thresh=2.2, min_dist=None, max_allowed_firing_rate=1):
-    """Find spikes from a dF/F matrix using the find_peaks function.
+def locate_spikes_scipy(
+    data, fps=30.03, thresh=2.2, min_dist=None, max_allowed_firing_rate=1, as_events=False
+):
+    """Find spikes from a dF/F matrix using the find_peaks algorithm.
     The fps parameter is used to calculate the minimum allowed distance
     between consecutive spikes, and to disqualify cells which had no
     evident dF/F peaks, which result in too many false-positives.
+    All cells are searched at once by ``spike_detection.find_peaks_scipy``.
 
     Parameters
     ----------
@@ -103,34 +109,38 @@ def locate_spikes_scipy(data, fps=30.03, thresh=2.2, min_dist=None, max_allowed_
     max_allowed_firing_rate : float, optional
         Maximal number of spikes. Used to filter out cells with "too many
         spikes".
+    as_events : bool, optional
+        Return a SpikeEvents instead of a dense (cell x time) matrix with 1
+        at the spikes.
     """
     assert len(data.shape) == 2 and data.shape[0] > 0
     if min_dist is None:
         min_dist = int(fps)
     else:
         min_dist = int(min_dist)
-    all_spikes: np.ndarray = np.zeros_like(data)
-    nan_to_zero = np.nan_to_num(data)
     max_spike_num = int(data.shape[1] // fps) * max_allowed_firing_rate
-    for row, cell in enumerate(nan_to_zero):
-        peaks, _ = scipy.signal.find_peaks(cell, prominence=thresh, threshold=(0.1, 5), distance=min_dist)
-        num_of_peaks = len(peaks)
-        if (num_of_peaks > 0) and (num_of_peaks < max_spike_num):
-            all_spikes[row, peaks] = 1
-    return all_spikes
+    spikes = find_peaks_scipy(
+        data, prominence=thresh, threshold=(0.1, 5), distance=min_dist
+    ).drop_cells_by_count(max_spike_num)
+    if as_events:
+        return spikes
+    return spikes.to_dense(data.dtype)
 
 
 def calc_mean_spike_num(data, fps=30.03, thresh=0.75):
     """
     Find the spikes in the data (using "locate_spikes_peakutils") and count
     them, to create statistics on their average number.
-    :param data: Raw data, cells x time
+    :param data: Raw data, cells x time, or its already detected SpikeEvents
     :param fps: Framerate
     :param thresh: Peakutils threshold for spikes
     :return: Number of spikes for each neuron
     """
-    all_spikes = locate_spikes_peakutils(data, fps, thresh)
-    mean_of_spikes = np.nanmean(all_spikes, axis=1)
+    if isinstance(data, SpikeEvents):
+        all_spikes = data
+    else:
+        all_spikes = locate_spikes_peakutils(data, fps, thresh, as_events=True)
+    mean_of_spikes = all_spikes.counts() / all_spikes.num_of_frames
     return mean_of_spikes
 
 
@@ -150,7 +160,8 @@ def scatter_spikes(
     Parameters:
         raw_data (np.ndarray): The original fluorescent traces matrix, cell x time.
         spike_data (np.ndarray): The result of the `locate_spikes` function, a matrix
-                                 with 1 wherever a spike was detected, and 0 otherwise.
+                                 with 1 wherever a spike was detected, and 0 otherwise,
+                                 or its SpikeEvents.
         downsample_display (int): Too many cells create clutter and are hard to display.
                                   This is the downsampling factor.
         time_vec (np.ndarray): 1D array with the x-axis values (time). If None, will
@@ -171,10 +182,13 @@ def scatter_spikes(
     y_heights = np.arange(0, num_displayed_cells * y_step, y_step)[:, np.newaxis]
     ax.plot(time_vec, (downsampled_data + y_heights).T, linewidth=0.5)
     if spike_data is not None:
-        peakvals = raw_data * spike_data
+        if not isinstance(spike_data, SpikeEvents):
+            spike_data = SpikeEvents.from_dense(spike_data)
+        frames, cells = spike_data.raster(slice(None, None, downsample_display))
+        time_vec = np.asarray(time_vec)
+        peakvals = raw_data[::downsample_display][cells, frames].astype(np.float64)
         peakvals[peakvals == 0] = np.nan
-        peakvals = peakvals[::downsample_display]
-        ax.plot(time_vec, (peakvals + y_heights).T, "r.", linewidth=0.1)
+        ax.plot(time_vec[frames], peakvals + y_heights[cells, 0], "r.", linewidth=0.1)
     ax.spines["top"].set_visible(False)
     ax.spines["right"].set_visible(False)
     ax.set_xlabel("Time (seconds)")
@@ -195,7 +209,7 @@ def plot_mean_vals(
     matrix containing spike locations, or the rolling mean dF/F value if `data` contains
     the raw dF/F values for all cells.
     Parameters:
-        data (np.ndarray): Data to be rolling-windowed.
+        data (np.ndarray): Data to be rolling-windowed, or SpikeEvents.
         x_axis (np.ndarray): 1D array of time points for display purposes.
         window (int): size of rolling window in number of array cells.
         title (str): Title of the figure.
@@ -207,7 +221,10 @@ def plot_mean_vals(
     """
     if x_axis is None:
         x_axis = np.arange(data.shape[1])
-    mean = pd.DataFrame(data.mean(axis=0))
+    if isinstance(data, SpikeEvents):
+        mean = pd.DataFrame(data.mean_over_cells())
+    else:
+        mean = pd.DataFrame(data.mean(axis=0))
     mean["x"] = x_axis
     mean_val = mean.rolling(window=window).mean()
     ax = mean_val.plot(x="x", ax=ax)
@@ -257,19 +274,13 @@ def calc_mean_dff_no_background(data):
 
 def deinterleave(fname: str, data_channel: int, num_of_channels: int = 2):
     """ Takes a multichannel TIF and writes back to disk the channel with
-    the relevant data. """
-    data_pre_split = tifffile.imread(fname)
-    new_fname = fname[:-4] + f"_CHANNEL_{data_channel}.tif"
-    try:
-        tifffile.imsave(
-            new_fname, data_pre_split[data_channel - 1 :: num_of_channels], bigtiff=True
-        )
-    except PermissionError:
-        raise
-    return new_fname
+    the relevant data. The stack is streamed in chunks of frames, see
+    stack_io.deinterleave_stack. """
+    new_fname, = deinterleave_stack(fname, num_of_channels, channels=[data_channel])
+    return str(new_fname)
 
 
-def generate_spikes_roc_curve(dff: np.ndarray, fps: float):
+def generate_spikes_roc_curve(dff: np.ndarray, fps: float, thresholds=None) -> np.ndarray:
     """
     To better assess the validity of a chosen threshold for spike detection
     in a dF/F trace, a ROC curve will be plotted. However, since we don't
@@ -278,26 +289,31 @@ def generate_spikes_roc_curve(dff: np.ndarray, fps: float):
     will try multiple spike thresholds and plot the resulting spiking rate,
     in hopes of identifying a region in which a change threshold doesn't
     significantly change the resulting spike rate.
+    The peaks of all thresholds are counted in a single pass over the data
+    by ``spike_detection.count_peaks_by_threshold``.
 
     Parameters:
         :param np.ndarray dff: Cells x time
         :param float fps: Frames per second
-    """
-    threshold_boundaries = np.arange(0.4, 0.99, 0.05)
-    spike_nums: np.ndarray = np.zeros_like(threshold_boundaries)
-    for idx, thresh in enumerate(threshold_boundaries):
-        spikes: np.ndarray = locate_spikes_peakutils(
-            dff, fps, thresh=thresh, max_allowed_firing_rate=np.inf
-        )
-        spike_nums[idx] = spikes.sum()
+        :param np.ndarray thresholds: The peakutils thresholds to try, by
+        default from 0.4 to 0.95 in steps of 0.05.
 
-    spike_nums /= dff.shape[0]
-    spike_nums /= dff.shape[1] / fps
+    :return np.ndarray: The curve of each cell - its spikes per second
+    at each threshold, cells x thresholds.
+    """
+    if thresholds is None:
+        thresholds = np.arange(0.4, 0.99, 0.05)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    counts = count_peaks_by_threshold(dff, thresholds, min_dist=int(fps))
+    max_spike_num = int(dff.shape[1] // fps) * np.inf  # as locate_spikes_peakutils
+    counts = np.where(counts < max_spike_num, counts, 0)
+    cell_rates = counts / (dff.shape[1] / fps)
     fig, ax = plt.subplots()
-    ax.plot(threshold_boundaries, spike_nums)
+    ax.plot(thresholds, cell_rates.mean(axis=0))
     ax.set_title("ROC for spike numbers as a function of the threshold")
     ax.set_xlabel("Threshold Value")
     ax.set_ylabel("# spikes / cell / second")
+    return cell_rates
 
 
 if __name__ == "__main__":
@@ -311,7 +327,7 @@ if __name__ == "__main__":
     # number_of_channels = 2
     fps = 30.04
     raw_data = np.load(fmr_results, allow_pickle=True)["F_dff"]
-    spikes = locate_spikes_scipy(raw_data, fps)
+    spikes = locate_spikes_scipy(raw_data, fps, as_events=True)
     time_vec = np.arange(raw_data.shape[1]) / fps
     scatter_spikes(raw_data, spikes, downsample_display=1, time_vec=time_vec)
     plt.show()
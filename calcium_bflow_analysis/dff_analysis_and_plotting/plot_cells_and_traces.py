@@ -14,6 +14,9 @@ import tifffile
 import skimage
 
 from calcium_bflow_analysis.colabeled_cells.find_colabeled_cells import TiffChannels
+from calcium_bflow_analysis.dff_analysis_and_plotting.spike_detection import SpikeEvents
+from calcium_bflow_analysis.projections import project_stack
+from calcium_bflow_analysis.stack_io import StackReader
 
 
 def rank_dff_by_stim(dff: np.ndarray, spikes: np.ndarray, stim: np.ndarray, fps: float):
@@ -23,7 +26,7 @@ def rank_dff_by_stim(dff: np.ndarray, spikes: np.ndarray, stim: np.ndarray, fps:
     Parameters:
     :param dff np.ndarray: Array of (cell x time) containing dF/F values of cells over time.
     :param spikes np.ndarray: Array of (cell x time) containing 1 wherever the cell fired
-    and 0 otherwise. Result of ``locate_spikes_peakutils``.
+    and 0 otherwise, or its SpikeEvents. Result of ``locate_spikes_peakutils``.
     :param stim np.ndarray: A vector with the length of the experiment containing 1 wherever
     the stimulus occurred.
     :param float fps: Frames per second
@@ -33,9 +36,10 @@ def rank_dff_by_stim(dff: np.ndarray, spikes: np.ndarray, stim: np.ndarray, fps:
     ends_of_stim_idx = np.where(stim_edges == 1)[0]
     frame_diffs = np.full((dff.shape[0], len(ends_of_stim_idx)), np.nan)
     dff_diffs = frame_diffs.copy()
-    spike_placeholder = np.zeros_like(spikes)
+    if not isinstance(spikes, SpikeEvents):
+        spikes = SpikeEvents.from_dense(spikes == 1)
     spikes_idx = np.array(
-        np.where(spikes == 1)
+        (spikes.rows(), spikes.frames)
     )  # two rows, 'time' columns. First row is row indices, second row is column index (i.e. time).
     for idx, (stim_start, stim_end) in enumerate(
         zip(ends_of_stim_idx[:-1], ends_of_stim_idx[1:])
@@ -193,9 +197,7 @@ def extract_cells_from_tif(
     res_data = np.load(results_file, allow_pickle=True)
     coords = res_data["crd"][indices][:num]
 
-    with tifffile.TiffFile(tif, movie=True) as f:
-        data = f.asarray()
-        data = data[slice(data_channel.value, None, number_of_channels), ...]
+    data = StackReader(tif, number_of_channels).read(data_channel.value)
 
     masks = extract_mask_from_coords(coords, data.shape[1:], cell_radius)
     cell_data = [data[:, mask[0], mask[1]] for mask in masks]
@@ -345,7 +347,7 @@ def draw_rois_over_cells(tif_fname: Union[pathlib.Path, np.ndarray], cell_radius
             except StopIteration:
                 print("Results file not found. Exiting.")
             return
-        tif = tifffile.imread(str(tif_fname)).mean(0)
+        tif = project_stack(tif_fname).mean
     elif isinstance(tif_fname, np.ndarray):
         tif = tif_fname
 
@@ -0,0 +1,436 @@
+"""
+Spike detection of all cells of a dF/F matrix at once.
+
+locate_spikes_peakutils and locate_spikes_scipy used to call
+``peakutils.indexes`` and ``scipy.signal.find_peaks`` on each cell in a
+Python loop. The kernels here reimplement both detections with numba, each
+cell in its own thread, and return the same peaks, up to the order of
+peaks of equal height (see _select_by_distance). The result is a
+SpikeEvents - the frames and amplitudes of the peaks of all cells, in rows
+like a CSR matrix, instead of a dense (cell x time) matrix which is mostly
+zeros. At less than a spike per second that's orders of magnitude
+smaller, and rates, counts in windows and epochs and raster plots are
+computed from the spikes alone.
+
+Usage:
+    spikes = find_peaks_peakutils(dff, thresh=0.7, min_dist=30)
+    spikes = spikes.drop_cells_by_count(max_spike_num)
+    spikes.frames_of(0)  # the peaks of the first cell
+    spikes.count_in_epochs(epoch_intervals)  # cell x epoch
+    counts = count_peaks_by_threshold(dff, np.linspace(0.4, 0.95, 200), min_dist=30)
+"""
+import attr
+from attr.validators import instance_of
+import numba
+import numpy as np
+
+from calcium_bflow_analysis.epoch_intervals import EpochIntervals
+
+
+@attr.s(slots=True)
+class SpikeEvents:
+    """
+    The spikes of a (cell x time) matrix. The spikes of the i-th cell are
+    at frames[indptr[i]:indptr[i + 1]], in increasing order, and their
+    dF/F values are the same slice of amplitudes.
+
+    Attributes:
+        indptr (np.ndarray): Offsets of the spikes of each cell, num_of_cells + 1 long.
+        frames (np.ndarray): The frame of each spike.
+        amplitudes (np.ndarray): The dF/F at each spike.
+        num_of_frames (int): Length of the recording.
+    """
+
+    indptr = attr.ib(validator=instance_of(np.ndarray))
+    frames = attr.ib(validator=instance_of(np.ndarray))
+    amplitudes = attr.ib(validator=instance_of(np.ndarray))
+    num_of_frames = attr.ib(validator=instance_of(int))
+
+    @classmethod
+    def from_mask(cls, mask: np.ndarray, values: np.ndarray):
+        """ The spikes at the True cells of a (cell x time) mask, with the
+        amplitudes taken from values, NaNs as zeros """
+        rows, frames = np.nonzero(mask)
+        indptr = np.zeros(mask.shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=mask.shape[0]), out=indptr[1:])
+        amplitudes = np.nan_to_num(values[rows, frames])
+        return cls(indptr, frames.astype(np.int64), amplitudes, int(mask.shape[1]))
+
+    @property
+    def num_of_cells(self) -> int:
+        return len(self.indptr) - 1
+
+    @property
+    def shape(self):
+        return self.num_of_cells, self.num_of_frames
+
+    def counts(self) -> np.ndarray:
+        """ The number of spikes of each cell """
+        return np.diff(self.indptr)
+
+    def rows(self) -> np.ndarray:
+        """ The cell of each spike """
+        return np.repeat(np.arange(self.num_of_cells), self.counts())
+
+    def frames_of(self, cell: int) -> np.ndarray:
+        return self.frames[self.indptr[cell] : self.indptr[cell + 1]]
+
+    def drop_cells_by_count(self, max_spike_num: float):
+        """ Removes all spikes of cells with no spikes or with max_spike_num
+        or more, which are considered false positives """
+        counts = self.counts()
+        valid = (counts > 0) & (counts < max_spike_num)
+        keep = np.repeat(valid, counts)
+        indptr = np.zeros_like(self.indptr)
+        np.cumsum(np.where(valid, counts, 0), out=indptr[1:])
+        return SpikeEvents(
+            indptr, self.frames[keep], self.amplitudes[keep], self.num_of_frames
+        )
+
+    def select(self, cells):
+        """ The spikes of some of the cells, given as a slice or indices """
+        cells = np.arange(self.num_of_cells)[cells]
+        counts = self.counts()[cells]
+        indptr = np.zeros(len(cells) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        positions = np.repeat(self.indptr[cells] - indptr[:-1], counts) + np.arange(indptr[-1])
+        return SpikeEvents(
+            indptr, self.frames[positions], self.amplitudes[positions], self.num_of_frames
+        )
+
+    def rates(self, fps: float) -> np.ndarray:
+        """ The spikes per second of each cell """
+        return self.counts() / (self.num_of_frames / fps)
+
+    def mean_over_cells(self) -> np.ndarray:
+        """ The fraction of the cells which spiked in each frame """
+        return np.bincount(self.frames, minlength=self.num_of_frames) / self.num_of_cells
+
+    def count_in_windows(self, starts, stops) -> np.ndarray:
+        """ The number of spikes of each cell in each of the [start, stop)
+        frame windows, as a (cell x window) array. The frames are sorted
+        within each cell, so with the cell as their high part they're sorted
+        as a whole, and each count is the difference of two binary searches. """
+        starts = np.clip(np.asarray(starts, dtype=np.int64), 0, self.num_of_frames)
+        stops = np.clip(np.asarray(stops, dtype=np.int64), starts, self.num_of_frames)
+        keys = self.rows() * self.num_of_frames + self.frames
+        cell_offsets = np.arange(self.num_of_cells)[:, np.newaxis] * self.num_of_frames
+        return np.searchsorted(keys, cell_offsets + stops) - np.searchsorted(
+            keys, cell_offsets + starts
+        )
+
+    def count_in_epochs(self, intervals: EpochIntervals, epochs=None) -> np.ndarray:
+        """ The number of spikes of each cell in each epoch, all epochs of
+        the intervals by default, as a (cell x epoch) array """
+        if epochs is None:
+            epochs = intervals.epochs
+        counts = np.zeros((self.num_of_cells, len(epochs)), dtype=np.int64)
+        for idx, epoch in enumerate(epochs):
+            windows = intervals.intervals_of(epoch)
+            counts[:, idx] = self.count_in_windows(windows[:, 0], windows[:, 1]).sum(axis=1)
+        return counts
+
+    def raster(self, cells=slice(None)):
+        """ The frames and cell positions of the spikes of the given cells,
+        the coordinates of a raster plot in which the i-th of the cells is
+        the i-th row """
+        displayed = self.select(cells)
+        return displayed.frames, displayed.rows()
+
+    def to_dense(self, dtype=np.float64) -> np.ndarray:
+        """ The (cell x time) matrix with 1 at the spikes and 0 elsewhere """
+        dense = np.zeros(self.shape, dtype=dtype)
+        dense[self.rows(), self.frames] = 1
+        return dense
+
+    @classmethod
+    def from_dense(cls, spikes: np.ndarray, values: np.ndarray = None):
+        """ The spikes of a dense (cell x time) matrix, such as
+        locate_spikes_peakutils returns, with the amplitudes taken from
+        values if given """
+        spikes = np.asarray(spikes)
+        mask = np.nan_to_num(spikes) != 0
+        return cls.from_mask(mask, spikes if values is None else np.asarray(values))
+
+
+def find_peaks_peakutils(data: np.ndarray, thresh: float = 0.7, min_dist: int = 1) -> SpikeEvents:
+    """
+    The peaks of each row of data, as ``peakutils.indexes(row, thres=thresh,
+    min_dist=min_dist)`` finds them. NaNs are treated as zeros. Of peaks of
+    equal height closer than min_dist the later one is kept.
+
+    Parameters:
+        data (np.ndarray): (cell x time) dF/F.
+        thresh (float): Normalized threshold between 0 and 1, relative to the
+            range of each row.
+        min_dist (int): Minimal distance between peaks. Lower peaks closer than
+            it to a higher one are dropped.
+    """
+    values = _as_rows(data)
+    mask = np.zeros(values.shape, dtype=np.bool_)
+    _peakutils_kernel(values, float(thresh), int(min_dist), mask)
+    return SpikeEvents.from_mask(mask, values)
+
+
+def count_peaks_by_threshold(
+    data: np.ndarray, thresholds, min_dist: int = 1
+) -> np.ndarray:
+    """
+    The number of peaks find_peaks_peakutils finds in each row of data with
+    each of the thresholds, as a (cell x threshold) array.
+
+    Peaks are only dropped by higher ones, so the peaks at a threshold are
+    the peaks at no threshold which are higher than it. These are found once
+    per cell and sorted by height, and the count at each threshold is a
+    binary search of its level, so many thresholds cost about as much as
+    one.
+    """
+    values = _as_rows(data)
+    thresholds = np.asarray(thresholds, dtype=np.float64).ravel()
+    counts = np.zeros((values.shape[0], len(thresholds)), dtype=np.int64)
+    _peakutils_sweep_kernel(values, thresholds, int(min_dist), counts)
+    return counts
+
+
+def find_peaks_scipy(
+    data: np.ndarray, prominence: float, threshold=(0.1, 5), distance: int = 1
+) -> SpikeEvents:
+    """
+    The peaks of each row of data, as ``scipy.signal.find_peaks(row,
+    prominence=prominence, threshold=threshold, distance=distance)`` finds
+    them. NaNs are treated as zeros. Of peaks of equal height closer than
+    distance the later one is kept.
+
+    Parameters:
+        data (np.ndarray): (cell x time) dF/F.
+        prominence (float): Minimal prominence of a peak.
+        threshold (tuple): Minimal and maximal vertical distance of a peak
+            from its neighbors. Either may be None.
+        distance (int): Minimal distance between peaks. Lower peaks closer than
+            it to a higher one are dropped.
+    """
+    if distance < 1:
+        raise ValueError("`distance` must be greater or equal to 1")
+    low, high = threshold
+    low = -np.inf if low is None else float(low)
+    high = np.inf if high is None else float(high)
+    values = _as_rows(data)
+    mask = np.zeros(values.shape, dtype=np.bool_)
+    _scipy_kernel(values, float(prominence), low, high, int(np.ceil(distance)), mask)
+    return SpikeEvents.from_mask(mask, values)
+
+
+def _as_rows(data: np.ndarray) -> np.ndarray:
+    assert data.ndim == 2 and data.shape[0] > 0
+    return np.asarray(data, dtype=np.float64)
+
+
+@numba.njit(parallel=True)
+def _peakutils_kernel(data, thresh, min_dist, out):
+    for row in numba.prange(data.shape[0]):
+        _peakutils_row(_clean_row(data[row]), thresh, min_dist, out[row])
+
+
+@numba.njit(parallel=True)
+def _peakutils_sweep_kernel(data, thresholds, min_dist, out):
+    for row in numba.prange(data.shape[0]):
+        y = _clean_row(data[row])
+        peaks = _peakutils_candidates(y)
+        if not len(peaks):
+            continue
+        keep = _peakutils_distance(peaks, y[peaks], min_dist)
+        heights = np.sort(y[peaks][keep])
+        levels = thresholds * (y.max() - y.min()) + y.min()
+        out[row] = len(heights) - np.searchsorted(heights, levels, side="right")
+
+
+@numba.njit
+def _peakutils_row(y, thresh, min_dist, out):
+    """ peakutils.indexes of a single row, marking the peaks in out """
+    peaks = _peakutils_candidates(y)
+    if not len(peaks):
+        return
+    level = thresh * (y.max() - y.min()) + y.min()
+    peaks = peaks[y[peaks] > level]
+    keep = _peakutils_distance(peaks, y[peaks], min_dist)
+    for k in range(len(peaks)):
+        if keep[k]:
+            out[peaks[k]] = True
+
+
+@numba.njit
+def _peakutils_distance(peaks, heights, min_dist):
+    """ The peaks which peakutils.indexes keeps, peaks closer than min_dist
+    included, which is a distance of min_dist + 1 in scipy's terms """
+    if min_dist > 1:
+        return _select_by_distance(peaks, heights, min_dist + 1)
+    return np.ones(len(peaks), dtype=np.bool_)
+
+
+@numba.njit
+def _peakutils_candidates(y):
+    """ The peaks peakutils.indexes finds in the row before its threshold
+    and distance are applied """
+    n = y.shape[0]
+    if n < 2:
+        return np.empty(0, dtype=np.int64)
+    dy = np.empty(n - 1)
+    num_of_zeros = 0
+    for i in range(n - 1):
+        dy[i] = y[i + 1] - y[i]
+        num_of_zeros += dy[i] == 0
+    if num_of_zeros == n - 1:  # a flat row has no peaks
+        return np.empty(0, dtype=np.int64)
+    # Plateaus take the slope of their neighbors - the left one at the end
+    # of the row, the right one at its start, and each half of a plateau
+    # inside the row that of its side
+    i = 0
+    while num_of_zeros and i < n - 1:
+        if dy[i] != 0:
+            i += 1
+            continue
+        first = i
+        while i < n - 1 and dy[i] == 0:
+            i += 1
+        last = i - 1
+        median = (first + last) / 2
+        for j in range(first, last + 1):
+            if first == 0:
+                dy[j] = dy[last + 1]
+            elif last == n - 2:
+                dy[j] = dy[first - 1]
+            elif j < median:
+                dy[j] = dy[first - 1]
+            else:
+                dy[j] = dy[last + 1]
+    peaks = np.empty(n, dtype=np.int64)
+    num_of_peaks = 0
+    for i in range(1, n - 1):  # without branches, which noise mispredicts
+        peaks[num_of_peaks] = i
+        num_of_peaks += (dy[i] < 0) & (dy[i - 1] > 0)
+    return peaks[:num_of_peaks]
+
+
+@numba.njit(parallel=True)
+def _scipy_kernel(data, prominence, low, high, distance, out):
+    for row in numba.prange(data.shape[0]):
+        _scipy_row(_clean_row(data[row]), prominence, low, high, distance, out[row])
+
+
+@numba.njit
+def _scipy_row(x, prominence, low, high, distance, out):
+    """ scipy.signal.find_peaks of a single row, marking the peaks in out """
+    n = x.shape[0]
+    peaks = np.empty(n, dtype=np.int64)
+    num_of_peaks = 0
+    # Local maxima, at the middle of flat peaks
+    for i in range(1, n - 1):
+        if x[i + 1] == x[i]:
+            if x[i - 1] < x[i]:
+                ahead = i + 1
+                while ahead < n - 1 and x[ahead] == x[i]:
+                    ahead += 1
+                if x[ahead] < x[i]:
+                    peaks[num_of_peaks] = (i + ahead - 1) // 2
+                    num_of_peaks += 1
+        else:
+            peaks[num_of_peaks] = i
+            num_of_peaks += (x[i - 1] < x[i]) & (x[i + 1] < x[i])
+    # Vertical distance to the neighbors
+    kept = 0
+    for k in range(num_of_peaks):
+        peak = peaks[k]
+        left = x[peak] - x[peak - 1]
+        right = x[peak] - x[peak + 1]
+        peaks[kept] = peak
+        kept += (low <= min(left, right)) & (max(left, right) <= high)
+    num_of_peaks = kept
+    peaks = peaks[:num_of_peaks]
+    keep = _select_by_distance(peaks, x[peaks], distance)
+    for k in range(num_of_peaks):
+        if keep[k] and _is_prominent(x, peaks[k], prominence):
+            out[peaks[k]] = True
+
+
+@numba.njit
+def _is_prominent(x, peak, prominence):
+    """
+    Whether the peak's prominence, its height above the higher of the
+    lowest points on each side before a higher point or the end of the row,
+    is at least the given one. It is if each side has a point low enough,
+    so each side is only scanned until it reaches one.
+    """
+    height = x[peak]
+    i = peak
+    while i >= 0 and x[i] <= height and prominence > height - x[i]:
+        i -= 1
+    if i < 0 or x[i] > height:
+        return False
+    i = peak
+    while i < x.shape[0] and x[i] <= height and prominence > height - x[i]:
+        i += 1
+    return i < x.shape[0] and x[i] <= height
+
+
+@numba.njit
+def _select_by_distance(peaks, heights, distance):
+    """
+    Which of the sorted peaks remain when, from the highest down, each
+    remaining peak removes the others closer than distance to it. Of equal
+    peaks the later one counts as higher, so ties are always broken the
+    same way. peakutils and scipy visit equal peaks in the order np.argsort
+    happens to give them, which depends on numpy's sort implementation and
+    on the number of peaks, and matches this rule only for a few peaks.
+    With equal peaks closer than distance, e.g. on quantized data, the
+    peaks kept may therefore differ from theirs.
+
+    Instead of sorting the peaks, a peak remains if none of the higher peaks
+    close to it remains, and those are resolved first, depth first, so each
+    peak only scans its neighborhood once.
+    """
+    num_of_peaks = peaks.shape[0]
+    state = np.zeros(num_of_peaks, dtype=np.int8)  # 0 unknown, 1 remains, 2 removed
+    first_neighbor = np.empty(num_of_peaks, dtype=np.int64)
+    neighbor = 0
+    for k in range(num_of_peaks):
+        while peaks[k] - peaks[neighbor] >= distance:
+            neighbor += 1
+        first_neighbor[k] = neighbor
+    cursor = first_neighbor.copy()
+    stack = np.empty(num_of_peaks, dtype=np.int64)
+    for k in range(num_of_peaks):
+        if state[k]:
+            continue
+        top = 0
+        stack[0] = k
+        while top >= 0:
+            peak = stack[top]
+            other = cursor[peak]
+            while other < num_of_peaks and peaks[other] - peaks[peak] < distance:
+                if state[other] != 2 and (
+                    heights[other] > heights[peak]
+                    or (heights[other] == heights[peak] and other > peak)
+                ):
+                    break
+                other += 1
+            cursor[peak] = other
+            if other < num_of_peaks and peaks[other] - peaks[peak] < distance:
+                if state[other] == 1:
+                    state[peak] = 2
+                    top -= 1
+                else:  # resolve the higher neighbor first
+                    top += 1
+                    stack[top] = other
+            else:
+                state[peak] = 1
+                top -= 1
+    return state == 1
+
+
+@numba.njit
+def _clean_row(row):
+    """ A copy of the row with zeros instead of NaNs """
+    y = np.empty(row.shape[0])
+    for i in range(row.shape[0]):
+        y[i] = 0.0 if np.isnan(row[i]) else row[i]
+    return y
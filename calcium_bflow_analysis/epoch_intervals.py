@@ -0,0 +1,268 @@
+"""
+A compact representation of the epochs of a FOV.
+
+The epochs of the analog analysis are compounds of a few base signals -
+the movement of the mouse (run, stand), the air puffs (stim, juxta, spont)
+and, in occluder experiments, the occluder phases (before_occ, during_occ,
+after_occ). Instead of a dense epoch x time mask, each base signal is kept
+as a list of [start, stop) frame intervals, and a compound epoch such as
+"stand_spont_during_occ" is the intersection of the intervals of its parts,
+computed when it's first asked for. The dense mask is only created by
+:meth:`EpochIntervals.mask` and :meth:`EpochIntervals.to_dense`, the latter
+by comparing a per-frame code, with a bit for each base signal, to the
+bits of each epoch.
+
+Usage:
+    intervals = EpochIntervals.from_masks({"run": run, "stand": stand, ...})
+    intervals.frames("stand_spont")  # frame indices
+    intervals.contains("run_stim", frames)  # membership of frames
+    intervals.to_dense()  # the epoch x time mask of the FOV dataset
+"""
+from itertools import product
+from typing import Dict, List, Sequence, Tuple
+
+import attr
+from attr.validators import instance_of
+import numpy as np
+
+
+MOVEMENT = ("run", "stand")
+PUFF = ("stim", "juxta", "spont")
+OCCLUDER = ("before_occ", "during_occ", "after_occ")
+BASE_SIGNALS = MOVEMENT + PUFF + OCCLUDER
+ALL_EPOCHS = "all"
+
+
+def base_groups(occluder: bool) -> Tuple[Tuple[str, ...], ...]:
+    """ The groups of base signals whose product makes up the epochs """
+    if occluder:
+        return MOVEMENT, PUFF, OCCLUDER
+    return MOVEMENT, PUFF
+
+
+def compound_epochs(groups: Sequence[Sequence[str]]) -> List[str]:
+    """
+    The names of all compound epochs, in the order of the "epoch" coordinate
+    of the FOV datasets - the product of the groups, each also allowing none
+    of its signals, with the epoch containing none of them last as "all".
+    """
+    names = [
+        "_".join(filter(None, epoch))
+        for epoch in product(*(tuple(group) + (None,) for group in groups))
+    ]
+    names[-1] = ALL_EPOCHS
+    return names
+
+
+def mask_to_intervals(mask: np.ndarray) -> np.ndarray:
+    """ The [start, stop) intervals of the True runs of the mask, as an
+    (n, 2) array """
+    mask = np.asarray(mask, dtype=bool)
+    edges = np.diff(np.concatenate(([False], mask, [False])).view(np.int8))
+    return np.column_stack((np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+
+
+def paint_intervals(starts, stops, length: int) -> np.ndarray:
+    """
+    A boolean vector of the given length which is True inside any of the
+    [start, stop) windows, which may overlap or extend past its end. All
+    windows are painted in a single pass, as the running sum of +1 at their
+    starts and -1 at their stops.
+    """
+    starts = np.clip(np.asarray(starts, dtype=np.int64), 0, length)
+    stops = np.clip(np.asarray(stops, dtype=np.int64), starts, length)
+    edges = np.bincount(starts, minlength=length + 1) - np.bincount(
+        stops, minlength=length + 1
+    )
+    return np.cumsum(edges[:-1]) > 0
+
+
+def has_neighbor(events, others, distance) -> np.ndarray:
+    """ Whether each of the events has one of the others closer than the
+    given distance, by a binary search of the sorted others """
+    events = np.asarray(events)
+    others = np.sort(np.asarray(others))
+    if not len(others) or not len(events):
+        return np.zeros(len(events), dtype=bool)
+    pos = np.searchsorted(others, events)
+    before = others[np.clip(pos - 1, 0, len(others) - 1)]
+    after = others[np.clip(pos, 0, len(others) - 1)]
+    closest = np.minimum(np.abs(events - before), np.abs(after - events))
+    return closest < distance
+
+
+def intersect_intervals(*intervals: np.ndarray) -> np.ndarray:
+    """
+    The intersection of sets of sorted, non-overlapping intervals. Each
+    boundary adds or removes one from a coverage count, and the frames
+    covered by all of the sets are the stretches in which the count equals
+    their number.
+    """
+    if len(intervals) == 1:
+        return intervals[0]
+    bounds = np.concatenate([interval.ravel() for interval in intervals])
+    steps = np.tile(np.array([1, -1], dtype=np.int64), len(bounds) // 2)
+    order = np.lexsort((steps, bounds))  # stops before starts at the same frame
+    coverage = np.cumsum(steps[order])
+    covered = np.flatnonzero(coverage == len(intervals))
+    starts, stops = bounds[order][covered], bounds[order][covered + 1]
+    nonempty = stops > starts
+    return np.column_stack((starts[nonempty], stops[nonempty]))
+
+
+@attr.s(slots=True)
+class EpochIntervals:
+    """
+    The frame intervals of the base signals of a FOV. intervals maps each
+    base signal to an (n, 2) array of [start, stop) frames, and groups are
+    the sets of base signals whose product gives the compound epochs.
+    Compound epochs are computed on demand and cached.
+    """
+
+    num_of_frames = attr.ib(validator=instance_of(int))
+    intervals = attr.ib(validator=instance_of(dict))
+    groups = attr.ib(validator=instance_of(tuple))
+    _compounds = attr.ib(init=False, factory=dict, repr=False)
+    _code = attr.ib(init=False, default=None, repr=False)
+
+    @classmethod
+    def from_masks(cls, masks: Dict[str, np.ndarray], groups=None):
+        """ Builds the intervals from the vectors of the base signals, either
+        boolean or, like those of the analog analysis, 1 in the epoch and NaN
+        outside of it. By default the groups are the movement and puff
+        signals, and the occluder phases if they're given. """
+        masks = {
+            name: np.isfinite(mask) if mask.dtype.kind == "f" else mask.astype(bool)
+            for name, mask in ((name, np.asarray(mask)) for name, mask in masks.items())
+        }
+        if groups is None:
+            groups = base_groups(OCCLUDER[0] in masks)
+        num_of_frames = len(next(iter(masks.values())))
+        intervals = {name: mask_to_intervals(mask) for name, mask in masks.items()}
+        return cls(num_of_frames, intervals, tuple(tuple(group) for group in groups))
+
+    @classmethod
+    def from_epoch_times(cls, epochs: Sequence[str], epoch_times: np.ndarray):
+        """ Builds the intervals from the dense epoch x time mask of a FOV
+        dataset, whose single-signal epochs are the base signals """
+        epochs = list(epochs)
+        epoch_times = np.asarray(epoch_times)
+        if epoch_times.dtype.kind == "f":  # masks of cubes which were NaN-padded
+            epoch_times = np.nan_to_num(epoch_times, nan=0.0).astype(bool)
+        groups = [
+            tuple(name for name in group if name in epochs)
+            for group in base_groups(OCCLUDER[0] in epochs)
+        ]
+        groups = tuple(group for group in groups if group)
+        masks = {name: epoch_times[epochs.index(name)] for group in groups for name in group}
+        if not masks:
+            raise ValueError(f"None of the epochs {epochs} is a base signal.")
+        return cls.from_masks(masks, groups)
+
+    @classmethod
+    def from_code(cls, code: np.ndarray, signals: Sequence[str] = BASE_SIGNALS):
+        """ Builds the intervals from a per-frame code whose i-th bit is
+        set in the frames of the i-th of the signals """
+        code = np.asarray(code)
+        masks = {name: (code >> bit) & 1 for bit, name in enumerate(signals)}
+        return cls.from_masks(masks)
+
+    @property
+    def epochs(self) -> List[str]:
+        return compound_epochs(self.groups)
+
+    def components(self, epoch: str) -> Tuple[str, ...]:
+        """ The base signals that make up the epoch's name """
+        if epoch == ALL_EPOCHS:
+            return ()
+        parts = []
+        remaining = epoch
+        names = sorted(self.intervals, key=len, reverse=True)
+        while remaining:
+            for name in names:
+                if remaining == name or remaining.startswith(name + "_"):
+                    parts.append(name)
+                    remaining = remaining[len(name) + 1 :]
+                    break
+            else:
+                raise KeyError(f"Unknown epoch {epoch}.")
+        return tuple(parts)
+
+    def intervals_of(self, epoch: str) -> np.ndarray:
+        """ The [start, stop) intervals of a base or compound epoch """
+        if epoch in self.intervals:
+            return self.intervals[epoch]
+        try:
+            return self._compounds[epoch]
+        except KeyError:
+            pass
+        parts = self.components(epoch)
+        if parts:
+            intervals = intersect_intervals(*(self.intervals[part] for part in parts))
+        else:
+            intervals = np.array([[0, self.num_of_frames]], dtype=np.int64)
+        self._compounds[epoch] = intervals
+        return intervals
+
+    def frames(self, epoch: str) -> np.ndarray:
+        """ The indices of the frames of the epoch """
+        intervals = self.intervals_of(epoch)
+        lengths = intervals[:, 1] - intervals[:, 0]
+        if not len(lengths):
+            return np.empty(0, dtype=np.int64)
+        offsets = np.repeat(intervals[:, 0] - np.cumsum(lengths) + lengths, lengths)
+        return np.arange(lengths.sum()) + offsets
+
+    def contains(self, epoch: str, frames) -> np.ndarray:
+        """ Whether each of the given frames is in the epoch, by a binary
+        search of the epoch's interval starts """
+        intervals = self.intervals_of(epoch)
+        frames = np.asarray(frames)
+        idx = np.searchsorted(intervals[:, 0], frames, side="right") - 1
+        inside = idx >= 0
+        inside[inside] = frames[inside] < intervals[idx[inside], 1]
+        return inside
+
+    def num_of_epoch_frames(self, epoch: str) -> int:
+        intervals = self.intervals_of(epoch)
+        return int((intervals[:, 1] - intervals[:, 0]).sum())
+
+    def mask(self, epoch: str) -> np.ndarray:
+        """ The dense boolean mask of the epoch """
+        intervals = self.intervals_of(epoch)
+        return paint_intervals(intervals[:, 0], intervals[:, 1], self.num_of_frames)
+
+    def bits(self, epoch: str) -> int:
+        """ The bits of the per-frame code which are set in the frames of
+        the epoch - one for each of its base signals """
+        names = list(self.intervals)
+        return sum(1 << names.index(part) for part in self.components(epoch))
+
+    def code(self) -> np.ndarray:
+        """ A small integer per frame, whose i-th bit is set if the frame
+        is in the i-th base signal """
+        if self._code is not None:
+            return self._code
+        dtype = np.min_scalar_type(max(1, (1 << len(self.intervals)) - 1))
+        code = np.zeros(self.num_of_frames, dtype=dtype)
+        for bit, intervals in enumerate(self.intervals.values()):
+            covered = paint_intervals(intervals[:, 0], intervals[:, 1], self.num_of_frames)
+            code |= covered.astype(dtype) << dtype.type(bit)
+        self._code = code
+        return code
+
+    def to_dense(self, epochs=None) -> np.ndarray:
+        """ The dense epoch x time mask, of all compound epochs by default.
+        The mask of each epoch is a single comparison of the per-frame code
+        with the epoch's bits, written directly into its row so that no
+        epoch x time temporary wider than the code is allocated. """
+        if epochs is None:
+            epochs = self.epochs
+        code = self.code()
+        dense = np.empty((len(epochs), self.num_of_frames), dtype=bool)
+        masked = np.empty_like(code)
+        for row, epoch in zip(dense, epochs):
+            required = code.dtype.type(self.bits(epoch))
+            np.bitwise_and(code, required, out=masked)
+            np.equal(masked, required, out=row)
+        return dense
@@ -1,11 +1,10 @@
 import attr
 from attr.validators import instance_of
 import pathlib
-import tifffile
 import numpy as np
 import re
-from datetime import datetime
-import os
+
+from calcium_bflow_analysis.metadata_index import get_stack_metadata
 
 
 @attr.s(slots=True)
@@ -34,21 +33,17 @@ class FluoMetadata:
         self.condition = str(self._get_meta_using_regex(self.cond_reg)).upper()
 
     def _get_si_meta(self):
-        """ Parse the metadata from the SI-generated file """
-        try:
-            with tifffile.TiffFile(str(self.fname)) as f:
-                si_meta = f.scanimage_metadata
-                self.fps = self._round_fps(float(si_meta['FrameData']['SI.hRoiManager.scanFrameRate']))
-                save_chans = si_meta['FrameData']['SI.hChannels.channelSave']
-                if type(save_chans) is int:
-                    self.num_of_channels = 1
-                else:
-                    self.num_of_channels = len(save_chans)
-                self.start_time = str(datetime.fromtimestamp(os.path.getmtime(str(self.fname))))
-                length = len(f.pages)//self.num_of_channels
-                self.timestamps = np.arange(length)/self.fps
-        except (TypeError, KeyError):
+        """ Parse the metadata from the SI-generated file, using the
+        metadata index of its folder """
+        si_meta = get_stack_metadata(self.fname)
+        if not si_meta.is_scanimage:
             self.timestamps = None
+            return
+        self.fps = self._round_fps(si_meta.fps)
+        self.num_of_channels = si_meta.num_of_channels
+        self.start_time = si_meta.start_time
+        length = si_meta.num_of_pages // self.num_of_channels
+        self.timestamps = np.arange(length) / self.fps
 
     def _get_meta_using_regex(self, reg: str):
         """ Parse the given regex from the filename """
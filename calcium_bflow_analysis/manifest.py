@@ -0,0 +1,164 @@
+"""
+A persistent manifest of the analysis of an experiment, used to rerun
+only the parts of it whose inputs changed.
+
+The manifest is a JSON file in the results folder. For each FOV it
+records the size and modification time of its input files (TIF, CaImAn
+results, analog and colabeled files), the parameters it was analyzed with
+and the .nc file it was written to. For each experimental day it records
+the FOV files which were concatenated into it. A FOV is then reanalyzed
+only if one of its inputs or parameters changed, and a day file is
+rebuilt only if the FOVs that make it up changed.
+
+Usage:
+    manifest = AnalysisManifest(results_folder)
+    if not manifest.fov_is_current(inputs, params):
+        ...  # analyze the FOV
+        manifest.record_fov(inputs, params, output)
+        manifest.save()
+"""
+import json
+import os
+import pathlib
+import warnings
+from typing import Dict, List, Optional, Sequence
+
+import attr
+from attr.validators import instance_of
+
+
+MANIFEST_FNAME = ".analysis_manifest.json"
+
+
+def file_stamp(fname) -> Optional[List[int]]:
+    """ The size and modification time (ns) of the file, or None if it
+    doesn't exist """
+    if fname is None:
+        return None
+    try:
+        stat = os.stat(str(fname))
+    except (OSError, TypeError, ValueError):
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+@attr.s(slots=True)
+class AnalysisManifest:
+    """
+    The manifest of the analysis whose results are in the given folder.
+    Input files are identified by their size and modification time rather
+    than by a hash of their contents, since hashing the raw stacks would
+    cost as much as analyzing them.
+    """
+
+    results_folder = attr.ib(validator=instance_of(pathlib.Path))
+    fovs = attr.ib(init=False, repr=False)
+    days = attr.ib(init=False, repr=False)
+
+    def __attrs_post_init__(self):
+        try:
+            with open(self.fname, "r") as f:
+                content = json.load(f)
+        except (OSError, ValueError):  # missing or partially-written manifest
+            content = {}
+        self.fovs = content.get("fovs", {})
+        self.days = content.get("days", {})
+
+    @property
+    def fname(self) -> pathlib.Path:
+        return self.results_folder / MANIFEST_FNAME
+
+    def has_fov(self, tif: pathlib.Path) -> bool:
+        return str(tif) in self.fovs
+
+    def fov_is_current(self, inputs: Dict[str, Optional[pathlib.Path]], params: Dict) -> bool:
+        """ Whether the FOV, whose files are given in inputs under the
+        "tif" key and others, was already analyzed with the same inputs
+        and parameters, and its output wasn't changed since """
+        entry = self.fovs.get(str(inputs["tif"]))
+        if entry is None or entry.get("failed"):
+            return False
+        return (
+            entry["inputs"] == _stamps(inputs)
+            and entry["params"] == _jsonable(params)
+            and file_stamp(entry["output"]) == entry["output_stamp"]
+        )
+
+    def fov_output(self, tif: pathlib.Path) -> Optional[str]:
+        entry = self.fovs.get(str(tif))
+        return None if entry is None else entry["output"]
+
+    def fov_failed(self, tif: pathlib.Path) -> bool:
+        entry = self.fovs.get(str(tif))
+        return entry is not None and entry.get("failed", False)
+
+    def invalidate_fov(self, tif: pathlib.Path):
+        """ Marks the FOV's last analysis as failed. Its output is stale, so
+        it isn't current and isn't concatenated, but the FOV is kept in the
+        manifest so that the next run tries to analyze it again. """
+        entry = self.fovs.get(str(tif))
+        if entry is not None:
+            entry["failed"] = True
+
+    def record_fov(
+        self,
+        inputs: Dict[str, Optional[pathlib.Path]],
+        params: Dict,
+        output: pathlib.Path,
+        **info,
+    ):
+        """ Records the analysis of a FOV. info holds values which
+        describe it but aren't used for change detection, e.g. its fps. """
+        self.fovs[str(inputs["tif"])] = {
+            "inputs": _stamps(inputs),
+            "params": _jsonable(params),
+            "output": str(output),
+            "output_stamp": file_stamp(output),
+            "info": _jsonable(info),
+        }
+
+    def day_is_current(self, day, fov_files: Sequence[pathlib.Path], output: pathlib.Path) -> bool:
+        """
+        Whether the day file was built from exactly these FOV files, none of
+        which changed since. Day files which were written before the manifest
+        existed can't be checked, so as before they're kept as they are.
+        """
+        output_stamp = file_stamp(output)
+        if output_stamp is None:
+            return False
+        entry = self.days.get(str(day))
+        if entry is None:
+            return True
+        return (
+            entry["output"] == str(output)
+            and entry["output_stamp"] == output_stamp
+            and entry["fovs"] == {str(file): file_stamp(file) for file in fov_files}
+        )
+
+    def record_day(self, day, fov_files: Sequence[pathlib.Path], output: pathlib.Path):
+        self.days[str(day)] = {
+            "output": str(output),
+            "output_stamp": file_stamp(output),
+            "fovs": {str(file): file_stamp(file) for file in fov_files},
+        }
+
+    def save(self):
+        """ Writes the manifest to a temporary file which then replaces it,
+        so that an interrupted run never leaves a partial manifest """
+        tmp_fname = self.fname.with_name(self.fname.name + ".tmp")
+        try:
+            with open(tmp_fname, "w") as f:
+                json.dump({"fovs": self.fovs, "days": self.days}, f, indent=1)
+            os.replace(str(tmp_fname), str(self.fname))
+        except OSError:
+            warnings.warn(f"Couldn't write the analysis manifest in {self.results_folder}.")
+
+
+def _stamps(inputs: Dict[str, Optional[pathlib.Path]]) -> Dict[str, Optional[List[int]]]:
+    return {key: file_stamp(fname) for key, fname in inputs.items()}
+
+
+def _jsonable(params: Dict) -> Dict:
+    """ The parameters as they're read back from the JSON file, so that
+    they can be compared with recorded ones """
+    return json.loads(json.dumps(params, default=str))
@@ -1,13 +1,14 @@
 import pathlib
-from typing import List
+from typing import List, Optional
 
 import attr
 from attr.validators import instance_of
-import tifffile
-import h5py
 import numpy as np
 import pandas as pd
 from calcium_bflow_analysis.roipoly import roipoly
+from calcium_bflow_analysis.projections import project_stack
+from calcium_bflow_analysis.read_ahead import file_nbytes, read_ahead
+from calcium_bflow_analysis.stack_io import StackReader
 import matplotlib.pyplot as plt
 
 from dff_calc.df_f_calculation import DffCalculator
@@ -29,6 +30,7 @@ class ManualRoiDrawing:
     colors = attr.ib(default=[f'C{idx}' for idx in range(10)])
     scale = attr.ib(default=1., validator=instance_of(float))
     data = attr.ib(init=False)
+    offset = attr.ib(init=False)
     rois = attr.ib(init=False)
     agg_data = attr.ib(init=False)
     raw_traces = attr.ib(init=False)
@@ -45,15 +47,18 @@ class ManualRoiDrawing:
         return self.dff
 
     def _load_data(self):
-        """ Load different data formats into self.data """
+        """ Load different data formats into self.data, and their mean
+        image into self.agg_data """
         print(f"Loading {self.fname}...")
-        if self.fname.endswith('.tif'):
-            self.data = tifffile.imread(self.fname)
-        elif self.fname.endswith('.h5') or self.fname.endswith('.hdf5'):
-            with h5py.File(self.fname) as f:
-                self.data = np.array(f['/Full Stack/Channel 1'])
-        else:
+        if not (self.fname.endswith('.tif') or self.fname.endswith('.h5') or self.fname.endswith('.hdf5')):
             raise UserWarning(f'File type of {self.fname} not supported.')
+        self.data = StackReader(self.fname, dataset=self.dataset).read()
+        self.agg_data = project_stack(self.fname, dataset=self.dataset, data=self.data).mean
+
+    @property
+    def dataset(self):
+        """ Name of the movie in HDF5 files """
+        return '/Full Stack/Channel 1'
 
     def _offset_data(self):
         """ Subtract the offset from the raw data """
@@ -64,7 +69,9 @@ class ManualRoiDrawing:
         if (dt is np.float32) or (dt is np.float16):
             self.data = self.data.astype(np.float64)
 
-        self.data -= self.data.min()
+        self.offset = self.data.min()
+        self.data = self.data - self.offset
+        self.agg_data = self.agg_data - self.offset
 
     def _draw_rois(self):
         """
@@ -72,7 +79,6 @@ class ManualRoiDrawing:
         :return:
         """
         self.rois = []
-        self.agg_data = self.data.mean(axis=0)
         for idx in range(self.num_rois):
             fig_rois, ax_rois = plt.subplots()
             ax_rois.imshow(self.agg_data, cmap='gray')
@@ -140,20 +146,35 @@ class ParseFijiRoiCsv:
     """
     fname = attr.ib(validator=instance_of(pathlib.Path))
     movie = attr.ib(init=False)
+    cn = attr.ib(init=False)
     results_fname = attr.ib(init=False)
     channel_fname = attr.ib(init=False)
 
     def run(self):
         """ Main pipeline function """
+        if self.load():
+            self.process()
+
+    def load(self) -> bool:
+        """ Opens the movie and reads its time projection. Returns False if
+        the results file already exists, i.e. there's nothing to do. """
         print(f"Parsing {self.fname}...")
         self.results_fname, self.channel_fname = self._generate_results_fname()
         if not self.results_fname:  # The file already exists
-            return
+            return False
+        # A view of memory-mapped stacks, so that apart from the projection
+        # only the bounding boxes of the ROIs are read from disk
+        self.movie = StackReader(self.channel_fname).read()
+        self.cn = self._generate_cn()
+        return True
+
+    def process(self):
+        """ Extracts the traces of the ROIs from the loaded movie
+        and writes the results to disk """
         params = self._generate_params_dict()
-        cn = self._generate_cn()
         crd = self._generate_crd()
         dff = self._extract_dff_from_masks(crd, params['fr'])
-        self._write_results(params, cn, crd, dff)
+        self._write_results(params, self.cn, crd, dff)
 
     def _generate_results_fname(self):
         """
@@ -179,9 +200,8 @@ class ParseFijiRoiCsv:
 
     def _generate_cn(self):
         """ Generates a time projection of the data to store in the
-        "Cn" variable """
-        self.movie = tifffile.imread(str(self.channel_fname))
-        return self.movie.mean(0)
+        "Cn" variable, from the movie which was already read """
+        return project_stack(self.channel_fname, data=self.movie).mean
 
     def _generate_crd(self):
         """
@@ -237,9 +257,21 @@ class ParseFijiRoiCsv:
 
 
 def parse_rois(foldername: pathlib.Path, glob='*rois.csv'):
-    """ Parses all rois.csv files in a folder into results.npz files """
-    for file in foldername.glob(glob):
-        ParseFijiRoiCsv(file).run()
+    """ Parses all rois.csv files in a folder into results.npz files. The
+    movies of the next files are read in the background while the current
+    one is processed. """
+    files = list(foldername.glob(glob))
+    movie_nbytes = lambda file: file_nbytes(str(file).replace("_rois.csv", ".tif"))
+    for _, parser in read_ahead(files, _load_rois, nbytes=movie_nbytes):
+        if parser is not None:
+            parser.process()
+
+
+def _load_rois(file: pathlib.Path) -> Optional[ParseFijiRoiCsv]:
+    """ Loads the data needed to parse the file, or returns None if
+    it was already parsed """
+    parser = ParseFijiRoiCsv(file)
+    return parser if parser.load() else None
 
 
 if __name__ == '__main__':
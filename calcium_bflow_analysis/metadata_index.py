@@ -0,0 +1,156 @@
+"""
+A persistent index of the acquisition metadata of the recorded stacks.
+
+Opening a multi-GB TIF just to learn its framerate and number of frames
+is expensive, and it used to happen on every run of every analysis. The
+index is a small JSON-lines sidecar file which is written into each folder
+containing stacks. Each line holds the metadata of a single stack, keyed
+by its name, size and modification time, so that a stack which was
+changed or replaced is parsed again on its next use.
+
+Usage:
+    meta = get_stack_metadata(pathlib.Path("fov1_00001.tif"))
+    meta.fps, meta.num_of_channels, meta.num_of_frames
+"""
+import json
+import os
+import pathlib
+import warnings
+from datetime import datetime
+from typing import Dict
+
+import attr
+from attr.validators import instance_of
+import tifffile
+
+from calcium_bflow_analysis.stack_io import probe_tif
+
+
+INDEX_FNAME = ".stack_metadata.jsonl"
+
+
+@attr.s(slots=True, frozen=True)
+class StackMetadata:
+    """ The acquisition parameters of a single stack, as they're kept
+    in the index. Stacks which weren't generated by ScanImage have
+    is_scanimage set to False and no fps. """
+
+    name = attr.ib(validator=instance_of(str))
+    size = attr.ib(validator=instance_of(int))
+    mtime = attr.ib(validator=instance_of(int))  # ns
+    is_scanimage = attr.ib(default=False, validator=instance_of(bool))
+    fps = attr.ib(default=None)
+    num_of_channels = attr.ib(default=1, validator=instance_of(int))
+    num_of_pages = attr.ib(default=0, validator=instance_of(int))
+    lines_per_frame = attr.ib(default=0, validator=instance_of(int))
+    start_time = attr.ib(default=None)
+
+    @property
+    def num_of_frames(self) -> int:
+        return self.num_of_pages // self.num_of_channels
+
+    def matches(self, stat: os.stat_result) -> bool:
+        """ Whether this entry still describes the file with the given stat """
+        return self.size == stat.st_size and self.mtime == stat.st_mtime_ns
+
+
+@attr.s(slots=True)
+class StackMetadataIndex:
+    """
+    The metadata index of a single folder. Entries are read lazily
+    from the sidecar file in that folder, and new entries are appended
+    to it whenever a stack is parsed for the first time. If the folder
+    is read-only the index still works, but only in memory.
+    """
+
+    folder = attr.ib(validator=instance_of(pathlib.Path))
+    entries = attr.ib(init=False, repr=False)
+
+    def __attrs_post_init__(self):
+        self.entries = self._read_entries()
+
+    @property
+    def index_fname(self) -> pathlib.Path:
+        return self.folder / INDEX_FNAME
+
+    def get(self, fname: pathlib.Path) -> StackMetadata:
+        """ Returns the metadata of the given stack, parsing it only
+        if it isn't in the index yet, or if it was changed since """
+        stat = os.stat(str(fname))
+        entry = self.entries.get(fname.name)
+        if entry is not None and entry.matches(stat):
+            return entry
+        entry = _parse_stack_metadata(fname, stat)
+        self.entries[fname.name] = entry
+        self._append_entry(entry)
+        return entry
+
+    def _read_entries(self) -> Dict[str, StackMetadata]:
+        """ Parse the sidecar file. Later lines override earlier
+        ones, so that updated files are simply appended to the index. """
+        entries = {}
+        try:
+            with open(self.index_fname, "r") as f:
+                for line in f:
+                    try:
+                        entry = StackMetadata(**json.loads(line))
+                    except (ValueError, TypeError):  # partially-written line
+                        continue
+                    entries[entry.name] = entry
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def _append_entry(self, entry: StackMetadata):
+        try:
+            with open(self.index_fname, "a") as f:
+                f.write(json.dumps(attr.asdict(entry)) + "\n")
+        except OSError:
+            warnings.warn(f"Couldn't write the metadata index in {self.folder}.")
+
+
+_indices: Dict[pathlib.Path, StackMetadataIndex] = {}
+
+
+def get_stack_metadata(fname: pathlib.Path) -> StackMetadata:
+    """ Main entry point of this module - returns the metadata of the given
+    stack using the index of its folder. The indices are kept in memory
+    for the lifetime of the process. """
+    fname = pathlib.Path(fname)
+    folder = fname.parent
+    try:
+        index = _indices[folder]
+    except KeyError:
+        index = _indices[folder] = StackMetadataIndex(folder)
+    return index.get(fname)
+
+
+def _parse_stack_metadata(fname: pathlib.Path, stat: os.stat_result) -> StackMetadata:
+    """ Reads the metadata of the stack from the file itself. The number of
+    pages and lines come from probe_tif, which only reads the headers. """
+    with tifffile.TiffFile(str(fname)) as f:
+        shape = probe_tif(f, num_of_channels=1)  # every page as a frame
+        si_meta = f.scanimage_metadata
+    entry = dict(
+        name=fname.name,
+        size=stat.st_size,
+        mtime=stat.st_mtime_ns,
+        num_of_pages=shape.frames,
+        lines_per_frame=shape.lines,
+    )
+    try:
+        frame_data = si_meta["FrameData"]
+        fps = float(frame_data["SI.hRoiManager.scanFrameRate"])
+        save_chans = frame_data["SI.hChannels.channelSave"]
+        lines_per_frame = int(frame_data["SI.hRoiManager.linesPerFrame"])
+    except (TypeError, KeyError):  # not a ScanImage file
+        return StackMetadata(**entry)
+
+    entry.update(
+        is_scanimage=True,
+        fps=fps,
+        num_of_channels=1 if type(save_chans) is int else len(save_chans),
+        lines_per_frame=lines_per_frame,
+        start_time=str(datetime.fromtimestamp(stat.st_mtime)),
+    )
+    return StackMetadata(**entry)
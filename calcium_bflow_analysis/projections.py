@@ -0,0 +1,277 @@
+"""
+Time projections (mean, max, min, std, sum and percentile images) of
+the imaging stacks.
+
+All projections of a channel are computed together in a single chunked
+pass over the stack, so a projection never holds more than a chunk of
+frames in memory. The results are cached in a small sidecar file next to
+the stack, keyed by the name, size and modification time of the stack and
+by every argument which selects the projected frames - the channel, the
+number of channels, the HDF5 dataset and the frame range - so that the
+next figure or analysis of the same FOV loads them instantly instead of
+re-reading the full recording. Callers which read the frames anyway pass
+them as data, and they're projected and cached without a second pass
+over the file.
+
+Usage:
+    proj = project_stack(pathlib.Path("fov1_00001.tif"), channel=1)
+    plt.imshow(proj.mean)
+    data = StackReader(fname).read()
+    proj = project_stack(fname, data=data)
+"""
+import os
+import pathlib
+import warnings
+from collections import namedtuple
+from typing import Callable, Optional, Sequence, Union
+
+import attr
+from attr.validators import instance_of
+import numpy as np
+
+from calcium_bflow_analysis.stack_io import StackReader
+
+
+@attr.s(slots=True, frozen=True)
+class StackProjections:
+    """ The projection images of a single channel of a stack over a range
+    of frames. The percentile images are approximated using a subset of
+    at most PERCENTILE_FRAMES frames spread evenly along the range. """
+
+    num_of_frames = attr.ib(validator=instance_of(int))
+    mean = attr.ib(validator=instance_of(np.ndarray))
+    max = attr.ib(validator=instance_of(np.ndarray))
+    min = attr.ib(validator=instance_of(np.ndarray))
+    std = attr.ib(validator=instance_of(np.ndarray))
+    percentiles = attr.ib(factory=dict, validator=instance_of(dict))
+
+    @property
+    def sum(self) -> np.ndarray:
+        return self.mean * self.num_of_frames
+
+    def percentile(self, q: float) -> np.ndarray:
+        return self.percentiles[float(q)]
+
+
+PERCENTILE_FRAMES = 500
+
+FrameSelection = namedtuple(
+    "FrameSelection", ("channel", "num_of_channels", "dataset", "start", "stop", "step")
+)
+
+
+def project_stack(
+    fname: Union[pathlib.Path, str],
+    channel: int = 0,
+    num_of_channels: Optional[int] = None,
+    frames: slice = slice(None),
+    percentiles: Sequence[float] = (),
+    dataset: str = "mov",
+    max_memory: int = 512 * 2 ** 20,
+    use_cache: bool = True,
+    data: Optional[np.ndarray] = None,
+) -> StackProjections:
+    """
+    Main entry point of this module - returns the projections of a
+    channel of the stack, either from the cache or by computing them.
+
+    Parameters:
+        fname (pathlib.Path): A TIF or an HDF5 file.
+        channel (int): Zero-based channel to project.
+        num_of_channels (int or None): Number of channels in the stack. If
+            None it's read from the file's metadata.
+        frames (slice): Frames of the channel to project over.
+        percentiles (list of floats): Percentiles (0 - 100) to compute.
+        dataset (str): Name of the dataset holding the movie in HDF5 files.
+        max_memory (int): Memory ceiling for the stack data, in bytes.
+        use_cache (bool): Whether to read and write the cached projections.
+        data (np.ndarray or None): The selected frames of the channel, if
+            the caller already read them, e.g. with StackReader.read. They're
+            projected instead of reading the file a second time.
+    """
+    fname = pathlib.Path(fname)
+    reader = StackReader(fname, num_of_channels, dataset)
+    frame_range = range(*frames.indices(reader.shape.frames))
+    if data is not None and len(data) != len(frame_range):
+        raise ValueError(
+            f"Got {len(data)} frames of {fname} instead of the {len(frame_range)} selected."
+        )
+    percentiles = tuple(float(q) for q in percentiles)
+    selection = FrameSelection(
+        channel,
+        reader.num_of_channels,
+        dataset if reader.is_hdf5 else "",
+        frame_range.start,
+        frame_range.stop,
+        frame_range.step,
+    )
+    cache_fname = _cache_fname(fname, selection)
+    stat = os.stat(str(fname))
+    if use_cache:
+        proj = _read_cache(cache_fname, stat, selection, percentiles)
+        if proj is not None:
+            return proj
+    if data is None:
+        read = lambda position, chunk_range: reader.read(
+            channel, slice(chunk_range.start, chunk_range.stop, chunk_range.step)
+        )
+    else:
+        read = lambda position, chunk_range: data[position : position + len(chunk_range)]
+    proj = _compute_projections(reader, read, frame_range, percentiles, max_memory)
+    if use_cache:
+        _write_cache(cache_fname, stat, selection, proj)
+    return proj
+
+
+def _compute_projections(
+    reader: StackReader,
+    read: Callable[[int, range], np.ndarray],
+    frame_range: range,
+    percentiles: Sequence[float],
+    max_memory: int,
+) -> StackProjections:
+    """
+    Projects the frames in a single pass over chunks of them, each read
+    by read(its position in frame_range, its frames). The
+    standard deviation is merged chunk by chunk (Chan et al.), which is
+    numerically stable even for very long recordings.
+    """
+    if len(frame_range) == 0:
+        raise ValueError(f"No frames to project in {reader.fname}.")
+    frame_shape = (reader.shape.lines, reader.shape.columns)
+    frame_bytes = reader.shape.lines * reader.shape.columns * 8
+    # The float64 copy of a chunk dominates its memory usage
+    frames_per_chunk = max(1, max_memory // (frame_bytes * 3))
+    sampled = frame_range[:: max(1, -(-len(frame_range) // PERCENTILE_FRAMES))]
+    sample = []
+
+    count = 0
+    mean = np.zeros(frame_shape)
+    m2 = np.zeros(frame_shape)
+    max_img = np.full(frame_shape, -np.inf)
+    min_img = np.full(frame_shape, np.inf)
+    for start in range(0, len(frame_range), frames_per_chunk):
+        chunk_range = frame_range[start : start + frames_per_chunk]
+        chunk = np.asarray(read(start, chunk_range), dtype=np.float64)
+        chunk_count = chunk.shape[0]
+        chunk_mean = chunk.mean(0)
+        chunk_m2 = ((chunk - chunk_mean) ** 2).sum(0)
+        delta = chunk_mean - mean
+        total = count + chunk_count
+        mean += delta * (chunk_count / total)
+        m2 += chunk_m2 + delta ** 2 * (count * chunk_count / total)
+        count = total
+        np.maximum(max_img, chunk.max(0), out=max_img)
+        np.minimum(min_img, chunk.min(0), out=min_img)
+        if percentiles:
+            in_sample = np.isin(chunk_range, sampled)
+            sample.append(chunk[in_sample].astype(reader.shape.dtype))
+
+    if percentiles:
+        sample = np.concatenate(sample)
+        percentile_imgs = {
+            q: img for q, img in zip(percentiles, np.percentile(sample, percentiles, axis=0))
+        }
+    else:
+        percentile_imgs = {}
+    return StackProjections(
+        num_of_frames=count,
+        mean=mean,
+        max=max_img.astype(reader.shape.dtype),
+        min=min_img.astype(reader.shape.dtype),
+        std=np.sqrt(m2 / count),
+        percentiles=percentile_imgs,
+    )
+
+
+def _cache_fname(fname: pathlib.Path, selection: FrameSelection) -> pathlib.Path:
+    """ The cache is a hidden file next to the stack, one per selection of
+    frames. The selection is also stored in the file and checked on load,
+    since the dataset name is only part of the file name in a sanitized
+    form. """
+    key = (
+        f"ch{selection.channel}of{selection.num_of_channels}"
+        f"_{selection.start}_{selection.stop}_{selection.step}"
+    )
+    if selection.dataset:
+        key = "".join(c if c.isalnum() else "-" for c in selection.dataset) + "_" + key
+    return fname.with_name(f".{fname.name}.proj_{key}.npz")
+
+
+def _read_cache(
+    cache_fname: pathlib.Path,
+    stat: os.stat_result,
+    selection: FrameSelection,
+    percentiles: Sequence[float],
+) -> Optional[StackProjections]:
+    """ Returns the cached projections if they're still valid for the stack,
+    were projected over the same selection of frames and contain all of the
+    requested percentiles """
+    try:
+        with np.load(str(cache_fname)) as f:
+            if f["size"] != stat.st_size or f["mtime"] != stat.st_mtime_ns:
+                return None
+            if str(f["dataset"]) != selection.dataset or not np.array_equal(
+                f["selection"], _numeric_selection(selection)
+            ):
+                return None
+            cached_percentiles = dict(zip(f["percentiles"], f["percentile_imgs"]))
+            if any(q not in cached_percentiles for q in percentiles):
+                return None
+            return StackProjections(
+                num_of_frames=int(f["num_of_frames"]),
+                mean=f["mean"],
+                max=f["max"],
+                min=f["min"],
+                std=f["std"],
+                percentiles={float(q): img for q, img in cached_percentiles.items()},
+            )
+    except (OSError, KeyError, ValueError):  # missing or corrupt cache file
+        return None
+
+
+def _write_cache(
+    cache_fname: pathlib.Path,
+    stat: os.stat_result,
+    selection: FrameSelection,
+    proj: StackProjections,
+):
+    """ Writes the projections to a temporary file which then replaces the
+    cache, so that a concurrent reader never sees a partial file """
+    percentiles = np.array(list(proj.percentiles.keys()), dtype=np.float64)
+    percentile_imgs = np.array(list(proj.percentiles.values())).reshape(
+        (len(percentiles),) + proj.mean.shape
+    )
+    tmp_fname = cache_fname.with_name(cache_fname.name + ".tmp")
+    try:
+        with open(str(tmp_fname), "wb") as f:
+            np.savez(
+                f,
+                size=stat.st_size,
+                mtime=stat.st_mtime_ns,
+                dataset=selection.dataset,
+                selection=_numeric_selection(selection),
+                num_of_frames=proj.num_of_frames,
+                mean=proj.mean,
+                max=proj.max,
+                min=proj.min,
+                std=proj.std,
+                percentiles=percentiles,
+                percentile_imgs=percentile_imgs,
+            )
+        os.replace(str(tmp_fname), str(cache_fname))
+    except OSError:
+        warnings.warn(f"Couldn't write the projections cache of {cache_fname.parent}.")
+
+
+def _numeric_selection(selection: FrameSelection) -> np.ndarray:
+    return np.array(
+        [
+            selection.channel,
+            selection.num_of_channels,
+            selection.start,
+            selection.stop,
+            selection.step,
+        ],
+        dtype=np.int64,
+    )
@@ -0,0 +1,96 @@
+"""
+Read-ahead of the inputs of batch analyses.
+
+Batch entry points go over many FOVs, and for each of them read a stack
+(or its projections, or its metadata) and then analyze it, leaving the
+CPU idle while the file is read from the NAS and the disk idle while the
+data is analyzed. :func:`read_ahead` loads the next items in a pool of
+threads while the current one is being processed by the caller. Reading
+and decoding TIFs (tifffile, zlib, numpy) release the GIL, so the threads
+overlap I/O and decompression with the analysis in the main thread.
+
+The number of bytes loaded ahead is bounded, so that prefetching large
+stacks never takes more than a fixed amount of memory.
+
+Usage:
+    for fname, data in read_ahead(fnames, tifffile.imread):
+        analyze(data)
+"""
+import collections
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, Tuple
+
+
+def file_nbytes(item) -> int:
+    """ The default estimate of the memory that loading an item takes - the
+    size of the file, or the total size of a tuple of files. Items which
+    aren't existing files are estimated as zero bytes. """
+    if isinstance(item, (tuple, list)):
+        return sum(file_nbytes(sub_item) for sub_item in item)
+    try:
+        return pathlib.Path(item).stat().st_size
+    except (TypeError, OSError):
+        return 0
+
+
+def warm_file(fname: pathlib.Path, block_size: int = 16 * 2 ** 20) -> pathlib.Path:
+    """ Reads the file through the OS page cache and discards the data, so
+    that the next read of it is served from memory instead of the NAS.
+    Useful as a loader for functions which only accept a filename. """
+    try:
+        with open(str(fname), "rb") as f:
+            while f.read(block_size):
+                pass
+    except OSError:  # the consumer will raise a meaningful error
+        pass
+    return fname
+
+
+def read_ahead(
+    items: Iterable,
+    loader: Callable[[Any], Any],
+    max_workers: int = 4,
+    max_in_flight: int = 2 * 2 ** 30,
+    nbytes: Callable[[Any], int] = file_nbytes,
+) -> Iterator[Tuple[Any, Any]]:
+    """
+    Yields (item, loader(item)) for each of the items, in their order,
+    while the next items are loaded in a pool of threads.
+
+    Parameters:
+        items (iterable): The items to load, usually filenames.
+        loader (callable): Loads a single item.
+        max_workers (int): Number of loading threads.
+        max_in_flight (int): Maximal number of bytes, as estimated by
+            nbytes, of items which were submitted for loading but weren't
+            consumed yet. A single item is always loaded, even if it's larger.
+        nbytes (callable): Estimates the memory that loading an item takes.
+
+    An exception raised by the loader is raised when its item is reached.
+    """
+    items = iter(items)
+    in_flight = collections.deque()
+    in_flight_bytes = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            next_item = next(items, StopIteration)
+            while True:
+                while next_item is not StopIteration and len(in_flight) <= max_workers:
+                    item_bytes = nbytes(next_item)
+                    if in_flight and in_flight_bytes + item_bytes > max_in_flight:
+                        break
+                    future = executor.submit(loader, next_item)
+                    in_flight.append((next_item, item_bytes, future))
+                    in_flight_bytes += item_bytes
+                    next_item = next(items, StopIteration)
+                if not in_flight:
+                    return
+                item, item_bytes, future = in_flight.popleft()
+                result = future.result()
+                yield item, result
+                del result
+                in_flight_bytes -= item_bytes
+        finally:  # an error was raised or the consumer stopped early
+            for _, _, future in in_flight:
+                future.cancel()
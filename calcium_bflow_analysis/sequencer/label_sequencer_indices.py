@@ -7,9 +7,10 @@ from typing import Tuple
 
 import numpy as np
 import pandas as pd
-import xarray as xr
 import matplotlib.pyplot as plt
 
+from calcium_bflow_analysis.day_store import RaggedDay, open_day
+
 
 def read_xr_and_concat(fname: pathlib.Path):
     """Reads the given filename and concatenates it into a single file.
@@ -17,8 +18,10 @@ def read_xr_and_concat(fname: pathlib.Path):
     Assumes that the filename is an xarray file which was made by parsing
     many calcium analysis results.
     """
-    data = xr.open_dataset(fname).dff
-    return np.vstack(data)
+    data = open_day(fname)
+    if isinstance(data, RaggedDay):
+        return data.stacked_dff()
+    return np.vstack(data.dff)
 
 
 def find_non_nan_rows(data: np.ndarray):
@@ -31,7 +34,9 @@ def make_filename_labels(fname: pathlib.Path):
     """Finds the filename for each of the dF/F traces and returns a vector
     with the full length of dF/F cells which labels which cell originated
     from which file."""
-    data = xr.open_dataset(fname)
+    data = open_day(fname)
+    if isinstance(data, RaggedDay):
+        return data.cell_labels("fname")
     return np.repeat(data.fname, len(data.neuron)).values
 
 
@@ -39,7 +44,9 @@ def make_mouse_id_labels(fname: pathlib.Path):
     """Finds the mouse ID for each of the dF/F traces and returns a vector
     with the full length of dF/F cells which labels which cell originated
     from which mouse."""
-    data = xr.open_dataset(fname)
+    data = open_day(fname)
+    if isinstance(data, RaggedDay):
+        return data.cell_labels("mouse_id")
     return np.repeat(data.mouse_id, len(data.neuron)).values
 
 
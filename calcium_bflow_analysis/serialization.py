@@ -0,0 +1,176 @@
+"""
+Encoding of the NetCDF files written by the analysis - the per-FOV
+datasets, the per-day stores and the vascular occluder results.
+
+All writers take an EncodingConfig, which sets the compression, the
+chunking and the data types the variables are stored with. Chunks are
+shaped for reading whole traces of a few cells at a time, which is how
+the data is read downstream. Boolean epoch masks can be stored bit-packed
+along their time axis, which takes an eighth of the space of a byte per
+frame. Such variables carry a "packed_dim" attribute, and are unpacked by
+:func:`open_dataset` and :func:`decode_dataset`.
+
+Each call site has a default configuration below, and accepts another one:
+    parser.add_metadata_and_serialize(encoding=EncodingConfig(float32=True))
+"""
+import pathlib
+from typing import Dict, Sequence, Tuple, Union
+
+import attr
+from attr.validators import instance_of, optional, in_
+import numpy as np
+import xarray as xr
+
+
+CELL_DIMS = ("neuron", "cell")
+TIME_DIMS = ("time", "frame", "sample")
+PACKED_SUFFIX = "_packed"
+
+
+@attr.s(frozen=True, slots=True)
+class EncodingConfig:
+    """
+    How variables are stored on disk.
+
+    Parameters:
+        compression (str or None): "zlib", or None for uncompressed data.
+            "zstd" and "blosc_lz4" require netCDF4 >= 1.6 with the HDF5 filter
+            plugins installed.
+        complevel (int): Compression level, 1 - 9.
+        shuffle (bool): Whether to apply the HDF5 shuffle filter, which
+            makes floating point data much more compressible.
+        float32 (bool): Store dF/F as float32 instead of float64.
+        pack_epoch_times (bool): Store boolean epoch masks as bits.
+        chunk_cells (int): Number of cells in a chunk.
+        chunk_frames (int): Number of frames in a chunk.
+    """
+
+    compression = attr.ib(
+        default="zlib", validator=optional(in_(("zlib", "zstd", "blosc_lz4")))
+    )
+    complevel = attr.ib(default=4, validator=instance_of(int))
+    shuffle = attr.ib(default=True, validator=instance_of(bool))
+    float32 = attr.ib(default=False, validator=instance_of(bool))
+    pack_epoch_times = attr.ib(default=True, validator=instance_of(bool))
+    chunk_cells = attr.ib(default=32, validator=instance_of(int))
+    chunk_frames = attr.ib(default=4096, validator=instance_of(int))
+
+    def chunks(self, dims: Sequence[str], shape: Sequence[int]) -> Tuple[int, ...]:
+        """ The chunk shape of a variable. Cells and frames are chunked as
+        configured, flattened (cell x frame) samples get the size of a whole
+        chunk, other dimensions such as epochs are kept whole and the
+        outermost dimension of cubes, fname, is one FOV per chunk. """
+        chunks = []
+        for dim, size in zip(dims, shape):
+            if dim in CELL_DIMS:
+                chunk = self.chunk_cells
+            elif dim == "sample":
+                chunk = self.chunk_cells * self.chunk_frames
+            elif dim in TIME_DIMS:
+                chunk = self.chunk_frames
+            elif dim.endswith(PACKED_SUFFIX):
+                chunk = -(-self.chunk_frames // 8)
+            elif dim == "fname":
+                chunk = 1
+            else:
+                chunk = size
+            chunks.append(max(1, min(chunk, size) if size else chunk))
+        return tuple(chunks)
+
+    def filters(self) -> Dict:
+        """ The compression keywords of netCDF4's createVariable and of
+        xarray's encoding """
+        if self.compression is None:
+            return {}
+        if self.compression == "zlib":
+            return {"zlib": True, "complevel": self.complevel, "shuffle": self.shuffle}
+        return {
+            "compression": self.compression,
+            "complevel": self.complevel,
+            "shuffle": self.shuffle,
+        }
+
+    def variable_kwargs(self, dims: Sequence[str], shape: Sequence[int]) -> Dict:
+        """ Keywords of netCDF4's createVariable for a variable """
+        return dict(chunksizes=self.chunks(dims, shape), **self.filters())
+
+    def dff_dtype(self, dtype: np.dtype) -> np.dtype:
+        if self.float32 and np.dtype(dtype).kind == "f":
+            return np.dtype(np.float32)
+        return np.dtype(dtype)
+
+
+FOV_ENCODING = EncodingConfig()
+DAY_ENCODING = EncodingConfig(chunk_cells=64, chunk_frames=4096)
+VASC_OCC_ENCODING = EncodingConfig(pack_epoch_times=False)
+
+
+def pack_bits(mask: np.ndarray) -> np.ndarray:
+    """ Packs a boolean array into bytes along its last axis """
+    return np.packbits(np.asarray(mask, dtype=bool), axis=-1)
+
+
+def unpack_bits(packed: np.ndarray, length: int) -> np.ndarray:
+    """ The inverse of pack_bits, for a last axis of the given length """
+    return np.unpackbits(packed, axis=-1, count=length).astype(bool)
+
+
+def packed_dim(dim: str) -> str:
+    return dim + PACKED_SUFFIX
+
+
+def encode_dataset(ds: xr.Dataset, config: EncodingConfig) -> Tuple[xr.Dataset, Dict]:
+    """
+    Returns the dataset to write and its encoding. Boolean variables are
+    bit-packed along their last dimension if the configuration says so,
+    and all data variables are chunked and compressed.
+    """
+    variables = {}
+    for name, var in ds.data_vars.items():
+        if config.pack_epoch_times and var.dtype == bool and var.ndim > 0:
+            dim = var.dims[-1]
+            attrs = dict(var.attrs, packed_dim=dim, packed_length=var.shape[-1])
+            variables[name] = xr.Variable(
+                var.dims[:-1] + (packed_dim(dim),), pack_bits(var.values), attrs
+            )
+    if variables:
+        ds = ds.assign(variables)
+    encoding = {}
+    for name, var in ds.data_vars.items():
+        encoding[name] = config.filters()
+        if var.ndim > 0:
+            encoding[name]["chunksizes"] = config.chunks(var.dims, var.shape)
+        if var.dtype.kind == "f":
+            encoding[name]["dtype"] = config.dff_dtype(var.dtype)
+    return ds, encoding
+
+
+def decode_dataset(ds: xr.Dataset) -> xr.Dataset:
+    """ Unpacks the bit-packed variables of the dataset in place, which
+    loads them. The dataset keeps its file open for its other variables. """
+    for name in list(ds.data_vars):
+        var = ds[name].variable
+        if "packed_dim" not in var.attrs:
+            continue
+        attrs = dict(var.attrs)
+        dim, length = attrs.pop("packed_dim"), int(attrs.pop("packed_length"))
+        ds[name] = xr.Variable(var.dims[:-1] + (dim,), unpack_bits(var.values, length), attrs)
+    return ds
+
+
+def to_netcdf(
+    data: Union[xr.Dataset, xr.DataArray], fname: Union[pathlib.Path, str], config: EncodingConfig
+):
+    """ Writes the dataset, or a DataArray, with the given encoding """
+    if isinstance(data, xr.DataArray):
+        # As DataArray.to_netcdf does, so that xr.open_dataarray reads it back
+        name = data.name if data.name is not None else "__xarray_dataarray_variable__"
+        data = data.to_dataset(name=name)
+    data, encoding = encode_dataset(data, config)
+    data.to_netcdf(str(fname), mode="w", encoding=encoding)
+
+
+def open_dataset(fname: Union[pathlib.Path, str]) -> xr.Dataset:
+    """ Opens a dataset written by to_netcdf, with its packed variables
+    unpacked. Files written without packing are opened as they are. """
+    return decode_dataset(xr.open_dataset(str(fname)))
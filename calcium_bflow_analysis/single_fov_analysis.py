@@ -13,6 +13,7 @@ import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib import gridspec
 
+from calcium_bflow_analysis.analog_cache import read_analog
 from calcium_bflow_analysis.analog_trace import (
     analog_trace_runner,
     AnalogAcquisitionType,
@@ -20,6 +21,8 @@ from calcium_bflow_analysis.analog_trace import (
 from calcium_bflow_analysis.fluo_metadata import FluoMetadata
 import calcium_bflow_analysis.dff_analysis_and_plotting.dff_analysis as dff_tools
 from calcium_bflow_analysis.dff_dataset import dff_dataset_init
+from calcium_bflow_analysis.day_store import RaggedDay
+from calcium_bflow_analysis.serialization import EncodingConfig, FOV_ENCODING, to_netcdf
 
 
 @attr.s(slots=True)
@@ -46,11 +49,8 @@ class SingleFovParser:
         This calls to the external `analog_trace_runner` function to do
         the heavy lifting.
         """
-        analog_data = pd.read_csv(
+        analog_data = read_analog(
             self.analog_fname,
-            header=None,
-            names=["stimulus", "run"],
-            index_col=False,
             # sep="\",  # old data format is \t
         ).iloc[:self.fluo_trace.shape[1]]
 
@@ -116,27 +116,25 @@ class SingleFovParser:
             viz = SingleFovViz(self)
             viz.draw()
 
-    def add_metadata_and_serialize(self):
+    def add_metadata_and_serialize(
+        self, overwrite=False, encoding: EncodingConfig = FOV_ENCODING
+    ):
         """
-        Write a full DataArray to disk after parsing the FOV, if it doesn't exist yet.
+        Write a full DataArray to disk after parsing the FOV, if it doesn't exist yet
+        or if overwrite is True. The encoding sets the compression and chunking of
+        the file, see ``serialization.EncodingConfig``.
         The new coordinates order is (epoch, neuron, time, mouse_id, fov, condition).
         """
-        try:
-            _ = next(
-                pathlib.Path(self.metadata.fname).parent.glob(
-                    str(self.metadata.fname.name)[:-4] + ".nc"
-                )
-            )
-        except StopIteration:  # the file doesn't exist, we'll make a new one
+        fname = pathlib.Path(self.metadata.fname)
+        exists = any(fname.parent.glob(str(fname.name)[:-4] + ".nc"))
+        if overwrite or not exists:
             try:
                 raw_data = self.fluo_analyzed.dff
             except AttributeError:
                 print("No fluorescent data in this FOV.")
                 return
             print("Writing new NetCDF to disk.")
-            self.fluo_analyzed.to_netcdf(
-                str(self.metadata.fname)[:-4] + ".nc", mode="w"
-            )
+            to_netcdf(self.fluo_analyzed, str(fname)[:-4] + ".nc", encoding)
 
 
 @attr.s
@@ -247,7 +245,7 @@ class SingleFovViz:
     def _scat_spikes(self, ax):
         """ Plots all dF/F traces and spikes on a given axes """
         spikes = dff_tools.locate_spikes_scipy(
-            self.fov.fluo_trace, self.fov.metadata.fps
+            self.fov.fluo_trace, self.fov.metadata.fps, as_events=True
         )
         time_vec = np.arange(self.fov.fluo_trace.shape[1]) / self.fov.metadata.fps
         dff_tools.scatter_spikes(
@@ -286,8 +284,9 @@ class SingleFovViz:
             columns=self.epochs_to_display,
         )
         df_spikes = df_auc.copy()
+        selector = EpochSelector(self.fov.fluo_analyzed)
         for epoch in self.epochs_to_display:
-            cur_data = filter_da(self.fov.fluo_analyzed, epoch=epoch)
+            cur_data = filter_da(selector, epoch=epoch)
             if cur_data.shape[0] == 0:
                 continue
             auc = dff_tools.calc_auc(cur_data)
@@ -306,49 +305,120 @@ class SingleFovViz:
 
 
 def filter_da(
-        data: xr.Dataset, epoch: str, condition: Optional[str] = None
+        data: Union[xr.Dataset, RaggedDay, "EpochSelector"],
+        epoch: str,
+        condition: Optional[str] = None,
 ) -> np.ndarray:
     """ Filter a Dataset by the given condition and epoch.
-         Returns a numpy array in the shape of cells x time """
-    epoch_data = data.sel(epoch=epoch)
-    if condition:
-        temp = epoch_data.where(epoch_data.condition == condition)
-        temp['epoch_times'] = temp['epoch_times'].astype(bool)
-        epoch_data = temp
-
-    # The final array, in the shape of (all_cells x time), will
-    # be concatenated from nan-filled arrays that will be created on the fly.
-    try:
-        number_of_files = len(data.fname)
-    except TypeError:  # unsized arrays have no len
-        stacked_dff = np.full((len(data.neuron), len(data.time)), np.nan)
-        relevant_epoch_dff = _generate_epoch_df(epoch_data)
-        last_column = relevant_epoch_dff.shape[1]
-        stacked_dff[:, :last_column] = relevant_epoch_dff
-        return stacked_dff[np.isfinite(stacked_dff).any(axis=1)]
-
-    number_of_neurons = len(data.neuron)
-    stacked_dff = np.full((number_of_files * number_of_neurons, len(data.time)), np.nan)
-    last_full_row = 0
-    for _, dff_ds in epoch_data.groupby("fname"):
-        relevant_epoch_dff = _generate_epoch_df(dff_ds)
-        last_column = relevant_epoch_dff.shape[1]
-        stacked_dff[
-        last_full_row: (last_full_row + number_of_neurons), :last_column
-        ] = relevant_epoch_dff
-        last_full_row += number_of_neurons
-
-    full_rows = np.isfinite(stacked_dff).any(axis=1)
-    return stacked_dff[full_rows]
-
-
-def _generate_epoch_df(ds):
-    relevant_epoch_idx = ds["epoch_times"].data.ravel()
-    dff = ds["dff"].data
-    if dff.ndim == 3:
-        dff = dff[0]
-    relevant_epoch_dff = dff[:, relevant_epoch_idx]
-    return relevant_epoch_dff
+         Returns a new, writable numpy array in the shape of cells x time.
+         When filtering the same Dataset many times, pass an EpochSelector
+         of it instead, which does the preparatory work only once. Its own
+         filter method may return a read-only view instead of a copy. """
+    if isinstance(data, xr.Dataset):
+        data = EpochSelector(data)
+    selected = data.filter(epoch, condition)
+    if not selected.flags.writeable:  # a view of the dataset
+        selected = selected.copy()
+    return selected
+
+
+@attr.s(slots=True)
+class EpochSelector:
+    """
+    Selects the dF/F of cells during epochs from a dataset of a single FOV
+    or a day cube of many FOVs. The row indices of each condition and the
+    frame indices of each epoch in each FOV are computed once and cached,
+    and each selection is then a single gather of the relevant rows and
+    frames.
+
+    Like the original filter_da, the frames of each FOV are left-aligned
+    and NaN-padded to the length of the "time" coordinate, and cells with
+    no valid value are dropped. Unlike filter_da, which always returns a
+    copy, if the epoch covers all frames of a contiguous range of valid
+    cells the result of filter is a read-only view of the dataset.
+    """
+
+    data = attr.ib(validator=instance_of(xr.Dataset))
+    dff = attr.ib(init=False, repr=False)  # (fname * neuron) x time
+    epoch_times = attr.ib(init=False, repr=False)  # fname x epoch x time
+    epochs = attr.ib(init=False, repr=False)
+    fov_of_row = attr.ib(init=False, repr=False)
+    condition_of_fov = attr.ib(init=False, repr=False)
+    rows_of_condition = attr.ib(init=False, repr=False)
+    frames_of_epoch = attr.ib(init=False, repr=False)
+
+    def __attrs_post_init__(self):
+        dff = np.asarray(self.data["dff"].values)
+        epoch_times = self.data["epoch_times"].values
+        if epoch_times.dtype.kind == "f":  # masks of cubes which were NaN-padded
+            epoch_times = np.nan_to_num(epoch_times, nan=0.0)
+        epoch_times = epoch_times.astype(bool)
+        if dff.ndim == 2:
+            dff, epoch_times = dff[np.newaxis], epoch_times[np.newaxis]
+        num_of_fovs, num_of_neurons, num_of_frames = dff.shape
+        self.dff = dff.reshape((num_of_fovs * num_of_neurons, num_of_frames))
+        self.epoch_times = epoch_times
+        self.epochs = self.data.indexes["epoch"]
+        self.fov_of_row = np.repeat(np.arange(num_of_fovs), num_of_neurons)
+        self.condition_of_fov = np.broadcast_to(
+            self.data["condition"].values, (num_of_fovs,)
+        )
+        self.rows_of_condition = {}
+        self.frames_of_epoch = {}
+
+    def rows(self, condition: Optional[str] = None) -> np.ndarray:
+        """ Indices of the rows of the FOVs of the condition """
+        try:
+            return self.rows_of_condition[condition]
+        except KeyError:
+            if condition:
+                in_condition = self.condition_of_fov[self.fov_of_row] == condition
+                rows = np.flatnonzero(in_condition)
+            else:
+                rows = np.arange(len(self.dff))
+            self.rows_of_condition[condition] = rows
+            return rows
+
+    def frames(self, epoch: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The frames of the epoch in each FOV, as a (fname x frames) array
+        whose i-th row starts with the lengths[i] frame indices of the epoch
+        in the i-th FOV, and the lengths array.
+        """
+        try:
+            return self.frames_of_epoch[epoch]
+        except KeyError:
+            mask = self.epoch_times[:, self.epochs.get_loc(epoch)]
+            lengths = mask.sum(axis=1)
+            # A stable sort of the negated mask brings the frames of the epoch
+            # to the start of each row, in their original order
+            frames = np.argsort(~mask, axis=1, kind="stable")[:, : lengths.max()]
+            self.frames_of_epoch[epoch] = frames, lengths
+            return frames, lengths
+
+    def filter(self, epoch: str, condition: Optional[str] = None) -> np.ndarray:
+        """ The (cell x time) dF/F of the cells of the condition during the
+        epoch """
+        rows = self.rows(condition)
+        frames, lengths = self.frames(epoch)
+        fovs = self.fov_of_row[rows]
+        num_of_frames = self.dff.shape[1]
+        lengths = lengths[fovs]
+        if (
+            len(rows) > 0
+            and (lengths == num_of_frames).all()
+            and rows[-1] - rows[0] + 1 == len(rows)
+        ):
+            view = self.dff[rows[0] : rows[-1] + 1]
+            if np.isfinite(view).any(axis=1).all():
+                view = view.view()
+                view.flags.writeable = False
+                return view
+        longest = lengths.max() if len(rows) > 0 else 0
+        selected = np.full((len(rows), num_of_frames), np.nan, dtype=self.dff.dtype)
+        selected[:, :longest] = self.dff[rows[:, np.newaxis], frames[fovs, :longest]]
+        selected[:, :longest][np.arange(longest) >= lengths[:, np.newaxis]] = np.nan
+        return selected[np.isfinite(selected[:, :longest]).any(axis=1)]
 
 
 if __name__ == "__main__":
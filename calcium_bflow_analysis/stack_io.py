@@ -0,0 +1,421 @@
+"""
+Low-level access to the raw imaging stacks, TIF (ScanImage, BigTIFF and
+plain) or HDF5.
+
+The main function here is :func:`probe_stack`, which is the only place
+where the shape of a stack should be read from. It never decodes any pixel
+data - the dimensions of a frame come from the first IFD and the number of
+pages from the chain of IFD offsets of the file.
+
+The data itself should be read using :class:`StackReader`, which returns
+a single channel of the stack, optionally cropped in time and space,
+without reading the other channels or the rest of the file.
+:func:`deinterleave_stack` uses it to split multichannel recordings into
+one file per channel with a bounded memory footprint.
+"""
+import mmap
+import pathlib
+import struct
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import attr
+from attr.validators import instance_of
+import numpy as np
+import tifffile
+import h5py
+
+
+StackShape = namedtuple("StackShape", ("frames", "channels", "lines", "columns", "dtype"))
+
+HDF5_SUFFIXES = (".h5", ".hdf5")
+
+
+def probe_stack(
+    fname: Union[pathlib.Path, str],
+    num_of_channels: Optional[int] = None,
+    dataset: str = "mov",
+) -> StackShape:
+    """
+    Returns the shape of the given stack without reading its data.
+
+    Parameters:
+        fname (pathlib.Path): A TIF or an HDF5 file.
+        num_of_channels (int or None): The number of interleaved channels
+            in the file. If None, it's read from the ScanImage or ImageJ
+            metadata of the file, defaulting to a single channel.
+        dataset (str): Name of the dataset holding the movie in HDF5 files.
+    """
+    fname = pathlib.Path(fname)
+    if fname.suffix in HDF5_SUFFIXES:
+        with h5py.File(str(fname), "r") as f:
+            data = f[dataset]
+            return StackShape(data.shape[0], 1, data.shape[1], data.shape[2], data.dtype)
+    with tifffile.TiffFile(str(fname)) as f:
+        return probe_tif(f, num_of_channels)
+
+
+def probe_tif(f: tifffile.TiffFile, num_of_channels: Optional[int] = None) -> StackShape:
+    """ :func:`probe_stack` for an already opened TiffFile """
+    page = f.pages[0]
+    if num_of_channels is None:
+        num_of_channels = _channels_from_header(f)
+    num_of_pages, _ = _scan_ifds(f.filehandle)
+    return StackShape(
+        num_of_pages // num_of_channels,
+        num_of_channels,
+        int(page.imagelength),
+        int(page.imagewidth),
+        page.dtype,
+    )
+
+
+@attr.s(slots=True)
+class StackReader:
+    """
+    Reads a single channel of an interleaved stack, with optional frame
+    ranges and spatial crops.
+
+    Uncompressed TIF files with equidistant pages - the ScanImage layout -
+    are memory-mapped, so the returned arrays are read-only views into
+    the file, and only the pages of the requested slice are ever read from
+    disk. Other TIF files are decoded page by page, only for the requested
+    frames of the requested channel. HDF5 datasets are sliced directly,
+    which only reads the chunks that contain the requested data.
+
+    Usage:
+        reader = StackReader(fname, num_of_channels=2)
+        data = reader.read(channel=1, frames=slice(0, 1000))
+    """
+
+    fname = attr.ib(converter=pathlib.Path)
+    num_of_channels = attr.ib(default=None)
+    dataset = attr.ib(default="mov", validator=instance_of(str))
+    shape = attr.ib(init=False)
+    _mapped = attr.ib(init=False, default=None, repr=False)
+
+    def __attrs_post_init__(self):
+        self.shape = probe_stack(self.fname, self.num_of_channels, self.dataset)
+        self.num_of_channels = self.shape.channels
+
+    @property
+    def is_hdf5(self) -> bool:
+        return self.fname.suffix in HDF5_SUFFIXES
+
+    def read(
+        self,
+        channel: int = 0,
+        frames: slice = slice(None),
+        rows: slice = slice(None),
+        columns: slice = slice(None),
+    ) -> np.ndarray:
+        """
+        Returns the (frames x rows x columns) data of the given channel.
+        Channels are zero-based. For memory-mappable files the result
+        is a read-only view, so it should be copied before modifying it.
+        """
+        if not 0 <= channel < self.num_of_channels:
+            raise ValueError(
+                f"Channel {channel} is invalid for a stack with {self.num_of_channels} channels."
+            )
+        if self.is_hdf5:
+            with h5py.File(str(self.fname), "r") as f:
+                return f[self.dataset][frames, rows, columns]
+        mapped = self._map()
+        if mapped is not None:
+            channel_data = mapped[channel :: self.num_of_channels][: self.shape.frames]
+            return channel_data[frames, rows, columns]
+        start, stop, step = frames.indices(self.shape.frames)
+        n = self.num_of_channels
+        pages = range(channel + start * n, channel + stop * n, step * n)
+        with tifffile.TiffFile(str(self.fname)) as f:
+            return self._decode(f, pages)[:, rows, columns]
+
+    def iter_chunks(
+        self, frames_per_chunk: int, channel: Optional[int] = None
+    ) -> Iterator[np.ndarray]:
+        """
+        Iterates over the stack in chunks of consecutive frames. Each chunk
+        is a writable (frames x lines x columns) array of the given channel,
+        or a (frames x channels x lines x columns) array of all channels if
+        channel is None. Only a single chunk is held in memory at a time.
+        """
+        frame_starts = range(0, self.shape.frames, frames_per_chunk)
+        frame_ranges = [
+            slice(start, min(start + frames_per_chunk, self.shape.frames))
+            for start in frame_starts
+        ]
+        n = self.num_of_channels
+        if self.is_hdf5:
+            for frames in frame_ranges:
+                if channel is not None:
+                    yield self.read(channel, frames)
+                else:
+                    yield self.read(0, frames)[:, np.newaxis]
+            return
+
+        # Chunks of memory-mapped stacks are copied out of the read-only map
+        if self._map() is not None:
+            for frames in frame_ranges:
+                if channel is not None:
+                    yield np.array(self.read(channel, frames))
+                else:
+                    pages = self._mapped[frames.start * n : frames.stop * n]
+                    yield np.array(pages.reshape((-1, n) + pages.shape[1:]))
+            return
+
+        # The TiffFile is kept open so that its IFDs are only parsed once
+        with tifffile.TiffFile(str(self.fname)) as f:
+            for frames in frame_ranges:
+                if channel is not None:
+                    pages = range(channel + frames.start * n, frames.stop * n, n)
+                    yield self._decode(f, pages)
+                else:
+                    pages = range(frames.start * n, frames.stop * n)
+                    data = self._decode(f, pages)
+                    yield data.reshape((-1, n) + data.shape[1:])
+
+    def _map(self) -> Optional[np.ndarray]:
+        """ Memory-maps the stack if its layout allows it, as a
+        (pages x lines x columns) array. Returns None otherwise. """
+        if self._mapped is None:
+            self._mapped = self._map_tif() if not self.is_hdf5 else False
+        if self._mapped is False:
+            return None
+        return self._mapped
+
+    def _map_tif(self):
+        """ Creates the memory-mapped array of the pages of the TIF, or
+        returns False if the data isn't stored raw and equidistantly. """
+        with tifffile.TiffFile(str(self.fname)) as f:
+            num_of_pages, last_ifd = _scan_ifds(f.filehandle)
+            if num_of_pages < 2:
+                return False
+            first, second = f.pages[0], f.pages[1]
+            frame_bytes = self.shape.lines * self.shape.columns * self.shape.dtype.itemsize
+            data_start = first.dataoffsets[0]
+            is_raw = (
+                first.compression == 1
+                and first.samplesperpixel == 1
+                and first.bitspersample == 8 * self.shape.dtype.itemsize
+                and sum(first.databytecounts) == frame_bytes
+                and first.dataoffsets[-1] + first.databytecounts[-1] - data_start == frame_bytes
+            )
+            if not is_raw:
+                return False
+            # The pages are equidistant if the data of the last page is
+            # where the first two pages predict it to be
+            data_stride = second.dataoffsets[0] - data_start
+            last_data = _read_first_data_offset(f.filehandle, _read_header(f.filehandle), last_ifd)
+            if data_stride < frame_bytes or last_data != data_start + (num_of_pages - 1) * data_stride:
+                return False
+            dtype = self.shape.dtype.newbyteorder(f.byteorder)
+        with open(str(self.fname), "rb") as fh:
+            buffer = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        return np.ndarray(
+            shape=(num_of_pages, self.shape.lines, self.shape.columns),
+            dtype=dtype,
+            buffer=buffer,
+            offset=data_start,
+            strides=(data_stride, self.shape.columns * dtype.itemsize, dtype.itemsize),
+        )
+
+    def _decode(self, f: tifffile.TiffFile, pages: range) -> np.ndarray:
+        """ Decodes only the given pages of an opened TiffFile """
+        if len(pages) == 0:
+            return np.empty((0, self.shape.lines, self.shape.columns), self.shape.dtype)
+        data = f.asarray(key=pages)
+        return data.reshape((len(pages), self.shape.lines, self.shape.columns))
+
+
+def deinterleave_stack(
+    fname: Union[pathlib.Path, str],
+    num_of_channels: Optional[int] = None,
+    channels: Optional[Sequence[int]] = None,
+    max_memory: int = 512 * 2 ** 20,
+) -> List[pathlib.Path]:
+    """
+    Writes the channels of a multichannel stack into separate BigTIFF
+    files, named "*_CHANNEL_x.tif" (one-based), in a single pass over the
+    file. The stack is streamed in chunks of frames, so no more than about
+    max_memory bytes are held in memory at any time.
+
+    Parameters:
+        fname (pathlib.Path): The interleaved stack.
+        num_of_channels (int or None): Number of channels in the stack. If
+            None it's read from the file's metadata.
+        channels (list of ints or None): The one-based channels to write.
+            Defaults to all of them.
+        max_memory (int): Memory ceiling for the stack data, in bytes.
+
+    Returns the filenames of the written channels.
+    """
+    fname = pathlib.Path(fname)
+    reader = StackReader(fname, num_of_channels)
+    if channels is None:
+        channels = range(1, reader.num_of_channels + 1)
+    frame_bytes = reader.shape.lines * reader.shape.columns * reader.shape.dtype.itemsize
+    # Each chunk is copied once more when a channel is written out
+    frames_per_chunk = max(1, max_memory // (frame_bytes * (reader.num_of_channels + 1)))
+    new_fnames = [fname.with_name(f"{fname.stem}_CHANNEL_{channel}.tif") for channel in channels]
+    writers = [tifffile.TiffWriter(str(new_fname), bigtiff=True) for new_fname in new_fnames]
+    try:
+        for chunk in reader.iter_chunks(frames_per_chunk):
+            for writer, channel in zip(writers, channels):
+                # Without an explicit photometric, chunks of 3 or 4 frames
+                # would be written as a single RGB(A) page
+                writer.write(
+                    chunk[:, channel - 1],
+                    contiguous=True,
+                    photometric="minisblack",
+                    metadata=None,
+                )
+    finally:
+        for writer in writers:
+            writer.close()
+    return new_fnames
+
+
+def deinterleave_folder(
+    foldername: pathlib.Path,
+    glob: str = "*.tif",
+    num_of_channels: Optional[int] = None,
+    channels: Optional[Sequence[int]] = None,
+    max_memory: int = 2 * 2 ** 30,
+    max_workers: int = 4,
+) -> Dict[pathlib.Path, List[pathlib.Path]]:
+    """
+    Deinterleaves all stacks in the folder using a pool of threads. The
+    memory ceiling is split evenly between the workers. Files which
+    are the result of a previous deinterleaving are skipped.
+    Returns a dictionary mapping each stack to its channel files.
+    """
+    fnames = [
+        fname for fname in sorted(foldername.glob(glob)) if "_CHANNEL_" not in fname.name
+    ]
+    memory_per_worker = max_memory // max_workers
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            fname: executor.submit(
+                deinterleave_stack, fname, num_of_channels, channels, memory_per_worker
+            )
+            for fname in fnames
+        }
+        return {fname: future.result() for fname, future in futures.items()}
+
+
+def _channels_from_header(f: tifffile.TiffFile) -> int:
+    """ Number of interleaved channels as written in the ScanImage or
+    ImageJ metadata of the file """
+    try:
+        save_chans = f.scanimage_metadata["FrameData"]["SI.hChannels.channelSave"]
+    except (TypeError, KeyError):
+        pass
+    else:
+        return 1 if type(save_chans) is int else len(save_chans)
+    try:
+        return int(f.imagej_metadata["channels"])
+    except (TypeError, KeyError):
+        return 1
+
+
+TiffHeader = namedtuple(
+    "TiffHeader", ("first_ifd", "tagno_format", "tag_size", "offset_format")
+)
+
+
+def _read_header(fh) -> TiffHeader:
+    """ Parse the byteorder and the offset sizes of a classic TIFF or
+    a BigTIFF file """
+    fh.seek(0)
+    header = fh.read(16)
+    byteorder = {b"II": "<", b"MM": ">"}[header[:2]]
+    version = struct.unpack(byteorder + "H", header[2:4])[0]
+    if version == 43:
+        first_ifd = struct.unpack(byteorder + "Q", header[8:16])[0]
+        return TiffHeader(first_ifd, byteorder + "Q", 20, byteorder + "Q")
+    first_ifd = struct.unpack(byteorder + "I", header[4:8])[0]
+    return TiffHeader(first_ifd, byteorder + "H", 12, byteorder + "I")
+
+
+def _read_ifd(fh, header: TiffHeader, offset: int) -> Tuple[int, int]:
+    """ Returns the number of tags in the IFD at the given offset and the
+    offset of the next IFD, without parsing the tags themselves """
+    tagno_size = struct.calcsize(header.tagno_format)
+    fh.seek(offset)
+    num_of_tags = struct.unpack(header.tagno_format, fh.read(tagno_size))[0]
+    fh.seek(offset + tagno_size + num_of_tags * header.tag_size)
+    next_offset = struct.unpack(
+        header.offset_format, fh.read(struct.calcsize(header.offset_format))
+    )[0]
+    return num_of_tags, next_offset
+
+
+def _read_first_data_offset(fh, header: TiffHeader, offset: int) -> int:
+    """ Returns the offset of the first strip (or tile) of the
+    IFD at the given offset, or 0 if the IFD has no such tag """
+    tagno_size = struct.calcsize(header.tagno_format)
+    offset_size = struct.calcsize(header.offset_format)
+    byteorder = header.offset_format[0]
+    value_formats = {3: "H", 4: "I", 16: "Q"}
+    fh.seek(offset)
+    num_of_tags = struct.unpack(header.tagno_format, fh.read(tagno_size))[0]
+    entries = fh.read(num_of_tags * header.tag_size)
+    for idx in range(num_of_tags):
+        entry = entries[idx * header.tag_size : (idx + 1) * header.tag_size]
+        code, dtype = struct.unpack(byteorder + "HH", entry[:4])
+        if code not in (273, 324):  # StripOffsets and TileOffsets
+            continue
+        count = struct.unpack(header.offset_format, entry[4 : 4 + offset_size])[0]
+        value_format = byteorder + value_formats[dtype]
+        value_size = struct.calcsize(value_format)
+        value = entry[4 + offset_size :]
+        if count * value_size > offset_size:  # the values are stored elsewhere
+            fh.seek(struct.unpack(header.offset_format, value)[0])
+            value = fh.read(value_size)
+        return struct.unpack(value_format, value[:value_size])[0]
+    return 0
+
+
+def _scan_ifds(fh) -> Tuple[int, int]:
+    """
+    Count the pages in the file from its IFD offsets. Returns that count
+    and the offset of the last IFD.
+
+    Acquisition software (ScanImage) writes the pages of a stack
+    equidistantly, so the offset of the last IFD can be computed from the
+    first two offsets and the size of the file. If the IFD found at that
+    offset is indeed the last one, only three IFDs were read. Otherwise we
+    follow the chain of IFD offsets, which is still much faster than
+    parsing each page.
+    """
+    header = _read_header(fh)
+    if header.first_ifd == 0:
+        return 0, 0
+    num_of_tags, second = _read_ifd(fh, header, header.first_ifd)
+    if second == 0:
+        return 1, header.first_ifd
+    _, third = _read_ifd(fh, header, second)
+    stride = second - header.first_ifd
+    if stride > 0 and third - second == stride:
+        estimate = (fh.size - header.first_ifd) // stride
+        for count in (estimate, estimate + 1, estimate - 1):
+            last = header.first_ifd + (count - 1) * stride
+            if count < 3 or last >= fh.size:
+                continue
+            try:
+                last_tags, last_next = _read_ifd(fh, header, last)
+            except struct.error:
+                continue
+            if last_tags == num_of_tags and last_next == 0:
+                return count, last
+
+    count = 2
+    last, offset = second, third
+    max_count = fh.size // header.tag_size
+    while offset != 0 and offset < fh.size and count < max_count:
+        count += 1
+        last = offset
+        _, offset = _read_ifd(fh, header, offset)
+    return count, last
@@ -1,8 +1,25 @@
+"""
+Correction of the line shift of bidirectionally-scanned images, in which
+the even and odd lines are offset horizontally from each other.
+
+The offset of a whole stack is estimated with sub-pixel precision by
+cross-correlating its even and odd lines, using FFTs over a subsample of
+its frames. The correction is then a phase ramp applied to the even lines,
+computed for a chunk of frames at a time.
+
+Usage:
+    shift = estimate_line_shift(pathlib.Path("fov1_00001.tif"))
+    correct_stack_line_shift(pathlib.Path("fov1_00001.tif"), shift)
+"""
 import pathlib
+from typing import Optional, Union
 
 import matplotlib.pyplot as plt
 import numpy as np
 import imageio
+import tifffile
+
+from calcium_bflow_analysis.stack_io import StackReader
 
 
 def correct_line_shift(img: np.ndarray, value: int):
@@ -12,6 +29,109 @@ def correct_line_shift(img: np.ndarray, value: int):
     return img
 
 
+def estimate_line_shift(
+    fname: Union[pathlib.Path, str],
+    channel: int = 0,
+    num_of_channels: Optional[int] = None,
+    num_of_frames: int = 200,
+    max_shift: Optional[int] = None,
+) -> float:
+    """
+    Estimates the horizontal offset, in pixels, of the even lines of the
+    stack relative to its odd lines.
+
+    Parameters:
+        fname (pathlib.Path): A TIF or an HDF5 file.
+        channel (int): Zero-based channel to estimate the shift from.
+        num_of_channels (int or None): Number of channels in the stack. If
+            None it's read from the file's metadata.
+        num_of_frames (int): Number of frames, evenly spread across the
+            stack, to use for the estimation.
+        max_shift (int or None): Largest offset to look for. Defaults to a
+            quarter of the width of the frames.
+    """
+    reader = StackReader(fname, num_of_channels)
+    step = max(1, reader.shape.frames // num_of_frames)
+    data = reader.read(channel, slice(None, None, step))[:num_of_frames]
+    return estimate_line_shift_of_frames(data, max_shift)
+
+
+def estimate_line_shift_of_frames(data: np.ndarray, max_shift: Optional[int] = None) -> float:
+    """
+    Estimates the offset of the even lines relative to the odd lines of a
+    (frames x lines x columns) array. The cross-power spectra of all pairs
+    of lines are summed, and the peak of their inverse transform is refined
+    with a parabolic fit around it.
+    """
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    num_of_pairs = data.shape[1] // 2
+    even = data[:, 0 : 2 * num_of_pairs : 2].astype(np.float64)
+    odd = data[:, 1 : 2 * num_of_pairs : 2].astype(np.float64)
+    even -= even.mean(axis=-1, keepdims=True)
+    odd -= odd.mean(axis=-1, keepdims=True)
+    cross_power = (np.fft.rfft(even, axis=-1) * np.fft.rfft(odd, axis=-1).conj()).sum(axis=(0, 1))
+    columns = data.shape[-1]
+    xcorr = np.fft.irfft(cross_power, n=columns)
+    if max_shift is None:
+        max_shift = columns // 4
+    lags = np.arange(-max_shift, max_shift + 1)
+    peak = lags[np.argmax(xcorr[lags])]
+    before, at, after = xcorr[peak - 1], xcorr[peak], xcorr[(peak + 1) % columns]
+    denominator = before - 2 * at + after
+    if denominator == 0:
+        return float(peak)
+    return float(peak + 0.5 * (before - after) / denominator)
+
+
+def shift_even_lines(data: np.ndarray, shift: float) -> np.ndarray:
+    """
+    Moves the even lines of the (... x lines x columns) array by shift
+    pixels to the right, in place, using a Fourier phase ramp so that
+    sub-pixel shifts are supported. Like np.roll, the lines wrap around.
+    """
+    even = data[..., ::2, :]
+    columns = data.shape[-1]
+    ramp = np.exp(-2j * np.pi * np.fft.rfftfreq(columns) * shift)
+    shifted = np.fft.irfft(np.fft.rfft(even, axis=-1) * ramp, n=columns, axis=-1)
+    if np.issubdtype(data.dtype, np.integer):
+        limits = np.iinfo(data.dtype)
+        shifted = np.clip(np.round(shifted), limits.min, limits.max)
+    even[...] = shifted
+    return data
+
+
+def correct_stack_line_shift(
+    fname: Union[pathlib.Path, str],
+    shift: Optional[float] = None,
+    num_of_channels: Optional[int] = None,
+    channel: int = 0,
+    max_memory: int = 512 * 2 ** 20,
+) -> pathlib.Path:
+    """
+    Writes a line-shift corrected copy of the stack, named "*_CORRECTED.tif",
+    streaming it in chunks of frames so that no more than about max_memory
+    bytes are held in memory. All channels are corrected by the same shift,
+    which is estimated from the given channel if it isn't given.
+    Returns the filename of the corrected stack.
+    """
+    fname = pathlib.Path(fname)
+    reader = StackReader(fname, num_of_channels)
+    if shift is None:
+        shift = estimate_line_shift(fname, channel, reader.num_of_channels)
+    frame_bytes = reader.shape.lines * reader.shape.columns * 16  # complex128
+    frames_per_chunk = max(1, max_memory // (frame_bytes * reader.num_of_channels * 2))
+    new_fname = fname.with_name(f"{fname.stem}_CORRECTED.tif")
+    with tifffile.TiffWriter(str(new_fname), bigtiff=True) as writer:
+        for chunk in reader.iter_chunks(frames_per_chunk):
+            chunk = shift_even_lines(chunk, -shift)
+            pages = chunk.reshape((-1,) + chunk.shape[2:])
+            # Each frame is its own page, even in chunks of 3 or 4 pages
+            # which would otherwise be written as a single RGB(A) page
+            writer.write(pages, contiguous=True, photometric="minisblack", metadata=None)
+    return new_fname
+
+
 def show_corrected_image(img: np.ndarray):
     fig, ax = plt.subplots()
     ax.imshow(corrected, cmap="gray")
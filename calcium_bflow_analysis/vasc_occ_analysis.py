@@ -102,18 +102,25 @@ class VascOccAnalyzer:
         """
         Calculates a dataframe, each row being a cell, with three columns - before, during and after
         the occlusion. The numbers for each cell are normalized for the length of the epoch.
+        The spikes themselves are returned as SpikeEvents.
         """
         before_occ = self.data.attrs["frames_before_occ"]
         during_occ = self.data.attrs["frames_during_occ"]
         after_occ = before_occ + during_occ
         norm_factor_during = before_occ / during_occ
         norm_factor_after = before_occ / self.data.attrs["frames_after_occ"]
-        all_spikes = locate_spikes_peakutils(dff, fps=self.data.attrs["fps"], thresh=0.8)
-        spikes_before = all_spikes[:, :before_occ].sum(axis=1)
-        spikes_during = (
-            all_spikes[:, before_occ:after_occ].sum(axis=1) * norm_factor_during
+        all_spikes = locate_spikes_peakutils(
+            dff, fps=self.data.attrs["fps"], thresh=0.8, as_events=True
         )
-        spikes_after = all_spikes[:, -after_occ:].sum(axis=1) * norm_factor_after
+        num_of_frames = all_spikes.num_of_frames
+        # The last after_occ frames, as a [-after_occ:] slice of the frames
+        after_start = max(num_of_frames - after_occ, 0) if after_occ else 0
+        counts = all_spikes.count_in_windows(
+            [0, before_occ, after_start], [before_occ, after_occ, num_of_frames]
+        ).astype(np.float64)
+        spikes_before = counts[:, 0]
+        spikes_during = counts[:, 1] * norm_factor_during
+        spikes_after = counts[:, 2] * norm_factor_after
         num_of_spikes = pd.DataFrame(
             {"before": spikes_before, "during": spikes_during, "after": spikes_after}
         )
@@ -4,12 +4,9 @@ import numpy as np
 import pandas as pd
 import pathlib
 import matplotlib.pyplot as plt
-import tifffile
-import os
 import itertools
 import xarray as xr
 from collections import namedtuple
-from datetime import datetime
 import colorama
 
 colorama.init()
@@ -17,6 +14,13 @@ import copy
 import warnings
 
 from calcium_bflow_analysis.calcium_over_time import FileFinder
+from calcium_bflow_analysis.metadata_index import get_stack_metadata
+from calcium_bflow_analysis.serialization import (
+    EncodingConfig,
+    VASC_OCC_ENCODING,
+    to_netcdf,
+)
+from calcium_bflow_analysis.analog_cache import read_analog
 from calcium_bflow_analysis.analog_trace import (
     AnalogAcquisitionType,
     analog_trace_runner,
@@ -54,6 +58,7 @@ class VascOccParser:
     )
     with_colabeling = attr.ib(default=False, validator=instance_of(bool))
     serialize = attr.ib(default=True, validator=optional(instance_of(str)))
+    encoding = attr.ib(default=VASC_OCC_ENCODING, validator=instance_of(EncodingConfig))
     fps = attr.ib(init=False)
     dff = attr.ib(init=False)
     colabel_idx = attr.ib(init=False)
@@ -85,9 +90,7 @@ class VascOccParser:
         for idx, row in self.data_files.iterrows():
             self._get_params(row["tif"])
             dff = calc_dff((row["caiman"]))
-            analog_data = pd.read_csv(
-                row["analog"], header=None, names=["stimulus", "run"], index_col=False
-            )
+            analog_data = read_analog(row["analog"])
             occ_metadata = self.OccMetadata(
                 self.frames_before_stim,
                 self.len_of_epoch_in_frames,
@@ -127,35 +130,28 @@ class VascOccParser:
         self.sliced_fluo.attrs["frames_after_occ"] = self.frames_after_stim
         if self.with_colabeling:
             self.sliced_fluo.attrs["colabeled"] = self.colabel_idx
-        self.sliced_fluo.to_netcdf(
-            str(foldername / (fname + ".nc")), mode="w"
-        )  # TODO: compress
+        to_netcdf(self.sliced_fluo, foldername / (fname + ".nc"), self.encoding)
 
     def _get_params(self, fname: pathlib.Path):
-        """ Get general stack parameters from the TiffFile object """
-        try:
-            print("Getting TIF parameters...")
-            with tifffile.TiffFile(str(fname)) as f:
-                si_meta = f.scanimage_metadata
-                self.fps = si_meta["FrameData"]["SI.hRoiManager.scanFrameRate"]
-                self.num_of_channels = len(
-                    si_meta["FrameData"]["SI.hChannels.channelsActive"]
-                )
-                num_of_frames = si_meta["FrameData"]["SI.hStackManager.framesPerSlice"]
-                self.frames_after_stim = num_of_frames - (
-                    self.frames_before_stim + self.len_of_epoch_in_frames
-                )
-                self.start_time = str(
-                    datetime.fromtimestamp(os.path.getmtime(self.data_files["tif"][0]))
-                )
-                self.timestamps = np.arange(num_of_frames) / self.fps
-                print("Done without errors!")
-        except TypeError:
+        """ Get general stack parameters from the metadata index """
+        print("Getting TIF parameters...")
+        meta = get_stack_metadata(fname)
+        if not meta.is_scanimage:
             warnings.warn("Failed to parse ScanImage metadata")
             self.start_time = None
             self.timestamps = None
             self.frames_after_stim = 1000
             self.fps = 58.31
+            return
+        self.fps = meta.fps
+        self.num_of_channels = meta.num_of_channels
+        num_of_frames = meta.num_of_frames
+        self.frames_after_stim = num_of_frames - (
+            self.frames_before_stim + self.len_of_epoch_in_frames
+        )
+        self.start_time = meta.start_time
+        self.timestamps = np.arange(num_of_frames) / self.fps
+        print("Done without errors!")
 
     def _load_colabeled_idx(self):
         """ Loads the indices of the colabeled cells from all found files """
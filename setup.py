@@ -40,6 +40,7 @@ setup(
                       'scikit-image >= 0.16',
                       'jupyter >= 1',
                       'h5py >= 2.10',
+                      'netCDF4 >= 1.5',
                       'mne >= 0.19',
                       'dff_calc >= 0.1',
                       'openpyxl', 
@@ -0,0 +1,221 @@
+"""
+The epochs of the analog analysis, compared with a plain copy of the
+original per-FOV pandas implementation, so that the vectorized paths -
+__mul__, the streaming detector and the batch analysis - keep producing
+the same epochs.
+"""
+from collections import namedtuple
+from itertools import product
+
+import numpy as np
+import pandas as pd
+import pytest
+import tifffile
+
+from calcium_bflow_analysis.analog_batch import analyze_analog_batch
+from calcium_bflow_analysis.analog_stream import StreamingAnalogDetector
+from calcium_bflow_analysis.analog_trace import (
+    AnalogAcquisitionType,
+    AnalogAnalysisTreadmill,
+    AnalogAnalysisTreadmillRows,
+)
+from calcium_bflow_analysis.fluo_metadata import FluoMetadata
+
+FPS = 30.0
+Occluder = namedtuple("Occluder", ("before", "during"))
+OCCLUDER = Occluder(100, 200)
+# The thresholds of the original implementation
+BASELINE = {
+    AnalogAcquisitionType.TREADMILL: dict(rising=False, both=-50, true=-1000, run=0.035),
+    AnalogAcquisitionType.TREADROWS: dict(rising=True, both=1, true=3.8, run=0.01),
+}
+
+
+def _baseline_windows(puff_idx, length):
+    puff_times = np.zeros(length)
+    if len(puff_idx) == 0:
+        return puff_times
+    limits = np.where(np.diff(puff_idx) > int(FPS))[0]
+    starts = np.concatenate(([0], limits + 1))
+    ends = np.concatenate((limits, [len(puff_idx) - 1]))
+    for start, end in zip(starts, ends):
+        puff_times[puff_idx[start] : puff_idx[end] + int(FPS)] = 1
+    return puff_times
+
+
+def _baseline_vectors(stim, run, analog_type, occluder):
+    """ The epoch vectors of the original analysis, 1 in the epoch and NaN
+    outside of it, from the per-frame stimulus and run channels """
+    thresholds = BASELINE[analog_type]
+    diffs = np.diff(stim)
+    if thresholds["rising"]:
+        both, true = np.where(diffs > thresholds["both"])[0], np.where(diffs > thresholds["true"])[0]
+    else:
+        both, true = np.where(diffs < thresholds["both"])[0], np.where(diffs < thresholds["true"])[0]
+    is_true = np.isin(both, true)
+    stim_times = _baseline_windows(both[is_true], len(stim))
+    juxta_times = _baseline_windows(both[~is_true], len(stim))
+    run = run - run.min()
+    run = run / run.max()
+    rolling = pd.Series(run).diff().abs().rolling(int(FPS)).mean()
+    run_vec = np.full(len(run), np.nan)
+    run_vec[rolling > thresholds["run"]] = 1
+    vectors = {
+        "run": run_vec,
+        "stand": np.where(np.isnan(run_vec), 1.0, np.nan),
+        "stim": np.where(stim_times == 0, np.nan, 1.0),
+        "juxta": np.where(juxta_times == 0, np.nan, 1.0),
+        "spont": np.where(stim_times + juxta_times == 0, 1.0, np.nan),
+    }
+    if occluder:
+        frames = np.arange(len(stim))
+        during = OCCLUDER.before + OCCLUDER.during
+        vectors["before_occ"] = np.where(frames < OCCLUDER.before, 1.0, np.nan)
+        vectors["during_occ"] = np.where((frames >= OCCLUDER.before) & (frames < during), 1.0, np.nan)
+        vectors["after_occ"] = np.where(frames >= during, 1.0, np.nan)
+    return vectors
+
+
+def _baseline_epoch_times(vectors, occluder):
+    """ The epoch names and epoch x time masks of the original __mul__ """
+    groups = [["run", "stand", None], ["stim", "juxta", "spont", None]]
+    if occluder:
+        groups.append(["before_occ", "during_occ", "after_occ", None])
+    names, masks = [], []
+    for epoch in product(*groups):
+        parts = [part for part in epoch if part is not None]
+        names.append("_".join(parts) if parts else "all")
+        mask = np.ones(len(vectors["run"]), dtype=bool)
+        for part in parts:
+            mask &= np.isfinite(vectors[part])
+        masks.append(mask)
+    return names, np.array(masks)
+
+
+def _baseline_codes(vectors, signals):
+    codes = np.zeros(len(vectors["run"]), dtype=np.uint8)
+    for bit, name in enumerate(signals):
+        codes |= np.isfinite(vectors[name]).astype(np.uint8) << np.uint8(bit)
+    return codes
+
+
+def _baseline_rows_to_frames(vec, num_of_frames):
+    window_size = max(len(vec) // num_of_frames, 1)
+    rolling = pd.Series(vec).abs().rolling(window_size).mean()
+    sample_at = np.linspace(window_size - 1, len(vec) - 1, num=num_of_frames, dtype=np.uint32)
+    return rolling.to_numpy()[sample_at]
+
+
+def _treadmill_analog(rng, num_of_samples):
+    """ Stimulus drops of puffs and juxta puffs, and a run channel with
+    bouts of movement """
+    stim = np.zeros(num_of_samples)
+    for event in rng.choice(num_of_samples - 5, size=int(rng.integers(0, 25)), replace=False):
+        stim[event + 1 : event + 1 + int(rng.integers(1, 5))] = rng.choice([-30000.0, -500.0])
+    moving = rng.random(num_of_samples) < 0.3
+    run = np.cumsum(rng.normal(size=num_of_samples) * moving) * 0.1
+    run += rng.normal(size=num_of_samples) * 0.01
+    return stim, run
+
+
+def _rows_analog(rng, num_of_frames, rows_per_frame):
+    """ Per-row stimulus rises of puffs and juxta puffs, and a run channel """
+    num_of_rows = num_of_frames * rows_per_frame + int(rng.integers(0, rows_per_frame))
+    stim = np.zeros(num_of_rows)
+    for event in rng.choice(num_of_rows - 40, size=int(rng.integers(0, 25)), replace=False):
+        stim[event + 1 : event + 1 + int(rng.integers(10, 40))] = rng.choice([5.0, 2.0])
+    _, run = _treadmill_analog(rng, num_of_rows)
+    return stim, run
+
+
+def _metadata(tif):
+    meta = FluoMetadata(tif, fps=FPS)
+    meta.mouse_id, meta.condition, meta.day, meta.fov = "1", "HYPER", 1, 1
+    return meta
+
+
+@pytest.mark.parametrize("seed", range(6))
+@pytest.mark.parametrize("occluder", [False, True])
+@pytest.mark.parametrize(
+    "analog_type", [AnalogAcquisitionType.TREADMILL, AnalogAcquisitionType.TREADROWS]
+)
+def test_mul_epoch_times(tmp_path, analog_type, occluder, seed):
+    rng = np.random.default_rng(seed)
+    tif = tmp_path / "1_HYPER_DAY_1_FOV_1_.tif"
+    if analog_type is AnalogAcquisitionType.TREADMILL:
+        stim, run = _treadmill_analog(rng, int(rng.integers(400, 3000)))
+        num_of_frames = len(stim)
+        meta = _metadata(tif)
+        analysis = AnalogAnalysisTreadmill(
+            tif, pd.DataFrame({"stimulus": stim, "run": run}), meta, occluder=occluder,
+            num_of_lines=4,
+        )
+        stim_frames, run_frames = stim, run
+    else:
+        num_of_frames = int(rng.integers(400, 1500))
+        stim, run = _rows_analog(rng, num_of_frames, int(rng.integers(3, 8)))
+        tifffile.imwrite(str(tif), np.zeros((num_of_frames, 8, 8), dtype=np.uint16))
+        meta = _metadata(tif)
+        analysis = AnalogAnalysisTreadmillRows(
+            tif, pd.DataFrame({"stimulus": stim, "run": run}), meta, occluder=occluder
+        )
+        stim_frames = _baseline_rows_to_frames(stim, num_of_frames)
+        run_frames = _baseline_rows_to_frames(run, num_of_frames)
+    meta.timestamps = np.arange(num_of_frames) / FPS
+    analysis.run()
+    ds = analysis * np.zeros((3, num_of_frames))
+
+    vectors = _baseline_vectors(stim_frames, run_frames, analog_type, occluder)
+    names, epoch_times = _baseline_epoch_times(vectors, occluder)
+    assert list(ds["epoch"].values) == names
+    np.testing.assert_array_equal(ds["epoch_times"].values, epoch_times)
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("occluder", [False, True])
+def test_streaming_codes(seed, occluder):
+    rng = np.random.default_rng(seed)
+    stim, run = _treadmill_analog(rng, int(rng.integers(400, 3000)))
+    detector = StreamingAnalogDetector(
+        fps=FPS, run_range=(run.min(), run.max()), occ_metadata=OCCLUDER if occluder else None
+    )
+    cuts = np.sort(rng.integers(0, len(stim), size=int(rng.integers(0, 20))))
+    codes = [detector.feed(chunk) for chunk in np.split(np.column_stack((stim, run)), cuts)]
+    codes = np.concatenate(codes + [detector.flush()])
+
+    vectors = _baseline_vectors(stim, run, AnalogAcquisitionType.TREADMILL, occluder)
+    np.testing.assert_array_equal(codes, _baseline_codes(vectors, detector.signals))
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("occluder", [False, True])
+@pytest.mark.parametrize(
+    "analog_type", [AnalogAcquisitionType.TREADMILL, AnalogAcquisitionType.TREADROWS]
+)
+def test_batch_codes(tmp_path, analog_type, occluder, seed):
+    rng = np.random.default_rng(seed)
+    fnames, frames_of_fovs, expected = [], [], []
+    for fov in range(4):
+        if analog_type is AnalogAcquisitionType.TREADMILL:
+            stim, run = _treadmill_analog(rng, int(rng.integers(400, 3000)))
+            stim_frames, run_frames = stim, run
+        else:
+            num_of_frames = int(rng.integers(400, 1500))
+            stim, run = _rows_analog(rng, num_of_frames, int(rng.integers(3, 8)))
+            stim_frames = _baseline_rows_to_frames(stim, num_of_frames)
+            run_frames = _baseline_rows_to_frames(run, num_of_frames)
+            frames_of_fovs.append(num_of_frames)
+        fname = tmp_path / f"fov_{fov}_analog.txt"
+        np.savetxt(str(fname), np.column_stack((stim, run)), delimiter=",")
+        fnames.append(fname)
+        expected.append(_baseline_vectors(stim_frames, run_frames, analog_type, occluder))
+
+    batch = analyze_analog_batch(
+        fnames,
+        analog_type,
+        FPS,
+        num_of_frames=frames_of_fovs or None,
+        occ_metadata=OCCLUDER if occluder else None,
+    )
+    for fov, vectors in enumerate(expected):
+        np.testing.assert_array_equal(batch.fov_codes(fov), _baseline_codes(vectors, batch.signals))
@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+import tifffile
+
+from calcium_bflow_analysis import calcium_over_time
+from calcium_bflow_analysis.calcium_over_time import CalciumAnalysisOverTime, FovResult
+from calcium_bflow_analysis.day_store import open_day
+from calcium_bflow_analysis.dff_dataset import dff_dataset_init
+from calcium_bflow_analysis.serialization import to_netcdf
+
+
+def _write_inputs(folder, name, value):
+    tif = folder / f"{name}.tif"
+    tifffile.imwrite(str(tif), np.full((2, 4, 4), value, dtype=np.uint16))
+    caiman = folder / f"{name}_results.npz"
+    np.savez(str(caiman), value=value)
+    return tif, caiman
+
+
+def _fake_analyze_fov(failing):
+    """ analyze_fov that writes a FOV whose dF/F is the value in its
+    CaImAn file, or fails for the tifs in failing """
+
+    def analyze_fov(unit):
+        if unit.tif in failing:
+            return FovResult(unit.tif, None, None, "Traceback: failed")
+        with np.load(str(unit.caiman)) as f:
+            value = float(f["value"])
+        ds = dff_dataset_init(
+            {
+                "dff": (["neuron", "time"], np.full((3, 10), value)),
+                "epoch_times": (["epoch", "time"], np.ones((1, 10), dtype=bool)),
+            },
+            {
+                "neuron": np.arange(3),
+                "time": np.arange(10) / 30.0,
+                "epoch": ["all"],
+                "fov": 1,
+                "mouse_id": "1",
+                "condition": "HYPER",
+                "day": 1,
+                "fname": unit.tif.stem,
+            },
+            {"fps": 30.0, "stim_window": 1.5},
+        )
+        output = str(unit.tif)[:-4] + ".nc"
+        to_netcdf(ds, output, unit.encoding)
+        return FovResult(unit.tif, output, 30.0, None)
+
+    return analyze_fov
+
+
+def _run(folder, files, monkeypatch, failing=()):
+    monkeypatch.setattr(calcium_over_time, "analyze_fov", _fake_analyze_fov(failing))
+    table = pd.DataFrame(
+        [(tif, caiman, None, None) for tif, caiman in files],
+        columns=["tif", "caiman", "analog", "colabeled"],
+    )
+    analysis = CalciumAnalysisOverTime(
+        files_table=table, serialize=True, folder_globs={folder: "*.tif"}
+    )
+    analysis.run_batch_of_timepoints(folder)
+    day = open_day(folder / "data_of_day_1.nc")
+    return {fov: day.fov_dff(fov)[0, 0] for fov in day.fovs.index}
+
+
+def test_failed_rerun_drops_stale_fov(tmp_path, monkeypatch):
+    """ A FOV whose inputs changed and whose reanalysis failed isn't
+    concatenated with its previous output, and is retried next time """
+    names = ("1_DAY_1_FOV_1", "1_DAY_1_FOV_2")
+    files = [_write_inputs(tmp_path, name, 1) for name in names]
+    assert _run(tmp_path, files, monkeypatch) == {names[0]: 1.0, names[1]: 1.0}
+
+    files = [_write_inputs(tmp_path, name, 2) for name in names]
+    dff = _run(tmp_path, files, monkeypatch, failing={files[1][0]})
+    assert dff == {names[0]: 2.0}
+
+    assert _run(tmp_path, files, monkeypatch) == {names[0]: 2.0, names[1]: 2.0}
@@ -0,0 +1,81 @@
+import numpy as np
+import peakutils
+import pytest
+import scipy.signal
+
+from calcium_bflow_analysis.dff_analysis_and_plotting.spike_detection import (
+    count_peaks_by_threshold,
+    find_peaks_peakutils,
+    find_peaks_scipy,
+)
+
+
+def _random(rng):
+    return np.cumsum(rng.normal(size=(40, 600)), axis=1)
+
+
+def _with_nans(rng):
+    """ Positive data, so that the NaNs, which are treated as zeros, aren't
+    peaks of equal height """
+    data = np.abs(_random(rng)) + 1
+    data[rng.random(data.shape) < 0.05] = np.nan
+    data[3] = np.nan
+    return data
+
+
+def _plateaus(rng):
+    """ Flat peaks of 1 to 4 samples, whose heights are all different so
+    that the order of the peaks doesn't depend on how ties are broken """
+    lengths = rng.integers(1, 5, size=(40, 300))
+    values = _random(rng)[:, :300]
+    return np.stack([np.repeat(row, lens)[:300] for row, lens in zip(values, lengths)])
+
+
+DATA = {"random": _random, "nans": _with_nans, "plateaus": _plateaus}
+
+
+@pytest.mark.parametrize("kind", DATA)
+@pytest.mark.parametrize("thresh, min_dist", [(0.3, 1), (0.5, 10), (0.7, 30)])
+def test_find_peaks_peakutils(kind, thresh, min_dist):
+    data = DATA[kind](np.random.default_rng(0))
+    spikes = find_peaks_peakutils(data, thresh=thresh, min_dist=min_dist)
+    for cell, row in enumerate(np.nan_to_num(data)):
+        expected = peakutils.indexes(row, thres=thresh, min_dist=min_dist)
+        np.testing.assert_array_equal(spikes.frames_of(cell), expected)
+
+
+@pytest.mark.parametrize("kind", DATA)
+@pytest.mark.parametrize(
+    "prominence, threshold, distance", [(1.0, (0.1, 5), 1), (2.0, (None, None), 10), (0.5, (0.2, None), 4)]
+)
+def test_find_peaks_scipy(kind, prominence, threshold, distance):
+    data = DATA[kind](np.random.default_rng(1))
+    spikes = find_peaks_scipy(data, prominence, threshold=threshold, distance=distance)
+    for cell, row in enumerate(np.nan_to_num(data)):
+        expected, _ = scipy.signal.find_peaks(
+            row, prominence=prominence, threshold=threshold, distance=distance
+        )
+        np.testing.assert_array_equal(spikes.frames_of(cell), expected)
+
+
+def test_tied_peaks_keep_the_later_one():
+    """ Of peaks of equal height closer than the distance, the later one
+    remains and removes the others from there on """
+    row = np.array([[0, 1, 0, 1, 0, 1, 0]], dtype=np.float64)
+    np.testing.assert_array_equal(find_peaks_peakutils(row, 0.1, min_dist=2).frames_of(0), [1, 5])
+    np.testing.assert_array_equal(find_peaks_peakutils(row, 0.1, min_dist=4).frames_of(0), [5])
+    spikes = find_peaks_scipy(row, 0.1, threshold=(None, None), distance=3)
+    np.testing.assert_array_equal(spikes.frames_of(0), [1, 5])
+
+
+@pytest.mark.parametrize("min_dist", [1, 30])
+def test_count_peaks_by_threshold(min_dist):
+    data = _with_nans(np.random.default_rng(2))
+    thresholds = np.linspace(0.05, 0.95, 25)
+    counts = count_peaks_by_threshold(data, thresholds, min_dist=min_dist)
+    for cell, row in enumerate(np.nan_to_num(data)):
+        expected = [
+            len(peakutils.indexes(row, thres=thresh, min_dist=min_dist))
+            for thresh in thresholds
+        ]
+        np.testing.assert_array_equal(counts[cell], expected)
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+import tifffile
+
+from calcium_bflow_analysis.stack_io import StackReader, deinterleave_stack
+
+
+@pytest.mark.parametrize("frames_per_chunk", [1, 3, 4, 7])
+def test_deinterleave_round_trip(tmp_path, frames_per_chunk):
+    """ Each frame is written as its own page, also in chunks of 3 or 4
+    frames which tifffile would otherwise write as RGB(A) pages """
+    data = np.random.randint(0, 1000, (48, 2, 16, 12)).astype(np.uint16)
+    fname = tmp_path / "stack.tif"
+    tifffile.imwrite(str(fname), data.reshape((96, 16, 12)), photometric="minisblack")
+    frame_bytes = 16 * 12 * data.itemsize
+    # deinterleave_stack holds each chunk once more per written channel
+    max_memory = frame_bytes * 3 * frames_per_chunk
+
+    new_fnames = deinterleave_stack(fname, num_of_channels=2, max_memory=max_memory)
+
+    for channel, new_fname in enumerate(new_fnames):
+        with tifffile.TiffFile(str(new_fname)) as f:
+            assert len(f.pages) == 48
+            assert len(f.series) == 1
+        np.testing.assert_array_equal(tifffile.imread(str(new_fname)), data[:, channel])
+        np.testing.assert_array_equal(
+            StackReader(new_fname, num_of_channels=1).read(), data[:, channel]
+        )